@@ -1,3 +1,5 @@
 from filedbm.main import open, FileDBM
+from filedbm.aio import open_async, AsyncFileDBM
+from filedbm.packed import PackedFileDBM, thaw
 
-__all__ = ["open", "FileDBM"]
+__all__ = ["open", "FileDBM", "open_async", "AsyncFileDBM", "PackedFileDBM", "thaw"]
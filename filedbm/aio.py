@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+asyncio interface to FileDBM.
+"""
+import io
+import asyncio
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Union, Dict, List, Iterable, Tuple
+
+from . import utils
+from .main import FileDBM, ValueWriter
+
+############################################
+### Parameters
+
+## Number of items pulled from the blocking iterators per executor call
+iter_batch_size = 256
+## Max number of large values (that hold a file descriptor until they're read or closed) pulled per executor call
+iter_max_open_values = 32
+
+
+#######################################################
+### Classes
+
+
+class AsyncFileObjectReadSlice:
+    """
+    Async wrapper around a FileObjectReadSlice. The reads run on the executor of the AsyncFileDBM that returned it. Iterating with async for streams the value in buffer_size chunks.
+    """
+    def __init__(self, value: utils.FileObjectReadSlice, run, buffer_size: int):
+        self._value = value
+        self._run = run
+        self._buffer_size = buffer_size
+
+    @property
+    def length(self):
+        return self._value.length
+
+    @property
+    def closed(self):
+        return self._value.closed
+
+    def seek(self, offset, whence=0):
+        return self._value.seek(offset, whence)
+
+    def tell(self):
+        return self._value.tell()
+
+    async def read(self, size=-1):
+        return await self._run(self._value.read, size)
+
+    async def readinto(self, b):
+        return await self._run(self._value.readinto, b)
+
+    async def view(self, size=-1):
+        return await self._run(self._value.view, size)
+
+    async def close(self):
+        self._value.close()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        chunk = await self.read(self._buffer_size)
+        if chunk:
+            return chunk
+        else:
+            raise StopAsyncIteration
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+
+class AsyncValueWriter:
+    """
+    Async wrapper around a ValueWriter. The writes and the commit run on the executor of the AsyncFileDBM that returned it, so chunks can be written as they arrive (e.g. from an async HTTP body).
+    """
+    def __init__(self, writer: ValueWriter, run):
+        self._writer = writer
+        self._run = run
+
+    @property
+    def closed(self):
+        return self._writer.closed
+
+    async def write(self, data):
+        return await self._run(self._writer.write, data)
+
+    async def close(self):
+        await self._run(self._writer.close)
+
+    async def abort(self):
+        await self._run(self._writer.abort)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, *args):
+        if exc_type is None:
+            await self.close()
+        else:
+            await self.abort()
+
+
+class AsyncFileDBM:
+    """
+    asyncio counterpart of FileDBM. All blocking file I/O runs on a dedicated thread pool of max_concurrency threads, which also bounds the number of file operations (and open file descriptors) in flight at any one time. Use open_async to create one.
+    """
+    def __init__(self, db: FileDBM, executor: ThreadPoolExecutor):
+        """
+
+        """
+        self.db = db
+        self._executor = executor
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        if kwargs:
+            func = partial(func, **kwargs)
+
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def _wrap(self, value):
+        if isinstance(value, utils.FileObjectReadSlice):
+            return AsyncFileObjectReadSlice(value, self._run, self.db._buffer_size)
+        else:
+            return value
+
+    async def _aiter(self, iterator):
+        """
+        Pull items from a blocking iterator on the executor in batches.
+        """
+        iterator = iter(iterator)
+        while True:
+            batch = await self._run(utils.next_chunk, iterator, iter_batch_size)
+            for item in batch:
+                yield item
+            if len(batch) < iter_batch_size:
+                break
+
+    async def _aiter_values(self, iterator):
+        """
+        Pull (key, value) items from a blocking iterator on the executor in batches. Small values are read on the executor, and a batch holds at most iter_max_open_values large values, so no more file descriptors than that are opened ahead of the consumer.
+        """
+        iterator = iter(iterator)
+        while True:
+            batch = await self._run(utils.next_values_chunk, iterator, iter_batch_size, iter_max_open_values)
+            if not batch:
+                break
+            for key, value in batch:
+                yield key, self._wrap(value)
+
+    async def get(self, key: str, default=None, serializer=None):
+        value = await self._run(self.db._get_prefetched, key, serializer)
+        if value is None:
+            return default
+        else:
+            return self._wrap(value)
+
+    async def set(self, key: str, value: Any, ttl: int=None, serializer=None):
+        if self.db._write:
+            await self._run(self.db._set, key, value, ttl, serializer)
+        else:
+            raise ValueError('File is open for read only.')
+
+    def open_writer(self, key: str, ttl: int=None):
+        if self.db._write:
+            return AsyncValueWriter(ValueWriter(self.db, key, ttl), self._run)
+        else:
+            raise ValueError('File is open for read only.')
+
+    async def append(self, key: str, data: bytes, atomic: bool=True, durability: str=None):
+        if self.db._write:
+            await self._run(self.db._patch, 'append', key, None, data, atomic, durability)
+        else:
+            raise ValueError('File is open for read only.')
+
+    async def write_at(self, key: str, offset: int, data: bytes, atomic: bool=True, durability: str=None):
+        if self.db._write:
+            await self._run(self.db._patch, 'write_at', key, offset, data, atomic, durability)
+        else:
+            raise ValueError('File is open for read only.')
+
+    async def delete(self, key: str):
+        if self.db._write:
+            await self._run(self.db._delete, key)
+        else:
+            raise ValueError('File is open for read only.')
+
+    async def contains(self, key: str):
+        return await self._run(self.db._contains, key)
+
+    async def len(self):
+        return await self._run(len, self.db)
+
+    async def get_many(self, keys: Iterable[str], default=None, serializer=None):
+        """
+        Get many keys concurrently, iter_max_open_values at a time so that no more file descriptors than that are opened at once. Returns a list in input order; missing keys get the default and failed keys get their exception.
+        """
+        results = []
+        for keys_chunk in utils.chunks(keys, iter_max_open_values):
+            results.extend(await asyncio.gather(*[self.get(key, default, serializer) for key in keys_chunk], return_exceptions=True))
+
+        return results
+
+    async def set_many(self, key_values: Union[Dict[str, Union[bytes, io.IOBase]], Iterable[Tuple[str, Union[bytes, io.IOBase]]]]):
+        """
+        Write many key/value pairs concurrently. Returns a list in input order with None or the exception for each write.
+        """
+        if not self.db._write:
+            raise ValueError('File is open for read only.')
+        if isinstance(key_values, dict):
+            key_values = key_values.items()
+        results = await asyncio.gather(*[self.set(key, value) for key, value in key_values], return_exceptions=True)
+
+        return list(results)
+
+    async def delete_many(self, keys: Iterable[str]):
+        """
+        Delete many keys concurrently. Returns a list in input order with None or the exception for each key.
+        """
+        if not self.db._write:
+            raise ValueError('File is open for read only.')
+        results = await asyncio.gather(*[self.delete(key) for key in keys], return_exceptions=True)
+
+        return list(results)
+
+    async def contains_many(self, keys: Iterable[str]):
+        results = await asyncio.gather(*[self.contains(key) for key in keys], return_exceptions=True)
+
+        return list(results)
+
+    async def update(self, key_value_dict: Union[Dict[str, bytes], Dict[str, io.IOBase]]):
+        for result in await self.set_many(key_value_dict):
+            if isinstance(result, Exception):
+                raise result
+
+    async def keys(self, prefix: str=None, start: str=None, stop: str=None, reverse: bool=False):
+        async for key in self._aiter(self.db.keys(prefix, start, stop, reverse)):
+            yield key
+
+    async def items(self, keys: List[str]=None, prefix: str=None, start: str=None, stop: str=None, reverse: bool=False):
+        if prefix is not None or start is not None or stop is not None or reverse:
+            ## Keys deleted since they were listed are skipped
+            range_keys = await self._run(list, self.db._range_keys(prefix, start, stop, reverse))
+            async for key, value in self._get_chunks(range_keys):
+                if value is not None:
+                    yield key, value
+        elif keys is None:
+            async for item in self._aiter_values(self.db.items()):
+                yield item
+        else:
+            async for item in self._get_chunks(keys):
+                yield item
+
+    async def _get_chunks(self, keys):
+        """
+        Get the values of keys concurrently, iter_max_open_values at a time so that no more file descriptors than that are held ahead of the consumer.
+        """
+        for keys_chunk in utils.chunks(keys, iter_max_open_values):
+            for key, value in zip(keys_chunk, await self.get_many(keys_chunk)):
+                if isinstance(value, Exception):
+                    raise value
+                yield key, value
+
+    async def values(self, keys: List[str]=None, prefix: str=None, start: str=None, stop: str=None, reverse: bool=False):
+        async for key, value in self.items(keys, prefix, start, stop, reverse):
+            yield value
+
+    def __aiter__(self):
+        return self.keys()
+
+    async def clear(self):
+        await self._run(self.db.clear)
+
+    async def verify(self, quarantine: bool=False, processes: bool=False, max_workers: int=None):
+        return await self._run(self.db.verify, quarantine, processes, max_workers)
+
+    async def close(self):
+        await self._run(self.db.close)
+        self._executor.shutdown(wait=False)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+
+#######################################################
+### Functions
+
+
+async def open_async(
+    db_path: str, flag: str = "r", max_concurrency: int=32, **kwargs):
+    """
+    Open a database for use with asyncio. Takes the same parameters as filedbm.open plus max_concurrency.
+
+    Parameters
+    -----------
+    db_path : str or pathlib.Path
+        It must be a path to a folder.
+
+    flag : str
+        Flag associated with how the file is opened according to the dbm style. See filedbm.open.
+
+    max_concurrency : int
+        The maximum number of blocking file operations that run at the same time. Further requests wait in the executor queue without holding file descriptors.
+
+    kwargs
+        Any other parameters of filedbm.open.
+
+    Returns
+    -------
+    AsyncFileDBM
+    """
+    executor = ThreadPoolExecutor(max_concurrency, thread_name_prefix='filedbm-async')
+    loop = asyncio.get_running_loop()
+    try:
+        db = await loop.run_in_executor(executor, partial(FileDBM, db_path, flag, **kwargs))
+    except BaseException:
+        executor.shutdown(wait=False)
+        raise
+
+    return AsyncFileDBM(db, executor)
@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Multi-key write batches.
+
+FileDBM.batch stages writes and deletes and applies them together. While a batch is open every value is written (and compressed) to its own staged data file in the batch's folder in .filedbm/batches, so nothing is visible yet. Committing makes the staged files durable and then writes the batch's log (the operations in order, as JSON) and renames it into .filedbm/batches next to the folder: the log existing is the commit point, and its mtime is the commit time. The operations are then applied (the staged files are renamed into place and the deletes done) with a single durability barrier at the end, after which the log and the batch folder are removed.
+
+A writer opening the database replays the batches that were committed but not completely applied and discards the ones that were never committed, so after a crash a batch is either applied completely or not at all. A batch holds an flock on its lock file while it's open, so the batches of live processes are left alone (without fcntl only batches older than utils.stale_tmp_age are recovered). Applying (or replaying) an operation is skipped when its key has been written since the commit, so a replay never overwrites or deletes a newer value.
+
+Readers don't lock. Instead get and `in` look up the key in the logs of the pending batches (see PendingBatches) and read the staged value, so a batch is seen either not at all or completely while its renames are in progress. The keys of a batch are added to the Bloom filter before it's committed, so a key that the filter rules out is never pending. keys(), len() and the other scans only see the operations applied so far.
+"""
+import os
+import io
+import json
+import shutil
+from threading import Lock
+from time import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from . import utils
+
+############################################
+### Parameters
+
+batches_dir_name = 'batches'
+log_suffix = '.log'
+lock_suffix = '.lock'
+## The folder of the batches is listed on every check while its mtime is more recent than this (in seconds), as a commit in the same clock tick as the last listing may not change it. Values written less than this before the last check also make readers check again.
+dir_mtime_margin = 1
+
+## How often (in seconds) readers check for batches committed by other processes when nothing else makes them check
+refresh_interval = 1
+
+
+#######################################################
+### Classes
+
+
+class Batch:
+    """
+    Writes and deletes staged by FileDBM.batch. Use it as a context manager: the batch is committed when the block exits and discarded if the block raises. Only the last write or delete of a key in a batch is kept. Deleting a key that doesn't exist is ignored.
+    """
+    def __init__(self, db, durability: str):
+        self._db = db
+        self.durability = durability
+        self.path, self._lock_fd = create_batch(db.db_path)
+        self._ops = {}
+        self._n_files = 0
+        self.closed = False
+
+    def _check_open(self):
+        if self.closed:
+            raise ValueError('The batch has already been committed or aborted.')
+
+    def __setitem__(self, key: str, value):
+        self.set(key, value)
+
+    def set(self, key: str, value, ttl: int=None, serializer=None):
+        """
+        Stage a write. Takes the same values as FileDBM.set; the value is read (and written to a staged file) now.
+        """
+        self._check_open()
+        if isinstance(value, os.PathLike):
+            with io.open(value, 'rb') as f:
+                return self.set(key, f, ttl, serializer)
+
+        db = self._db
+        serializer = db._get_serializer(serializer)
+        if serializer is not None:
+            value = serializer.dumps(value)
+
+        now = time()
+        fields = {}
+        if ttl is not None:
+            fields[utils.field_expiry] = utils.expiry_struct.pack(now + ttl)
+
+        file_name = str(self._n_files)
+        self._n_files += 1
+        writer = utils.DataBlockWriter(db.db_path, key.encode(), db._n_bytes_key, db._n_bytes_value, db._compressor, self.path.joinpath(file_name), db._checksum)
+        try:
+            if isinstance(value, (bytes, bytearray, memoryview)):
+                writer.write(value)
+            else:
+                writer.write_from(value, db._buffer_size)
+            writer.finish(fields)
+        except BaseException:
+            writer.abort()
+            raise
+
+        self._discard(key)
+        self._ops[key] = ('set', file_name, ttl, now)
+
+    def __delitem__(self, key: str):
+        self.delete(key)
+
+    def delete(self, key: str):
+        """
+        Stage a delete.
+        """
+        self._check_open()
+        self._discard(key)
+        self._ops[key] = ('delete',)
+
+    def update(self, key_values):
+        """
+        Stage the writes of a dict or an iterable of (key, value) pairs.
+        """
+        if isinstance(key_values, dict):
+            key_values = key_values.items()
+        for key, value in key_values:
+            self.set(key, value)
+
+    def __len__(self):
+        return len(self._ops)
+
+    def _discard(self, key):
+        op = self._ops.pop(key, None)
+        if op is not None and op[0] == 'set':
+            os.unlink(self.path.joinpath(op[1]))
+
+    def commit(self):
+        """
+        Make the staged files durable, write the log and apply the batch. If the process dies after the log has been written, the batch is applied by the next writer that opens the database.
+        """
+        self._check_open()
+        self.closed = True
+        try:
+            ops = [(key,) + op for key, op in self._ops.items()]
+            if self._db._bloom is not None:
+                ## Readers only look for pending batches once the filter doesn't rule the key out
+                for key, op, *args in ops:
+                    if op == 'set':
+                        self._db._bloom.add(utils.hash_key(key.encode()))
+            if self.durability != 'none':
+                ## The staged files are fsynced concurrently rather than one after the other
+                files = [self.path.joinpath(op[2]) for op in ops if op[1] == 'set']
+                list(self._db._get_executor().map(utils.fsync_path, files))
+            commit_ns = write_log(self.path, ops, self.durability != 'none')
+        except BaseException:
+            remove_batch(self.path)
+            release_batch(self._lock_fd)
+            raise
+
+        try:
+            self._db._apply_batch(self.path, ops, commit_ns, self.durability)
+        finally:
+            release_batch(self._lock_fd)
+
+    def abort(self):
+        """
+        Discard the staged writes and deletes.
+        """
+        if not self.closed:
+            self.closed = True
+            remove_batch(self.path)
+            release_batch(self._lock_fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+
+
+class PendingBatches:
+    """
+    The operations of the batches that are committed but not completely applied, for readers. The logs are read when they appear (a log never changes once written) and forgotten when they're removed. The folder is checked at most every refresh_interval seconds, unless the reader has seen a sign of a batch that it doesn't know of yet: a missing value (which may have been deleted by a batch) or a value written since the last check (see is_recent). A batch is applied in order and its log removed last, so a reader that has seen one of its applied operations always finds the rest.
+    """
+    def __init__(self, db_path):
+        self.path = db_path.joinpath(utils.sys_dir_name, batches_dir_name)
+        self._mtime = None
+        self._checked = 0
+        self._logs = {}
+        self._ops = {}
+        self._lock = Lock()
+
+    def get(self, key: str, check: bool=False):
+        """
+        The pending operation of a key as (batch folder, commit time in ns, op), or None. op is ('set', staged file name, ttl, time) or ('delete',). If several pending batches have the key, the last committed wins. With check=True the folder is checked now rather than only once refresh_interval has passed.
+        """
+        if check or time() - self._checked >= refresh_interval:
+            self.refresh()
+
+        if self._ops:
+            return self._ops.get(key)
+
+    def is_recent(self, mtime_ns: int):
+        """
+        Whether a value written at mtime_ns could have been written by a batch committed after the last check.
+        """
+        return mtime_ns/1e9 > self._checked - dir_mtime_margin
+
+    def refresh(self):
+        self._checked = time()
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self._mtime and (mtime is None or time() - mtime/1e9 > dir_mtime_margin):
+            return
+
+        with self._lock:
+            self._mtime = mtime
+            try:
+                names = [name for name in os.listdir(self.path) if name.endswith(log_suffix)]
+            except FileNotFoundError:
+                names = []
+
+            logs = {}
+            for name in names:
+                path = self.path.joinpath(name[:-len(log_suffix)])
+                log = self._logs.get(path)
+                if log is None:
+                    log = read_log(path)
+                    if log is None:
+                        ## Applied and removed since the folder was listed
+                        continue
+                logs[path] = log
+
+            ops = {}
+            for path, (batch_ops, commit_ns) in sorted(logs.items(), key=lambda item: item[1][1]):
+                for key, *op in batch_ops:
+                    ops[key] = (path, commit_ns, tuple(op))
+            self._logs = logs
+            self._ops = ops
+
+    def after_fork(self):
+        self._lock = Lock()
+
+
+#######################################################
+### Functions
+
+
+def create_batch(db_path):
+    """
+    Create the folder of a new batch. The lock file is created and locked before the folder, so a batch is never seen unlocked while it's in use. Returns the folder path and the fd of the lock file.
+    """
+    batches_path = db_path.joinpath(utils.sys_dir_name, batches_dir_name)
+    batches_path.mkdir(parents=True, exist_ok=True)
+    batch_id = os.urandom(8).hex()
+    lock_fd = os.open(batches_path.joinpath(batch_id + lock_suffix), os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o666)
+    if fcntl is not None:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+    path = batches_path.joinpath(batch_id)
+    path.mkdir()
+
+    return path, lock_fd
+
+
+def iter_batches(db_path):
+    """
+    The folders of the batches in the database.
+    """
+    batches_path = db_path.joinpath(utils.sys_dir_name, batches_dir_name)
+    try:
+        entries = list(os.scandir(batches_path))
+    except FileNotFoundError:
+        return
+
+    for entry in entries:
+        if entry.is_dir():
+            yield batches_path.joinpath(entry.name)
+
+
+def claim_batch(path):
+    """
+    Lock a batch for recovery. Returns the fd of its lock file, or None if the batch is in use by a live process (or has been removed in the meantime).
+    """
+    lock_path = path.with_name(path.name + lock_suffix)
+    try:
+        lock_fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o666)
+    except FileNotFoundError:
+        return None
+
+    if fcntl is None:
+        if time() - os.fstat(lock_fd).st_mtime > utils.stale_tmp_age:
+            return lock_fd
+    else:
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            pass
+        else:
+            if path.exists():
+                return lock_fd
+            ## Applied and removed since it was listed
+            lock_path.unlink()
+
+    os.close(lock_fd)
+
+    return None
+
+
+def release_batch(lock_fd):
+    os.close(lock_fd)
+
+
+def log_path(path):
+    return path.with_name(path.name + log_suffix)
+
+
+def write_log(path, ops, sync: bool):
+    """
+    Write the log of a batch (the commit point). It's written to a temporary file in the batch's folder and renamed next to it; with sync the log and the folder of the batches are fsynced. Returns the commit time (the mtime of the log in ns).
+    """
+    tmp_path = path.joinpath(log_suffix + '.tmp')
+    with io.open(tmp_path, 'w') as f:
+        json.dump(ops, f)
+        if sync:
+            f.flush()
+            os.fsync(f.fileno())
+        commit_ns = os.fstat(f.fileno()).st_mtime_ns
+    os.replace(tmp_path, log_path(path))
+    if sync:
+        utils.fsync_dir(path.parent)
+
+    return commit_ns
+
+
+def read_log(path):
+    """
+    The operations of a committed batch as a list of (key, 'set', staged file name, ttl, time) and (key, 'delete') and its commit time in ns, or None if the batch was never committed.
+    """
+    try:
+        with io.open(log_path(path)) as f:
+            return json.load(f), os.fstat(f.fileno()).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def read_staged_value(path, file_name, n_bytes_key, n_bytes_value, ttl=None, buffer_size=512000):
+    """
+    The value of a staged file of a batch as a FileObjectReadSlice, or None if it has been applied (or the value has expired).
+    """
+    try:
+        block = utils.open_data_block(path.joinpath(file_name), n_bytes_key, n_bytes_value)
+    except FileNotFoundError:
+        return None
+
+    if utils.is_expired(block.stat.st_mtime, block.fields, ttl):
+        utils.close_data_block(block)
+        return None
+
+    return utils.data_block_value(block, buffer_size)
+
+
+def remove_batch(path):
+    """
+    Remove the log of a batch, its folder and its lock file. The log goes first, so a batch is never left committed without its staged files.
+    """
+    try:
+        log_path(path).unlink()
+    except FileNotFoundError:
+        pass
+    shutil.rmtree(path, ignore_errors=True)
+    try:
+        path.with_name(path.name + lock_suffix).unlink()
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark suite.
+
+Run it with python -m filedbm.bench. Every operation is timed over a grid of key counts and value sizes, the results (throughput and p50/p99 latency) are written as JSON and can be compared against a saved baseline:
+
+    python -m filedbm.bench --keys 1000,100000 --sizes 100,10k,1M --output results.json
+    python -m filedbm.bench --baseline results.json --fail-on-regression
+
+Key counts and value sizes take k/M/G suffixes. Combinations whose total data would exceed --max-bytes use fewer keys (the key count that was actually used is in the results).
+"""
+import os
+import sys
+import json
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+from time import perf_counter, time, strftime, gmtime
+
+from .main import FileDBM
+
+############################################
+### Parameters
+
+operations = ('set', 'get', 'contains', 'keys', 'items', 'len', 'update', 'expire')
+
+default_keys = '1k,10k'
+default_sizes = '100,10k,1M'
+default_max_bytes = '1G'
+
+## Number of key/value pairs per update call
+update_batch_size = 1000
+
+## Number of times len is timed
+len_repeats = 5
+
+suffixes = {'k': 10**3, 'm': 10**6, 'g': 10**9}
+
+
+#######################################################
+### Functions
+
+
+def parse_number(text):
+    """
+    Parse an integer with an optional k, M or G suffix.
+    """
+    text = text.strip()
+    multiplier = suffixes.get(text[-1:].lower())
+    if multiplier is None:
+        return int(text)
+    else:
+        return int(float(text[:-1])*multiplier)
+
+
+def parse_numbers(text):
+    return [parse_number(item) for item in text.split(',') if item.strip()]
+
+
+def percentile(sorted_values, q):
+    """
+    Nearest-rank percentile of already sorted values.
+    """
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(q/100*len(sorted_values) + 0.5)) - 1))
+
+    return sorted_values[index]
+
+
+def summarize(op, n_keys, value_size, latencies, n_items, n_bytes):
+    """
+    Create the result record of an operation from its latencies (in seconds, one per call).
+    """
+    latencies = sorted(latencies)
+    total = sum(latencies)
+
+    return {
+        'op': op,
+        'n_keys': n_keys,
+        'value_size': value_size,
+        'calls': len(latencies),
+        'items': n_items,
+        'total_s': total,
+        'items_per_s': n_items/total if total else None,
+        'mb_per_s': n_bytes/total/1e6 if (total and n_bytes) else None,
+        'p50_ms': percentile(latencies, 50)*1e3,
+        'p99_ms': percentile(latencies, 99)*1e3,
+        }
+
+
+def timed(func, *args):
+    start = perf_counter()
+    result = func(*args)
+
+    return perf_counter() - start, result
+
+
+def read_all(value, buffer_size):
+    n = 0
+    chunk = value.read(buffer_size)
+    while chunk:
+        n += len(chunk)
+        chunk = value.read(buffer_size)
+    value.close()
+
+    return n
+
+
+def bench_scenario(db_path, n_keys, value_size, ops, open_kwargs, rng):
+    """
+    Run the operations for one key count and value size on a new database. Returns the result records.
+    """
+    results = []
+    keys = ['key-{:09d}'.format(i) for i in range(n_keys)]
+    value = os.urandom(value_size)
+    buffer_size = open_kwargs.get('buffer_size', 512000)
+
+    db = FileDBM(db_path, 'n', **open_kwargs)
+    try:
+        latencies = []
+        for key in keys:
+            latencies.append(timed(db.__setitem__, key, value)[0])
+        if 'set' in ops:
+            results.append(summarize('set', n_keys, value_size, latencies, n_keys, n_keys*value_size))
+
+        lookup_keys = list(keys)
+        rng.shuffle(lookup_keys)
+
+        if 'get' in ops:
+            latencies = []
+            for key in lookup_keys:
+                start = perf_counter()
+                read_all(db.get(key), buffer_size)
+                latencies.append(perf_counter() - start)
+            results.append(summarize('get', n_keys, value_size, latencies, n_keys, n_keys*value_size))
+
+        if 'contains' in ops:
+            latencies = [timed(db.__contains__, key)[0] for key in lookup_keys]
+            results.append(summarize('contains', n_keys, value_size, latencies, n_keys, 0))
+
+        if 'keys' in ops:
+            latency, n = timed(lambda: sum(1 for _ in db.keys()))
+            results.append(summarize('keys', n_keys, value_size, [latency], n, 0))
+
+        if 'items' in ops:
+            start = perf_counter()
+            n_bytes = 0
+            n = 0
+            for key, item_value in db.items():
+                n_bytes += read_all(item_value, buffer_size)
+                n += 1
+            results.append(summarize('items', n_keys, value_size, [perf_counter() - start], n, n_bytes))
+
+        if 'len' in ops:
+            latencies = [timed(len, db)[0] for _ in range(len_repeats)]
+            results.append(summarize('len', n_keys, value_size, latencies, n_keys*len_repeats, 0))
+
+        if 'update' in ops:
+            latencies = []
+            for i in range(0, n_keys, update_batch_size):
+                batch = {key: value for key in keys[i:i + update_batch_size]}
+                latencies.append(timed(db.update, batch)[0])
+            results.append(summarize('update', n_keys, value_size, latencies, n_keys, n_keys*value_size))
+
+        if 'expire' in ops:
+            for key in keys:
+                db.set(key, value, -1)
+            latency, n_removed = timed(db.expire, None, True)
+            results.append(summarize('expire', n_keys, value_size, [latency], n_removed, 0))
+    finally:
+        db.close()
+        shutil.rmtree(db_path, ignore_errors=True)
+
+    return results
+
+
+def run(keys, sizes, ops=operations, max_bytes=10**9, open_kwargs=None, base_path=None, seed=0, log=None):
+    """
+    Run the benchmarks over all combinations of key counts and value sizes. Returns the report (metadata and results) as a dict.
+    """
+    if open_kwargs is None:
+        open_kwargs = {}
+    rng = random.Random(seed)
+    tmp_dir = tempfile.mkdtemp(prefix='filedbm-bench-', dir=base_path)
+
+    results = []
+    done = set()
+    try:
+        for value_size in sizes:
+            for n_keys in keys:
+                n = max(1, min(n_keys, max_bytes // max(value_size, 1)))
+                if (n, value_size) in done:
+                    continue
+                done.add((n, value_size))
+                if log is not None:
+                    log('{} keys x {} bytes'.format(n, value_size))
+                results.extend(bench_scenario(os.path.join(tmp_dir, 'db'), n, value_size, ops, open_kwargs, rng))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    meta = {
+        'time': strftime('%Y-%m-%dT%H:%M:%SZ', gmtime(time())),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'open_kwargs': open_kwargs,
+        'seed': seed,
+        }
+
+    return {'meta': meta, 'results': results}
+
+
+def compare(report, baseline, threshold=0.1):
+    """
+    Compare the throughput of each result with the same operation, key count and value size in the baseline. Returns a list of comparison records; regression is True when the throughput dropped by more than threshold (a fraction).
+    """
+    base = {(r['op'], r['n_keys'], r['value_size']): r for r in baseline['results']}
+
+    comparisons = []
+    for result in report['results']:
+        old = base.get((result['op'], result['n_keys'], result['value_size']))
+        if old is None or not old['items_per_s'] or not result['items_per_s']:
+            continue
+        ratio = result['items_per_s']/old['items_per_s']
+        comparisons.append({
+            'op': result['op'],
+            'n_keys': result['n_keys'],
+            'value_size': result['value_size'],
+            'baseline_items_per_s': old['items_per_s'],
+            'items_per_s': result['items_per_s'],
+            'ratio': ratio,
+            'baseline_p99_ms': old['p99_ms'],
+            'p99_ms': result['p99_ms'],
+            'regression': ratio < 1 - threshold,
+            })
+
+    return comparisons
+
+
+def format_table(report, comparisons=None):
+    lines = ['{:<9} {:>9} {:>11} {:>14} {:>10} {:>10} {:>10}'.format('op', 'keys', 'value size', 'items/s', 'MB/s', 'p50 ms', 'p99 ms')]
+    for r in report['results']:
+        lines.append('{:<9} {:>9} {:>11} {:>14.1f} {:>10} {:>10.4f} {:>10.4f}'.format(r['op'], r['n_keys'], r['value_size'], r['items_per_s'] or 0, '' if r['mb_per_s'] is None else '{:.1f}'.format(r['mb_per_s']), r['p50_ms'], r['p99_ms']))
+
+    if comparisons:
+        lines.append('')
+        lines.append('{:<9} {:>9} {:>11} {:>10} {:>12}'.format('op', 'keys', 'value size', 'ratio', ''))
+        for c in comparisons:
+            lines.append('{:<9} {:>9} {:>11} {:>10.3f} {:>12}'.format(c['op'], c['n_keys'], c['value_size'], c['ratio'], 'REGRESSION' if c['regression'] else ''))
+
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m filedbm.bench', description='Benchmark FileDBM operations over key counts and value sizes.')
+    parser.add_argument('--keys', default=default_keys, help='Comma separated key counts (e.g. 1k,10k,1M). Default: ' + default_keys)
+    parser.add_argument('--sizes', default=default_sizes, help='Comma separated value sizes in bytes (e.g. 10,1k,100M). Default: ' + default_sizes)
+    parser.add_argument('--ops', default=','.join(operations), help='Comma separated operations to report. Default: all of ' + ','.join(operations))
+    parser.add_argument('--max-bytes', default=default_max_bytes, help='The max total bytes of values per combination. Default: ' + default_max_bytes)
+    parser.add_argument('--path', default=None, help='The folder to create the benchmark databases in (use the filesystem to be measured). Default: the system temp folder.')
+    parser.add_argument('--open-kwargs', default='{}', help='JSON object of extra parameters for filedbm.open, e.g. \'{"shard_depth": 2, "compression": "zstd"}\'.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help='Write the JSON report to this file. Default: stdout.')
+    parser.add_argument('--baseline', default=None, help='A JSON report to compare against.')
+    parser.add_argument('--threshold', type=float, default=0.1, help='The drop in throughput (as a fraction) that counts as a regression. Default: 0.1')
+    parser.add_argument('--fail-on-regression', action='store_true', help='Exit with status 1 if any regression is found.')
+    args = parser.parse_args(argv)
+
+    ops = [op.strip() for op in args.ops.split(',') if op.strip()]
+    unknown = set(ops) - set(operations)
+    if unknown:
+        parser.error('Unknown operations: ' + ', '.join(sorted(unknown)))
+
+    def log(message):
+        print(message, file=sys.stderr)
+
+    report = run(parse_numbers(args.keys), parse_numbers(args.sizes), ops, parse_number(args.max_bytes), json.loads(args.open_kwargs), args.path, args.seed, log)
+
+    comparisons = None
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            comparisons = compare(report, json.load(f), args.threshold)
+        report['comparison'] = {'baseline': args.baseline, 'threshold': args.threshold, 'results': comparisons}
+
+    output = json.dumps(report, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(output)
+
+    print(format_table(report, comparisons), file=sys.stderr)
+
+    if args.fail_on_regression and comparisons and any(c['regression'] for c in comparisons):
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Bloom filter over the key hashes.
+
+The filter lives in .filedbm/bloom and is memory mapped shared by every process that opens the database, so a key written by one process is immediately visible to the lookups of the others. A lookup that the filter rules out returns without touching the filesystem. Every bit position is stored as a whole byte: setting a position is then a single byte store, which can't lose the positions set concurrently by other threads or processes (a read-modify-write of packed bits could, and Python has no atomic operations on a memory map). The price is 8 times the memory of a packed filter, about -1.44*log2(fpr) bytes per key (9.6 at 1%), doubled by the capacity headroom of a rebuild. Deleted keys can't be removed from a Bloom filter, so their positions stay set until the filter is rebuilt; it is rebuilt (sized for twice the current number of keys) whenever it fills up to the point that its false-positive rate is well above the target. The number of positions set is kept in the header as they're set, so checking the fill doesn't scan the filter. It isn't locked between processes, so concurrent adds can miscount a little; every rebuild recounts it.
+
+A new filter is put in place empty and marked as building before the keys are listed, and the keys are set in the mapped file. Lookups treat a building filter as containing everything, and writers (including those of processes that opened the database before the filter was enabled, see filter_exists) add their keys to it, so a key written while the filter is built can't be missed. Writers only stat the filter file on a timer (writer_check_interval), so a new filter waits that long after it's put in place before listing the keys: by then every writer has either found it or finished the writes it made without it.
+"""
+import os
+import io
+import mmap
+import math
+import struct
+from threading import Lock
+from time import time, sleep
+
+from . import utils
+
+############################################
+### Parameters
+
+bloom_file_name = 'bloom'
+
+magic = b'FDBMBLOM'
+version = 2
+
+## magic, version, number of hash functions, retired flag, building flag, number of positions, capacity (keys), target false-positive rate, number of positions set
+header_struct = struct.Struct('<8sHHBB2xQQdQ')
+retired_pos = 12
+building_pos = 13
+count_struct = struct.Struct('<Q')
+count_pos = header_struct.size - count_struct.size
+
+min_capacity = 1024
+
+## The filter is rebuilt once its estimated false-positive rate exceeds this multiple of the target
+max_fpr_ratio = 2
+
+## How often (in seconds) a reader without a filter file looks for one
+reopen_interval = 1
+
+## How often (in seconds) a writer without a filter file looks for one
+writer_check_interval = 0.1
+
+
+#######################################################
+### Classes
+
+
+class BloomFilter:
+    """
+    The shared filter of a database. A filter that has been replaced by a rebuild is marked as retired in its header, so the processes still mapping it switch to the new file on their next lookup.
+    """
+    def __init__(self, db_path, fpr: float, write: bool):
+        self.path = db_path.joinpath(utils.sys_dir_name, bloom_file_name)
+        self.fpr = fpr
+        self._write = write
+        self._lock = Lock()
+        ## The mapping with its number of positions and hash functions, replaced as a whole so that lookups never mix up two filters
+        self._filter = None
+        self._next_open = 0
+        self._n_changes = 0
+        self.needs_rebuild = False
+        self._open()
+
+    def _open(self):
+        """
+        Map the current filter file. Returns False if there is none. The old mapping isn't closed as lookups in other threads may still be using it; it's unmapped once they're done with it.
+        """
+        self._filter = None
+        try:
+            with io.open(self.path, 'r+b' if self._write else 'rb') as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_WRITE if self._write else mmap.ACCESS_READ)
+        except FileNotFoundError:
+            self._next_open = time() + (writer_check_interval if self._write else reopen_interval)
+            return False
+
+        file_magic, file_version, k, retired, building, m, self.capacity, fpr, n_set = header_struct.unpack_from(mm, 0)
+        if file_magic != magic or file_version != version:
+            mm.close()
+            if self._write:
+                ## Replaced by the rebuild of the writer
+                return False
+            raise ValueError('The Bloom filter file is not valid. Rebuild it with rebuild_bloom.')
+        self._filter = (mm, m, k)
+        self._n_changes = 0
+        self._check_interval = max(min_capacity, self.capacity // 8)
+
+        return True
+
+    def exists(self):
+        return self._filter is not None
+
+    def might_contain(self, key_hash: str):
+        """
+        False if the key is definitely not in the database. Without a filter everything might be.
+        """
+        bloom = self._filter
+        if bloom is None or bloom[0][retired_pos]:
+            if bloom is None and time() < self._next_open:
+                return True
+            with self._lock:
+                if not self._open():
+                    return True
+            bloom = self._filter
+
+        mm, m, k = bloom
+        if mm[building_pos]:
+            return True
+        for pos in positions(key_hash, m, k):
+            if not mm[pos]:
+                return False
+
+        return True
+
+    def add(self, key_hash: str):
+        """
+        Set the positions of a key hash. Called before the value is written, so a lookup never misses a stored key. A filter replaced by a rebuild is retired before the rebuild lists the keys, so the positions are set again in the new filter if it was retired meanwhile.
+        """
+        with self._lock:
+            while True:
+                if self._filter is None:
+                    if time() < self._next_open or not self._open():
+                        return
+                elif self._filter[0][retired_pos] and not self._open():
+                    return
+                mm, m, k = self._filter
+                n_new = set_positions(mm, positions(key_hash, m, k))
+                if n_new:
+                    n_set, = count_struct.unpack_from(mm, count_pos)
+                    count_struct.pack_into(mm, count_pos, n_set + n_new)
+                if not mm[retired_pos]:
+                    break
+            self._count_change()
+
+    def discard(self, key_hash: str):
+        """
+        A key has been deleted. Its positions can't be cleared, but the deletes count towards the next saturation check.
+        """
+        if self._filter is not None:
+            with self._lock:
+                self._count_change()
+
+    def _count_change(self):
+        self._n_changes += 1
+        if self._n_changes >= self._check_interval:
+            self._n_changes = 0
+            if self.estimated_fpr() > max_fpr_ratio*self.fpr:
+                self.needs_rebuild = True
+
+    def estimated_fpr(self):
+        """
+        The false-positive rate estimated from the fraction of positions that are set.
+        """
+        mm, m, k = self._filter
+        n_set, = count_struct.unpack_from(mm, count_pos)
+
+        return min(1, n_set/m)**k
+
+    def build(self, key_hashes):
+        """
+        Replace the filter with a new one over key_hashes (a callable returning an iterable of all the key hashes in the database), sized for twice their number. The hashes are listed twice: once to size the filter, then again after the new filter has been put in place (marked as building), so the keys written meanwhile by any process are in it. A filter that replaces no other first waits for the writers that haven't looked for it yet.
+        """
+        capacity = max(min_capacity, 2*sum(1 for _ in key_hashes()))
+        m = math.ceil(-capacity*math.log(self.fpr)/math.log(2)**2)
+        k = max(1, round(m/capacity*math.log(2)))
+
+        tmp_path = self.path.with_name(bloom_file_name + '.' + os.urandom(6).hex() + '.tmp')
+        with io.open(tmp_path, 'wb') as f:
+            f.write(header_struct.pack(magic, version, k, 0, 1, m, capacity, self.fpr, 0))
+            f.truncate(header_struct.size + m)
+
+        with self._lock:
+            os.replace(tmp_path, self.path)
+            replaced = self._filter is not None
+            if replaced:
+                self._filter[0][retired_pos] = 1
+            self._open()
+            self.needs_rebuild = False
+            mm = self._filter[0]
+
+        if not replaced:
+            sleep(writer_check_interval)
+
+        for key_hash in key_hashes():
+            set_positions(mm, positions(key_hash, m, k))
+
+        count_struct.pack_into(mm, count_pos, mm[header_struct.size:].count(1))
+        mm[building_pos] = 0
+
+    def remove(self):
+        """
+        Remove the filter file (when the filter is disabled).
+        """
+        with self._lock:
+            if self._filter is not None:
+                self._filter[0][retired_pos] = 1
+                self._filter[0].close()
+                self._filter = None
+            try:
+                self.path.unlink()
+            except FileNotFoundError:
+                pass
+
+    def after_fork(self):
+        self._lock = Lock()
+
+    def close(self):
+        with self._lock:
+            if self._filter is not None:
+                self._filter[0].close()
+                self._filter = None
+
+
+#######################################################
+### Functions
+
+
+def filter_exists(db_path):
+    """
+    Whether the database has a filter file (checked by writers that opened the database without one).
+    """
+    return db_path.joinpath(utils.sys_dir_name, bloom_file_name).exists()
+
+
+def set_positions(mm, pos_list):
+    """
+    Set the positions in a mapped filter. Returns the number that weren't set yet.
+    """
+    n_new = 0
+    for pos in pos_list:
+        if not mm[pos]:
+            mm[pos] = 1
+            n_new += 1
+
+    return n_new
+
+
+def positions(key_hash, m, k):
+    """
+    The k byte positions of a key hash in a filter of m positions (double hashing over the key hash).
+    """
+    digest = bytes.fromhex(key_hash)
+    h1 = int.from_bytes(digest[:8], 'little')
+    h2 = int.from_bytes(digest[-8:], 'little') | 1
+
+    return [header_struct.size + (h1 + i*h2) % m for i in range(k)]
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Value checksums.
+
+crc32 and blake2b are always available. crc32c and xxhash are used when the crc32c and xxhash packages are installed. The checksum covers the value as stored (i.e. after compression) and is computed while the value is written; it's recorded with its algorithm in the trailer of the data block, so a database can hold a mix of algorithms (and values without checksums).
+"""
+import zlib
+from hashlib import blake2b
+
+from .registry import Registry
+
+try:
+    import crc32c
+except ImportError:
+    crc32c = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+############################################
+### Parameters
+
+blake2b_digest_size = 16
+
+
+#######################################################
+### Classes
+
+
+class ChecksumError(ValueError):
+    """
+    A value doesn't match its stored checksum.
+    """
+
+
+class Checksum:
+    """
+    A checksum algorithm. new() returns a hasher with update(data) and digest(). resume(digest), if the algorithm has it, returns a hasher that continues from the digest of the data so far, so an append only hashes the appended data.
+    """
+    def __init__(self, name: str, checksum_id: int, new, resume=None):
+        self.name = name
+        self.checksum_id = checksum_id
+        self.new = new
+        self.resume = resume
+
+
+class CRC32:
+    """
+    Give the running crcs the update/digest interface of hashlib.
+    """
+    def __init__(self, func, crc: int=0):
+        self._func = func
+        self._crc = crc
+
+    def update(self, data):
+        self._crc = self._func(data, self._crc)
+
+    def digest(self):
+        return self._crc.to_bytes(4, 'little')
+
+
+#######################################################
+### Functions
+
+
+def crc32_new():
+    return CRC32(zlib.crc32)
+
+
+def crc32_resume(digest):
+    return CRC32(zlib.crc32, int.from_bytes(digest, 'little'))
+
+
+def crc32c_new():
+    return CRC32(crc32c.crc32c)
+
+
+def crc32c_resume(digest):
+    return CRC32(crc32c.crc32c, int.from_bytes(digest, 'little'))
+
+
+def xxhash_new():
+    return xxhash.xxh3_64()
+
+
+def blake2b_new():
+    return blake2b(digest_size=blake2b_digest_size)
+
+
+registry = Registry('checksum', 'checksums', [
+    Checksum('crc32', 1, crc32_new, crc32_resume),
+    Checksum('crc32c', 2, crc32c_new, crc32c_resume),
+    Checksum('xxhash', 3, xxhash_new),
+    Checksum('blake2b', 4, blake2b_new),
+    ], 'checksum_id', {'crc32c': ('crc32c', crc32c), 'xxhash': ('xxhash', xxhash)})
+
+checksums = registry.items
+checksum_available = registry.available
+
+
+def get_checksum(name):
+    """
+    Get a checksum algorithm by name.
+    """
+    return registry.get(name)
+
+
+def get_checksum_by_id(checksum_id):
+    """
+    Get the checksum algorithm of a trailer field.
+    """
+    return registry.get_by_id(checksum_id)
+
+
+def encode_field(checksum, digest):
+    """
+    The trailer field of a checksum: its id and the digest.
+    """
+    return bytes((checksum.checksum_id,)) + digest
+
+
+def decode_field(field):
+    """
+    The checksum algorithm and digest of a trailer field.
+    """
+    return get_checksum_by_id(field[0]), bytes(field[1:])
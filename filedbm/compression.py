@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Value compression codecs.
+
+zlib and lzma are always available. zstd and lz4 are used when the zstandard and lz4 packages are installed (the zstd and lz4 extras, e.g. pip install filedbm[zstd]). The codec of a compressed value is recorded in the trailer of its data block, so a database can hold a mix of codecs (and uncompressed values).
+"""
+import zlib
+import lzma
+import struct
+
+from .registry import Registry
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+############################################
+### Parameters
+
+## Codec id and uncompressed value length
+codec_struct = struct.Struct('<BQ')
+
+
+#######################################################
+### Classes
+
+
+class Codec:
+    """
+    A compression codec. compressobj(level) returns an object with compress(data) and flush() and decompress_chunks(file_obj, buffer_size) generates the decompressed data in chunks of at most buffer_size bytes.
+    """
+    def __init__(self, name: str, codec_id: int, compressobj, decompress_chunks):
+        self.name = name
+        self.codec_id = codec_id
+        self.compressobj = compressobj
+        self.decompress_chunks = decompress_chunks
+
+
+class Compressor:
+    """
+    The compression settings used for writing values.
+    """
+    def __init__(self, codec: str, level: int=None, min_size: int=256):
+        self.codec = get_codec(codec)
+        self.level = level
+        self.min_size = min_size
+
+    def compressobj(self):
+        return self.codec.compressobj(self.level)
+
+
+class LZ4Compressor:
+    """
+    Give the lz4 frame compressor the same compress/flush interface as the others.
+    """
+    def __init__(self, level=None):
+        self._c = lz4.frame.LZ4FrameCompressor(compression_level=0 if level is None else level)
+        self._started = False
+
+    def compress(self, data):
+        if self._started:
+            return self._c.compress(data)
+        else:
+            self._started = True
+            return self._c.begin() + self._c.compress(data)
+
+    def flush(self):
+        if self._started:
+            return self._c.flush()
+        else:
+            self._started = True
+            return self._c.begin() + self._c.flush()
+
+
+#######################################################
+### Functions
+
+
+def zlib_compressobj(level=None):
+    return zlib.compressobj(-1 if level is None else level)
+
+
+def zlib_decompress_chunks(file_obj, buffer_size):
+    d = zlib.decompressobj()
+    chunk = file_obj.read(buffer_size)
+    while chunk:
+        while chunk:
+            out = d.decompress(chunk, buffer_size)
+            if out:
+                yield out
+            chunk = d.unconsumed_tail
+        chunk = file_obj.read(buffer_size)
+
+    out = d.flush()
+    if out:
+        yield out
+
+
+def lzma_compressobj(level=None):
+    return lzma.LZMACompressor(preset=level)
+
+
+def bounded_decompress_chunks(d, file_obj, buffer_size):
+    """
+    For the decompressors with the needs_input/eof interface (lzma and lz4 frames).
+    """
+    while not d.eof:
+        if d.needs_input:
+            chunk = file_obj.read(buffer_size)
+            if not chunk:
+                raise EOFError('Compressed data ended before the end-of-stream marker was reached.')
+        else:
+            chunk = b''
+        out = d.decompress(chunk, buffer_size)
+        if out:
+            yield out
+
+
+def lzma_decompress_chunks(file_obj, buffer_size):
+    return bounded_decompress_chunks(lzma.LZMADecompressor(), file_obj, buffer_size)
+
+
+def zstd_compressobj(level=None):
+    return zstandard.ZstdCompressor(level=3 if level is None else level).compressobj()
+
+
+def zstd_decompress_chunks(file_obj, buffer_size):
+    with zstandard.ZstdDecompressor().stream_reader(file_obj, read_size=buffer_size, closefd=False) as reader:
+        out = reader.read(buffer_size)
+        while out:
+            yield out
+            out = reader.read(buffer_size)
+
+
+def lz4_decompress_chunks(file_obj, buffer_size):
+    return bounded_decompress_chunks(lz4.frame.LZ4FrameDecompressor(), file_obj, buffer_size)
+
+
+registry = Registry('compression', 'compression', [
+    Codec('zlib', 1, zlib_compressobj, zlib_decompress_chunks),
+    Codec('lzma', 2, lzma_compressobj, lzma_decompress_chunks),
+    Codec('zstd', 3, zstd_compressobj, zstd_decompress_chunks),
+    Codec('lz4', 4, LZ4Compressor, lz4_decompress_chunks),
+    ], 'codec_id', {'zstd': ('zstandard', zstandard), 'lz4': ('lz4', lz4)})
+
+codecs = registry.items
+codec_available = registry.available
+
+
+def get_codec(name):
+    """
+    Get a codec by name. 'auto' is zstd when the zstandard package is installed, otherwise zlib.
+    """
+    if name == 'auto':
+        name = 'zstd' if zstandard is not None else 'zlib'
+
+    return registry.get(name, ('auto',))
+
+
+def get_codec_by_id(codec_id):
+    """
+    Get the codec of a compressed value.
+    """
+    return registry.get_by_id(codec_id)
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Capacity-bounded eviction.
+
+A database opened with max_size and/or max_entries is kept under those bounds by evicting values after writes, according to a policy: 'lru' (least recently read or written), 'lfu' (least often read) or 'fifo' (oldest write). The sizes, counts and write times come from the manifest, which every process keeps up to date, so the totals are known without listing the directory.
+
+Reads are recorded in memory only and appended to the access log in .filedbm/access in batches (and on close), so tracking them doesn't cost a write per read. Every record holds the time of the last read and the number of reads since the previous record of that process; the log is folded into one record per key when it's compacted.
+
+Eviction is incremental: a write evicts at most evict_batch_size values. The victims are taken from a heap of the entries ordered by a lower bound of their score. Scores only go up (a read or a write makes a value more recent or more used), so the heap is updated lazily: an entry whose score has gone up since it was pushed is pushed again with its current score when it reaches the top, and only an entry whose score is still the pushed one is evicted. New entries (from any process) are pushed as the manifest reads them, and a write checks at most max_victim_checks heap entries, so its cost is bounded however many values have been read since.
+"""
+import os
+import io
+import heapq
+import struct
+from threading import Lock
+from time import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from . import utils
+
+############################################
+### Parameters
+
+access_file_name = 'access'
+
+policies = ('lru', 'lfu', 'fifo')
+
+## key hash, time of the last read, number of reads
+record_struct = struct.Struct('<{}sdI'.format(utils.key_hash_len))
+
+## Reads are appended to the access log once this many keys have pending reads
+flush_size = 1000
+
+## The log is compacted when it holds more than this many records per live entry (plus the minimum below)
+compact_ratio = 2
+compact_min_records = 10000
+
+## The max number of values evicted by a single write
+evict_batch_size = 16
+
+## The max number of heap entries looked at to find a victim
+max_victim_checks = 256
+
+
+#######################################################
+### Classes
+
+
+class AccessLog:
+    """
+    The merged access log (key hash -> (last read, reads)) plus the reads of this process that haven't been flushed yet.
+    """
+    def __init__(self, db_path):
+        self.path = db_path.joinpath(utils.sys_dir_name, access_file_name)
+        self._entries = {}
+        self._pending = {}
+        self._n_records = 0
+        self._offset = 0
+        self._ino = None
+        self._lock = Lock()
+
+    def touch(self, key_hash: str):
+        """
+        Record a read.
+        """
+        now = time()
+        with self._lock:
+            last, hits = self._pending.get(key_hash, (now, 0))
+            self._pending[key_hash] = (now, hits + 1)
+            n_pending = len(self._pending)
+        if n_pending >= flush_size:
+            self.flush()
+
+    def get(self, key_hash: str):
+        """
+        The time of the last read (or None) and the number of reads of a key.
+        """
+        last, hits = self._entries.get(key_hash, (None, 0))
+        pending = self._pending.get(key_hash)
+        if pending is not None:
+            last = pending[0]
+            hits += pending[1]
+
+        return last, hits
+
+    def flush(self):
+        """
+        Append the pending reads to the log with a single write and read them back (with those of other processes).
+        """
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+        if pending:
+            data = b''.join(record_struct.pack(bytes.fromhex(key_hash), last, hits) for key_hash, (last, hits) in pending.items())
+            try:
+                fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+            except PermissionError:
+                ## A reader without write access to the database can't record its reads
+                fd = None
+            if fd is not None:
+                try:
+                    fd = utils.append_log(self.path, data, fd)
+                finally:
+                    os.close(fd)
+        self.refresh()
+
+    def refresh(self):
+        """
+        Read the records added since the last refresh (or the whole log if it has been compacted).
+        """
+        with self._lock:
+            try:
+                stat = os.stat(self.path)
+            except FileNotFoundError:
+                return
+
+            if stat.st_ino != self._ino:
+                self._entries = {}
+                self._n_records = 0
+                self._offset = 0
+                self._ino = stat.st_ino
+
+            if stat.st_size > self._offset:
+                with io.open(self.path, 'rb') as f:
+                    f.seek(self._offset)
+                    data = f.read(stat.st_size - self._offset)
+                n = len(data) // record_struct.size
+                for key_hash, last, hits in record_struct.iter_unpack(data[:n*record_struct.size]):
+                    key_hash = key_hash.hex()
+                    old = self._entries.get(key_hash)
+                    if old is not None:
+                        last = max(last, old[0])
+                        hits += old[1]
+                    self._entries[key_hash] = (last, hits)
+                self._n_records += n
+                self._offset += n*record_struct.size
+
+    def needs_compaction(self, n_live):
+        return self._n_records > compact_ratio*n_live + compact_min_records
+
+    def compact(self, live_hashes):
+        """
+        Rewrite the log with one record per key that is still in the database, if it has grown enough. The log is read and replaced while appends are locked out (see utils.locked_log), so no record is lost; without fcntl that isn't possible and the log isn't compacted.
+        """
+        if fcntl is None or not self.needs_compaction(len(live_hashes)):
+            return
+
+        with utils.locked_log(self.path):
+            self.refresh()
+            entries = self._entries
+            tmp_path = self.path.with_name(self.path.name + '.' + os.urandom(6).hex() + '.tmp')
+            with io.open(tmp_path, 'wb') as f:
+                f.write(b''.join(record_struct.pack(bytes.fromhex(key_hash), last, hits) for key_hash, (last, hits) in entries.items() if key_hash in live_hashes))
+            os.replace(tmp_path, self.path)
+        self.refresh()
+
+    def clear(self):
+        with self._lock:
+            self._pending = {}
+            try:
+                self.path.unlink()
+            except FileNotFoundError:
+                pass
+
+    def after_fork(self):
+        self._lock = Lock()
+        self._pending = {}
+
+
+class Evictor:
+    """
+    Picks the values to evict from the manifest entries (key hash -> (key, size, mtime in ns, expiry)) according to the policy. The fifo policy doesn't need the access log, so access is None.
+    """
+    def __init__(self, manifest, access, policy: str='lru', max_size: int=None, max_entries: int=None):
+        if policy not in policies:
+            raise ValueError('eviction must be one of ' + str(policies) + '.')
+        self.manifest = manifest
+        self.access = access
+        self.policy = policy
+        self.max_size = max_size
+        self.max_entries = max_entries
+        self._heap = None
+        self._in_heap = set()
+        self._lock = Lock()
+        manifest.listener = self._push
+
+    def score(self, key_hash, entry):
+        """
+        The eviction order of an entry: the lowest is evicted first.
+        """
+        if self.policy == 'fifo':
+            return entry[2]
+        last, hits = self.access.get(key_hash)
+        written = entry[2]/1e9
+        if self.policy == 'lru':
+            return written if last is None else max(written, last)
+        else:
+            return (hits, written if last is None else max(written, last))
+
+    def lower_bound(self, entry):
+        """
+        The score of an entry that has never been read, which no score of it can be lower than.
+        """
+        if self.policy == 'fifo':
+            return entry[2]
+        elif self.policy == 'lru':
+            return entry[2]/1e9
+        else:
+            return (0, entry[2]/1e9)
+
+    def build(self):
+        """
+        Build the heap from the manifest entries. Done when a writer opens the database, so that no write has to.
+        """
+        entries = self.manifest.entries()
+        with self._lock:
+            heap = [(self.lower_bound(entry), key_hash) for key_hash, entry in list(entries.items())]
+            heapq.heapify(heap)
+            self._heap = heap
+            self._in_heap = set(key_hash for _, key_hash in heap)
+
+    def _push(self, key_hash, entry):
+        """
+        Called by the manifest for every entry it reads. A key that is already in the heap keeps its entry, as its old score is still a lower bound.
+        """
+        with self._lock:
+            if self._heap is not None and key_hash not in self._in_heap:
+                self._in_heap.add(key_hash)
+                heapq.heappush(self._heap, (self.lower_bound(entry), key_hash))
+
+    def over_capacity(self):
+        if self.max_entries is not None and len(self.manifest) > self.max_entries:
+            return True
+        if self.max_size is not None and self.manifest.total_size > self.max_size:
+            return True
+
+        return False
+
+    def next_victim(self):
+        """
+        The key hash and key of the next value to evict, or None if there's nothing left to evict or none was found within max_victim_checks heap entries (the next call continues).
+        """
+        if self._heap is None:
+            self.build()
+        if self.access is not None:
+            self.access.refresh()
+        ## The manifest calls _push while reading, so it's read before taking the lock
+        entries = self.manifest.entries()
+        with self._lock:
+            heap = self._heap
+            for _ in range(max_victim_checks):
+                if not heap:
+                    return None
+                pushed_score, key_hash = heap[0]
+                entry = entries.get(key_hash)
+                if entry is None:
+                    heapq.heappop(heap)
+                    self._in_heap.discard(key_hash)
+                    continue
+                score = self.score(key_hash, entry)
+                if score > pushed_score:
+                    heapq.heapreplace(heap, (score, key_hash))
+                    continue
+                heapq.heappop(heap)
+                self._in_heap.discard(key_hash)
+                return key_hash, entry[0]
+
+        return None
+
+    def maintain(self):
+        """
+        Append this process's reads to the access log and compact it if it has grown enough. Called after evicting, so the work is spread over the writes.
+        """
+        if self.access is not None:
+            self.access.flush()
+            entries = self.manifest.entries()
+            if self.access.needs_compaction(len(entries)):
+                self.access.compact(entries)
+
+    def after_fork(self):
+        self._lock = Lock()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Time-bucketed expiry index.
+
+Every write of a value that can expire appends its key hash to the bucket file of its expiry time in .filedbm/expiry. Expiring then only needs to look at the buckets that are due (the past ones and the one now falls in) instead of checking every file in the database.
+"""
+import os
+import io
+
+from . import utils
+
+############################################
+### Parameters
+
+expiry_dir_name = 'expiry'
+
+## The width of each expiry bucket in seconds
+bucket_size = 60
+
+
+#######################################################
+### Classes
+
+
+class ExpiryIndex:
+    """
+    The bucket files are append-only lists of key hashes (one per line), named by the bucket number (expiry // bucket_size). A bucket may list hashes that have since been overwritten with a later expiry or deleted, so entries are always checked against the data file before anything is removed.
+    """
+    def __init__(self, db_path):
+        self.path = db_path.joinpath(utils.sys_dir_name, expiry_dir_name)
+
+    def add(self, key_hash: str, expiry: float):
+        """
+        Add a key hash to the bucket of its expiry time.
+        """
+        bucket_path = self.path.joinpath(str(self.bucket_of(expiry)))
+        line = (key_hash + '\n').encode()
+        try:
+            fd = utils.append_log(bucket_path, line)
+        except FileNotFoundError:
+            self.path.mkdir(parents=True, exist_ok=True)
+            fd = utils.append_log(bucket_path, line)
+        os.close(fd)
+
+    def bucket_of(self, t: float):
+        """
+        The number of the bucket that a time falls in.
+        """
+        return int(t // bucket_size)
+
+    def due_buckets(self, now: float, current: bool=False):
+        """
+        The bucket numbers whose whole time range has passed, oldest first. With current=True the bucket that now falls in is included too.
+        """
+        try:
+            names = os.listdir(self.path)
+        except FileNotFoundError:
+            return []
+
+        max_bucket = now // bucket_size + (1 if current else 0)
+        buckets = [int(name) for name in names if name.isdigit() and int(name) < max_bucket]
+        buckets.sort()
+
+        return buckets
+
+    def read_bucket(self, bucket: int):
+        """
+        The key hashes listed in a bucket, in the order they were added.
+        """
+        try:
+            with io.open(self.path.joinpath(str(bucket)), 'r') as f:
+                return [line for line in f.read().split('\n') if len(line) == utils.key_hash_len*2]
+        except FileNotFoundError:
+            return []
+
+    def update_bucket(self, bucket: int, read_hashes, key_hashes):
+        """
+        Replace the hashes of a bucket that were read (read_hashes, see read_bucket) with the ones that still need to be processed (key_hashes), keeping the hashes added since it was read, or remove the bucket if none are left. The bucket is locked while it's rewritten so that no concurrent add is lost (see utils.locked_log). A bucket that another process has rewritten in the meantime is left as it is; its hashes are checked again later.
+        """
+        bucket_path = self.path.joinpath(str(bucket))
+        try:
+            with utils.locked_log(bucket_path):
+                current = self.read_bucket(bucket)
+                if current[:len(read_hashes)] == list(read_hashes):
+                    key_hashes = list(key_hashes) + current[len(read_hashes):]
+                elif current:
+                    return
+                else:
+                    key_hashes = []
+
+                if key_hashes:
+                    tmp_path = self.path.joinpath(str(bucket) + '.' + os.urandom(6).hex() + '.tmp')
+                    with io.open(tmp_path, 'w') as f:
+                        f.write(''.join(key_hash + '\n' for key_hash in key_hashes))
+                    os.replace(tmp_path, bucket_path)
+                else:
+                    bucket_path.unlink()
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        try:
+            names = os.listdir(self.path)
+        except FileNotFoundError:
+            return
+        for name in names:
+            try:
+                os.unlink(self.path.joinpath(name))
+            except FileNotFoundError:
+                pass
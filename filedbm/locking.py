@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Inter-process locking for writers.
+
+Readers never lock: values are replaced with atomic renames, so a reader always sees a complete old or new value. Writers take two kinds of fcntl locks in the .filedbm folder:
+
+- A shared flock on the lock file for the duration of each write (or delete). Operations that replace the whole database (clear and opening with flag='n') take it exclusively, so they wait for the writes in progress and block new ones.
+- A byte-range lock on the key lock file for the key being written, so read-modify-write sequences on a key (e.g. moving it between a segment and a file or releasing a deduplicated blob) aren't interleaved between processes. Keys are striped over key_lock_slots ranges, so writers of different keys rarely wait on each other.
+
+Byte-range (fcntl.lockf) locks belong to the process, and closing any descriptor of the file releases all of them. So the FileDBM instances of a process that have the same database open share one KeyLocks (one descriptor, reference counted) and exclude each other with its per-slot thread locks.
+"""
+import os
+import shutil
+from contextlib import contextmanager
+from threading import Lock, Condition
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from . import utils
+
+############################################
+### Parameters
+
+lock_file_name = 'lock'
+key_lock_file_name = 'keylocks'
+
+key_lock_slots = 4096
+
+## The KeyLocks of the key lock files open in this process, by real path
+_key_locks = {}
+_key_locks_lock = Lock()
+
+
+#######################################################
+### Classes
+
+
+class KeyLocks:
+    """
+    The key lock file of a database, shared by the instances of a process (see open_key_locks). The threads are coordinated with per-slot thread locks on top of the fcntl locks.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+        self.n_users = 0
+        self._pid = os.getpid()
+        self._slot_locks = {}
+        self._slot_locks_lock = Lock()
+
+    def _slot_lock(self, slot):
+        with self._slot_locks_lock:
+            lock = self._slot_locks.get(slot)
+            if lock is None:
+                lock = self._slot_locks[slot] = Lock()
+
+        return lock
+
+    @contextmanager
+    def hold(self, slot: int):
+        with self._slot_lock(slot):
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, 1, slot)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, slot)
+
+    def after_fork(self):
+        """
+        The thread locks may have been held by other threads of the parent. The descriptor is kept: the child doesn't inherit the parent's fcntl locks, and closing it in the child doesn't release them.
+        """
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._slot_locks = {}
+            self._slot_locks_lock = Lock()
+
+
+class ProcessLock:
+    """
+    The database lock and the key locks of a database. fcntl locks are held per process, so the threads of a process are coordinated with a condition (database lock) and per-slot thread locks (key locks) on top.
+    """
+    def __init__(self, db_path):
+        if fcntl is None:
+            raise NotImplementedError('Locking needs fcntl, which is not available on this platform.')
+        self.path = db_path.joinpath(utils.sys_dir_name, lock_file_name)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._open()
+        self._keys = open_key_locks(self.path.with_name(key_lock_file_name))
+
+    def _open(self):
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+        self._cond = Condition(Lock())
+        self._shared = 0
+        self._exclusive = False
+
+    @contextmanager
+    def shared(self):
+        """
+        Hold the database lock shared (e.g. for a write). Reentrant within a process.
+        """
+        with self._cond:
+            while self._exclusive:
+                self._cond.wait()
+            if self._shared == 0:
+                fcntl.flock(self._fd, fcntl.LOCK_SH)
+            self._shared += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._shared -= 1
+                if self._shared == 0:
+                    fcntl.flock(self._fd, fcntl.LOCK_UN)
+                    self._cond.notify_all()
+
+    @contextmanager
+    def exclusive(self):
+        """
+        Hold the database lock exclusively. Waits until no other thread or process is writing.
+        """
+        with self._cond:
+            while self._shared or self._exclusive:
+                self._cond.wait()
+            self._exclusive = True
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        finally:
+            with self._cond:
+                self._exclusive = False
+                self._cond.notify_all()
+
+    def key(self, key_hash: str):
+        """
+        Hold the write lock of a key (by its hash). Only one key lock may be held at a time by a thread, which rules out deadlocks between processes.
+        """
+        return self._keys.hold(int(key_hash[:8], 16) % key_lock_slots)
+
+    @contextmanager
+    def write(self, key_hash: str):
+        """
+        The locks for writing a key: the database lock shared and the key's lock.
+        """
+        with self.shared(), self.key(key_hash):
+            yield
+
+    def after_fork(self):
+        """
+        Give a forked child its own lock file description. flocks are shared with the parent through inherited file descriptors, so releasing one in the child would release the parent's lock.
+        """
+        os.close(self._fd)
+        self._open()
+        self._keys.after_fork()
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+            close_key_locks(self._keys)
+
+
+#######################################################
+### Functions
+
+
+def open_key_locks(path):
+    """
+    Get the KeyLocks of a key lock file, opening it if no other instance of the process has it open.
+    """
+    real_path = os.path.realpath(path)
+    with _key_locks_lock:
+        key_locks = _key_locks.get(real_path)
+        if key_locks is None:
+            key_locks = _key_locks[real_path] = KeyLocks(real_path)
+        key_locks.n_users += 1
+
+    return key_locks
+
+
+def close_key_locks(key_locks):
+    """
+    Release a KeyLocks from open_key_locks. The file is closed when its last user releases it.
+    """
+    with _key_locks_lock:
+        key_locks.n_users -= 1
+        if key_locks.n_users == 0:
+            del _key_locks[key_locks.path]
+            os.close(key_locks.fd)
+
+
+def remove_database_contents(db_path):
+    """
+    Remove everything in a database folder except the lock files (which other processes may be waiting on).
+    """
+    keep = {lock_file_name, key_lock_file_name}
+    for path in db_path.iterdir():
+        if path.name == utils.sys_dir_name:
+            for sys_path in path.iterdir():
+                if sys_path.name not in keep:
+                    if sys_path.is_dir() and not sys_path.is_symlink():
+                        shutil.rmtree(sys_path, ignore_errors=True)
+                    else:
+                        sys_path.unlink()
+        elif path.is_dir() and not path.is_symlink():
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            path.unlink()
+
+
+def _after_fork_in_child():
+    global _key_locks_lock
+    _key_locks_lock = Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
@@ -7,24 +7,133 @@ import os
 import io
 import pathlib
 from collections.abc import Mapping, MutableMapping
-from typing import Any, Generic, Iterator, Union, Dict, List
+from typing import Any, Generic, Iterator, Union, Dict, List, Iterable, Tuple
 import shutil
-from time import time
+import weakref
+from contextlib import nullcontext
+from time import time, perf_counter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from itertools import repeat
+from collections import deque
+from threading import Lock, Thread, Event
 # from hashlib import blake2b
 
 # import utils
 from . import utils
+from .manifest import Manifest, rebuild_manifest
+from .expiry import ExpiryIndex
+from .compression import Compressor
+from .segments import SegmentStore
+from .serializers import get_serializer
+from .locking import ProcessLock, remove_database_contents
+from .metrics import Metrics
+from .bloom import BloomFilter, filter_exists as bloom_filter_exists, writer_check_interval as bloom_check_interval
+from . import checksums
+from .eviction import AccessLog, Evictor, evict_batch_size, policies as eviction_policies
+from . import packed
+from . import batch
+
+
+#######################################################
+### Parameters
+
+## The open databases, to reset their per-process state in forked children
+_open_dbs = weakref.WeakValueDictionary()
 
 
 #######################################################
 ### Classes
 
 
+class ValueWriter:
+    """
+    Stores a value written in chunks (see FileDBM.open_writer). While the value could still fit in a segment it's held in memory; beyond that it's written straight to a temporary data file with a DataBlockWriter, whose header gets the value length once the value is complete. Closing the writer commits the value atomically.
+    """
+    def __init__(self, db, key: str, ttl: int=None):
+        self._db = db
+        self._key = key
+        self._ttl = ttl
+        self._head = []
+        self._head_len = 0
+        self._block = None
+        self.closed = False
+        if not db._segment_max_value_size:
+            self._open_block()
+
+    def _open_block(self):
+        db = self._db
+        self._block = utils.DataBlockWriter(db.db_path, self._key.encode(), db._n_bytes_key, db._n_bytes_value, db._compressor, None, db._checksum)
+        for chunk in self._head:
+            self._block.write(chunk)
+        self._head = None
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('I/O operation on closed file.')
+        if self._block is None:
+            self._head.append(bytes(data))
+            self._head_len += len(data)
+            if self._head_len > self._db._segment_max_value_size:
+                self._open_block()
+            return len(data)
+
+        return self._block.write(data)
+
+    def writelines(self, chunks):
+        for chunk in chunks:
+            self.write(chunk)
+
+    def write_from(self, value):
+        """
+        Write everything read from a file object (in buffer_size chunks) or all the chunks of an iterable of bytes.
+        """
+        if hasattr(value, 'read'):
+            buffer_size = self._db._buffer_size
+            chunk = value.read(buffer_size)
+            while chunk:
+                self.write(chunk)
+                chunk = value.read(buffer_size)
+        else:
+            self.writelines(value)
+
+    def close(self):
+        """
+        Store the value.
+        """
+        if not self.closed:
+            self.closed = True
+            if self._block is None:
+                self._db._store(self._key, b''.join(self._head), self._ttl)
+            else:
+                self._db._store(self._key, self._block, self._ttl)
+
+    def abort(self):
+        """
+        Discard the value.
+        """
+        if not self.closed:
+            self.closed = True
+            if self._block is not None:
+                self._block.abort()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
 class FileDBM(MutableMapping):
     """
 
     """
-    def __init__(self, db_path: str, flag: str = "r", buffer_size: int=512000, n_bytes_key: int=2, n_bytes_value: int=4, ttl: int=None):
+    def __init__(self, db_path: str, flag: str = "r", buffer_size: int=512000, n_bytes_key: int=2, n_bytes_value: int=4, ttl: int=None, shard_depth: int=None, max_workers: int=None, durability: str='none', cache_size: int=0, cache_max_value_size: int=1048576, manifest: bool=None, sweep_interval: float=None, compression: str=None, compression_level: int=None, compression_min_size: int=256, segment_max_value_size: int=None, segment_size: int=67108864, dedup: bool=None, serializer: str=None, locking: bool=False, metrics: bool=False, bloom_fpr: float=None, max_size: int=None, max_entries: int=None, eviction: str=None, checksum: str=None, verify_checksums: bool=False):
         """
 
         """
@@ -44,122 +153,1604 @@ class FileDBM(MutableMapping):
             write = True
         elif flag == "n":  # Always create a new, empty database, open for reading and writing
             write = True
-            if fp_exists:
+            if fp_exists and not locking:
                 shutil.rmtree(fp, ignore_errors=True)
-            fp_exists = False
+                fp_exists = False
         else:
             raise ValueError("Invalid flag")
 
+        ## The arguments for reopening in another process (see __reduce__)
+        self._open_args = (db_path, 'w' if write else 'r', buffer_size, n_bytes_key, n_bytes_value, ttl, shard_depth, max_workers, durability, cache_size, cache_max_value_size, manifest, sweep_interval, compression, compression_level, compression_min_size, segment_max_value_size, segment_size, dedup, serializer, locking, metrics, bloom_fpr, max_size, max_entries, eviction, checksum, verify_checksums)
+
         self._write = write
         self._buffer_size = buffer_size
         self._n_bytes_key = n_bytes_key
         self._n_bytes_value = n_bytes_value
         self._ttl = ttl
+        self._max_workers = max_workers
+        utils.check_durability(durability)
+        self._durability = durability
+        self._committer = utils.GroupCommitter() if durability == 'group' else None
+        self._compressor = Compressor(compression, compression_level, compression_min_size) if compression else None
+        self._checksum = checksums.get_checksum(checksum) if checksum else None
+        self._verify_checksums = verify_checksums
+        self._serializer = get_serializer(serializer) if serializer else None
+        self._cache = utils.ValueCache(cache_size, min(cache_size, cache_max_value_size)) if cache_size else None
+        self._executor = None
+        self._executor_lock = Lock()
+        self._metrics = Metrics() if metrics else None
 
         ## Load or assign encodings and attributes
         if not fp_exists:
             fp.mkdir(parents=True)
 
+        self._lock = ProcessLock(fp) if (write and locking) else None
+        if flag == 'n' and fp_exists:
+            ## Wait for the writers of the old database instead of removing it under them
+            with self._lock.exclusive():
+                remove_database_contents(fp)
+            fp_exists = False
+
+        meta = utils.read_meta(fp)
+
+        if 'shard_depth' in meta:
+            if (shard_depth is not None) and (shard_depth != meta['shard_depth']):
+                raise ValueError('The database has a shard_depth of ' + str(meta['shard_depth']) + '. Use migrate_layout to change it.')
+        else:
+            if shard_depth is None:
+                shard_depth = 0
+            utils.check_shard_depth(shard_depth)
+            if shard_depth and fp_exists and next(utils.iter_data_paths(fp), None) is not None:
+                raise ValueError('The database has a flat layout. Use migrate_layout to change the shard_depth.')
+            if write:
+                meta['shard_depth'] = shard_depth
+                utils.write_meta(fp, meta)
+
         self.db_path = fp
+        self._load_layout(meta)
+
+        if write:
+            utils.remove_stale_tmp_files(fp)
+
+        ## Capacity
+        if write:
+            capacity = {'max_size': max_size, 'max_entries': max_entries, 'eviction': eviction}
+            changed = {name: value for name, value in capacity.items() if (value is not None) and (value != meta.get(name))}
+            if changed:
+                if changed.get('eviction', 'lru') not in eviction_policies:
+                    raise ValueError('eviction must be one of ' + str(eviction_policies) + '.')
+                meta = utils.read_meta(fp)
+                for name, value in changed.items():
+                    if value:
+                        meta[name] = value
+                    else:
+                        meta.pop(name, None)
+                utils.write_meta(fp, meta)
+
+        capacity = meta.get('max_size') or meta.get('max_entries')
+        if capacity:
+            ## The evictor gets the sizes, counts and write times from the manifest
+            if manifest is False:
+                raise ValueError('max_size and max_entries need the manifest.')
+            if not meta.get('manifest', False):
+                manifest = True
+
+        ## Manifest
+        if manifest is None:
+            manifest = meta.get('manifest', False)
+        elif manifest != meta.get('manifest', False):
+            if not write:
+                raise ValueError('The manifest can only be enabled or disabled when the database is open for writing.')
+            meta = utils.read_meta(fp)
+            meta['manifest'] = manifest
+            if manifest:
+                rebuild_manifest(fp, n_bytes_key, n_bytes_value, self._max_depth)
+                utils.write_meta(fp, meta)
+            else:
+                utils.write_meta(fp, meta)
+                try:
+                    fp.joinpath(utils.sys_dir_name, utils.manifest_file_name).unlink()
+                except FileNotFoundError:
+                    pass
+
+        self._manifest = Manifest(fp) if manifest else None
+
+        ## Segments
+        if write and (segment_max_value_size is not None) and (segment_max_value_size != meta.get('segment_max_value_size')):
+            meta = utils.read_meta(fp)
+            meta['segment_max_value_size'] = segment_max_value_size
+            utils.write_meta(fp, meta)
+
+        if 'segment_max_value_size' in meta:
+            self._segment_max_value_size = meta['segment_max_value_size']
+            self._segments = SegmentStore(fp, n_bytes_key, n_bytes_value, write, segment_size)
+        else:
+            self._segment_max_value_size = 0
+            self._segments = None
+
+        ## Deduplication
+        if write and (dedup is not None) and (dedup != meta.get('dedup')):
+            meta = utils.read_meta(fp)
+            meta['dedup'] = dedup
+            utils.write_meta(fp, meta)
+
+        self._dedup = meta.get('dedup', False)
+        ## Once enabled, deleted and overwritten values may refer to blobs even if dedup has been turned off since
+        self._has_blobs = 'dedup' in meta
+
+        ## Expiry
+        self._expiry_index = ExpiryIndex(fp)
+        self._expire_lock = Lock()
+        self._next_expire = time()
+        self._sweep_interval = sweep_interval
+        self._sweep_stop = None
+        if write and sweep_interval is not None:
+            self._sweep_stop = Event()
+            Thread(target=self._sweep, name='filedbm-sweeper', daemon=True).start()
+
+        ## Bloom filter
+        if write and (bloom_fpr is not None) and (bloom_fpr != meta.get('bloom_fpr')):
+            if not 0 <= bloom_fpr < 1:
+                raise ValueError('bloom_fpr must be a false-positive rate between 0 and 1 (or 0 to remove the filter).')
+            meta = utils.read_meta(fp)
+            if bloom_fpr:
+                meta['bloom_fpr'] = bloom_fpr
+            else:
+                meta.pop('bloom_fpr', None)
+                BloomFilter(fp, 1, True).remove()
+            utils.write_meta(fp, meta)
+            rebuild_bloom = bool(bloom_fpr)
+        else:
+            rebuild_bloom = False
+
+        if meta.get('bloom_fpr'):
+            self._bloom = BloomFilter(fp, meta['bloom_fpr'], write)
+            if write and (rebuild_bloom or not self._bloom.exists()):
+                self.rebuild_bloom()
+        else:
+            self._bloom = None
+        self._next_bloom_check = 0
+
+        ## Eviction
+        if capacity:
+            policy = meta.get('eviction', 'lru')
+            self._access = None if policy == 'fifo' else AccessLog(fp)
+            self._evictor = Evictor(self._manifest, self._access, policy, meta.get('max_size'), meta.get('max_entries'))
+            if write:
+                self._evictor.build()
+        else:
+            self._access = None
+            self._evictor = None
+        self._evict_lock = Lock()
+
+        self._pending = batch.PendingBatches(fp)
+        if write:
+            self._recover_batches()
+
+        _open_dbs[id(self)] = self
+
+
+    def _load_layout(self, meta):
+        """
+        Assign the directory layout from the metadata.
+        """
+        self._shard_depth = meta.get('shard_depth', 0)
+        self._prev_shard_depth = meta.get('prev_shard_depth')
+        self._max_depth = max(self._shard_depth, self._prev_shard_depth or 0)
+        self._meta_mtime = utils.meta_mtime(self.db_path)
+
+    def _refresh_layout(self):
+        """
+        Reload the layout if the metadata has been changed by another process (e.g. by an online migration). Returns True if the layout was reloaded.
+        """
+        if utils.meta_mtime(self.db_path) != self._meta_mtime:
+            old_layout = (self._shard_depth, self._prev_shard_depth)
+            self._load_layout(utils.read_meta(self.db_path))
+            return old_layout != (self._shard_depth, self._prev_shard_depth)
+        else:
+            return False
+
+    def _lookup_depths(self):
+        """
+        The shard depths to look for a key in. The previous layout is only checked during a migration and the metadata is only checked for changes once the known layouts have been exhausted.
+        """
+        yield self._shard_depth
+        if self._prev_shard_depth is not None:
+            yield self._prev_shard_depth
+        if self._refresh_layout():
+            yield self._shard_depth
+            if self._prev_shard_depth is not None:
+                yield self._prev_shard_depth
+
+    def _get_value(self, key: str):
+        if self._metrics is None:
+            value = self._read_value(key)
+        else:
+            start = perf_counter()
+            try:
+                value = self._read_value(key)
+            except Exception:
+                self._metrics.record('get', perf_counter() - start, error=True)
+                raise
+            if value is None:
+                self._metrics.record('get', perf_counter() - start, miss=True)
+            else:
+                self._metrics.record('get', perf_counter() - start, value.length)
+
+        ## Only kept in memory until the next flush of the access log
+        if self._access is not None and value is not None:
+            self._access.touch(utils.hash_key(key.encode()))
+
+        return value
+
+    def _read_value(self, key: str):
+        key_bytes = key.encode()
+        if self._bloom is not None and not self._bloom.might_contain(utils.hash_key(key_bytes)):
+            return None
+
+        value = self._read_stored_value(key, key_bytes)
+        ## Values in segments are never written by batches
+        check = value is None or (value.stat is not None and self._pending.is_recent(value.stat.st_mtime_ns))
+        pending = self._pending.get(key, check)
+        if pending is not None:
+            if value is not None:
+                value.close()
+            return self._read_pending_value(key, key_bytes, *pending)
+
+        return value
+
+    def _read_pending_value(self, key, key_bytes, batch_path, commit_ns, op):
+        """
+        Read a key of a committed batch that may not have been applied yet: the staged value (or nothing for a delete), unless the key has been written since the commit or the staged value has already been applied.
+        """
+        mtime_ns = self._stored_mtime_ns(utils.hash_key(key_bytes))
+        if mtime_ns is None or mtime_ns <= commit_ns:
+            if op[0] == 'delete':
+                return None
+            value = batch.read_staged_value(batch_path, op[1], self._n_bytes_key, self._n_bytes_value, self._ttl, self._buffer_size)
+            if value is not None:
+                return value
+
+        return self._read_stored_value(key, key_bytes)
+
+    def _stored_mtime_ns(self, key_hash):
+        """
+        The mtime in ns of the newest stored record of a key (a segment tombstone counts, a deleted data file doesn't), or None.
+        """
+        mtimes = []
+        if self._segments is not None:
+            self._segments.find(key_hash, False)
+            entry = self._segments.lookup_any(key_hash)
+            if entry is not None:
+                mtimes.append(entry[0])
+        for shard_depth in self._lookup_depths():
+            try:
+                mtimes.append(os.stat(utils.key_file_path(self.db_path, key_hash, shard_depth)).st_mtime_ns)
+            except FileNotFoundError:
+                pass
+
+        return max(mtimes, default=None)
+
+    def _read_stored_value(self, key, key_bytes):
+        if self._cache is not None:
+            value = self._cache.get(key, self._ttl)
+            if value is not None:
+                return value
+
+        if self._segments is not None:
+            value = self._get_segment_value(utils.hash_key(key_bytes))
+            if value is not None:
+                return value
+
+        for shard_depth in self._lookup_depths():
+            value = utils.get_value(self.db_path, key_bytes, self._n_bytes_key, self._n_bytes_value, self._ttl, shard_depth, self._buffer_size)
+            if value is not None:
+                if self._verify_checksums:
+                    ## Checked before it's cached, as the cache holds the decompressed value
+                    utils.verify_on_read(value)
+                if self._cache is not None and value.length <= self._cache.max_value_size:
+                    data = value.read()
+                    value.close()
+                    self._cache.put(key, value.f, value.stat, data, value.fields)
+                    value = utils.FileObjectReadSlice.from_buffer(data, value.f, value.stat, value.fields)
+                return value
+
+        return None
+
+    def _get_segment_value(self, key_hash):
+        """
+        Get a value stored in the segments. The value is read in a single pread, so it's returned as an in-memory FileObjectReadSlice.
+        """
+        found = self._segments.get_block(key_hash, False)
+        if found is None:
+            return None
+
+        entry, (key_bytes, value_pos, value_len, fields, block) = found
+        if utils.is_expired(entry[0]/1e9, fields, self._ttl):
+            return None
+
+        value = utils.FileObjectReadSlice.from_buffer(block[value_pos:value_pos + value_len], self._segments.segment_path(entry), None, fields)
+        value = utils.decompress_value(value, self._buffer_size)
+        if self._verify_checksums:
+            utils.verify_on_read(value)
+
+        return value
+
+    def compact_segments(self, min_dead_ratio: float=0.5):
+        """
+        Reclaim the space of overwritten and deleted values in the segments. Every segment with at least min_dead_ratio of dead bytes has its live values copied to the active segment and is then removed. This also runs in the background whenever a segment fills up. Returns the number of bytes reclaimed.
+        """
+        if self._segments is None:
+            return 0
+        if self._write:
+            return self._segments.compact(min_dead_ratio)
+        else:
+            raise ValueError('File is open for read only.')
+
+    def verify(self, quarantine: bool=False, processes: bool=False, max_workers: int=None):
+        """
+        Scrub the database: check every data file, blob and segment record for damage (truncation, a broken trailer, a key that doesn't match its file) and every value that has a checksum against it (see the checksum parameter of open). The files are checked in parallel, in chunks of utils.verify_chunk_size files, on the thread pool of the bulk methods or with processes=True on a pool of max_workers processes (for checksums that hold the GIL). The database stays usable while it runs. With quarantine=True the damaged files and records are moved to the quarantine folder in .filedbm and their keys are removed from the database; a damaged blob takes all the keys that refer to it. Returns a dict with the number of values checked, the number of those that couldn't be checked against a checksum ('unverified'), the list of the damaged ones ('corrupt', each a dict of path, key and problem) and the number quarantined.
+        """
+        if quarantine and not self._write:
+            raise ValueError('File is open for read only.')
+
+        paths = [(file_path, True) for file_path in utils.iter_data_paths(self.db_path, self._max_depth)]
+        paths.extend((file_path, False) for file_path in utils.iter_blob_paths(self.db_path))
+        if processes:
+            executor = ProcessPoolExecutor(max_workers)
+        else:
+            executor = self._get_executor()
+        try:
+            results = [result for chunk in executor.map(utils.verify_data_files, utils.chunks(paths, utils.verify_chunk_size), repeat(self._n_bytes_key), repeat(self._n_bytes_value), repeat(self._buffer_size)) for result in chunk]
+        finally:
+            if processes:
+                executor.shutdown()
+        n_files = len(results)
+
+        ## The segments are read in one go each, so their records are checked here
+        corrupt_records = []
+        if self._segments is not None:
+            for key_hash, entry, (_, _, _, _, block) in self._segments.iter_blocks():
+                key, status = utils.verify_segment_block(key_hash, block, self._n_bytes_key, self._n_bytes_value)
+                results.append((self._segments.segment_path(entry), key, status))
+                if status != 'ok' and status not in utils.unverified_statuses:
+                    corrupt_records.append((key_hash, entry, bytes(block)))
+
+        corrupt = [{'path': str(file_path), 'key': key, 'problem': status} for file_path, key, status in results if status != 'ok' and status not in utils.unverified_statuses]
+        n_quarantined = 0
+        if quarantine and corrupt:
+            quarantine_path = self.db_path.joinpath(utils.sys_dir_name, utils.quarantine_dir_name)
+            quarantine_path.mkdir(exist_ok=True)
+            blobs_path = self.db_path.joinpath(utils.sys_dir_name, utils.blobs_dir_name)
+            for file_path, key, status in results[:n_files]:
+                if status == 'ok' or status in utils.unverified_statuses:
+                    continue
+                if file_path.parent.parent == blobs_path:
+                    n_quarantined += self._quarantine_blob(file_path, quarantine_path)
+                else:
+                    n_quarantined += self._quarantine_file(file_path, quarantine_path)
+            for key_hash, entry, block in corrupt_records:
+                n_quarantined += self._quarantine_record(key_hash, entry, block, quarantine_path)
+            if self._cache is not None:
+                ## The keys of damaged files can't be trusted, so the cache is dropped as a whole
+                self._cache.clear()
+
+        return {'checked': len(results), 'unverified': sum(status in utils.unverified_statuses for _, _, status in results), 'corrupt': corrupt, 'quarantined': n_quarantined}
+
+    def _quarantine_file(self, file_path, quarantine_path):
+        """
+        Move a damaged data file to the quarantine folder and remove its key. Returns 1 if it was moved.
+        """
+        key_hash = file_path.name
+        with self._write_lock(key_hash):
+            content_hash = utils.read_blob_field(file_path, self._n_bytes_key, self._n_bytes_value)
+            new_path = quarantine_path.joinpath(key_hash + '.' + os.urandom(4).hex())
+            try:
+                os.replace(file_path, new_path)
+            except FileNotFoundError:
+                return 0
+            self._commit_unlink(file_path)
+            self._commit_unlink(new_path)
+            if content_hash is not None:
+                utils.release_blob(self.db_path, content_hash, key_hash, self._durability, self._committer)
+            self._forget(key_hash)
+
+        return 1
+
+    def _quarantine_blob(self, file_path, quarantine_path):
+        """
+        Move a damaged blob to the quarantine folder and remove the keys that refer to it. Returns 1 if it was moved.
+        """
+        content_hash = file_path.name
+        new_path = quarantine_path.joinpath(content_hash)
+        try:
+            os.replace(file_path, new_path)
+        except FileNotFoundError:
+            return 0
+        self._commit_unlink(file_path)
+        self._commit_unlink(new_path)
+
+        ## The keys' links to the blob are named <content hash>.<key hash>
+        key_hashes = [name.split('.', 1)[1] for name in os.listdir(file_path.parent) if name.startswith(content_hash + '.')]
+        for key_hash in key_hashes:
+            with self._write_lock(key_hash):
+                for shard_depth in self._lookup_depths():
+                    data_path = utils.key_file_path(self.db_path, key_hash, shard_depth)
+                    if utils.read_blob_field(data_path, self._n_bytes_key, self._n_bytes_value) != content_hash:
+                        ## Overwritten in the meantime
+                        continue
+                    try:
+                        self._unlink_data_file(data_path)
+                    except FileNotFoundError:
+                        continue
+                    self._forget(key_hash)
+
+        return 1
+
+    def _quarantine_record(self, key_hash, entry, block, quarantine_path):
+        """
+        Write a damaged segment record to the quarantine folder and add a tombstone for its key. Returns 1 if it was still the key's record.
+        """
+        with self._write_lock(key_hash):
+            tombstone = self._segments.delete(key_hash, entry)
+            if tombstone is None:
+                return 0
+            self._commit_segment(tombstone)
+            with io.open(quarantine_path.joinpath(key_hash + '.' + os.urandom(4).hex()), 'wb') as f:
+                f.write(block)
+            self._forget(key_hash)
+
+        return 1
+
+    def _forget(self, key_hash):
+        """
+        Remove a key that was taken out of the database by verify from the bloom filter and the manifest.
+        """
+        if self._bloom is not None:
+            self._bloom.discard(key_hash)
+        if self._manifest is not None:
+            self._manifest.remove(key_hash)
+
+    def cache_info(self):
+        """
+        The value cache counters (hits, misses, evictions) and current size in bytes and entries. Returns None if the cache is disabled.
+        """
+        if self._cache is not None:
+            return self._cache.info()
+
+    def stats(self, reset: bool=False):
+        """
+        The operation metrics: per operation (get, set, delete, contains, len, expire) the number of calls, errors and misses and a latency histogram (upper bounds in seconds), plus the bytes read and written, the number of expired values removed, the number of values evicted and the value cache counters. Returns None if metrics are disabled. With reset=True the counters are set back to zero after being read.
+        """
+        if self._metrics is None:
+            return None
+        stats = self._metrics.to_dict()
+        stats['cache'] = self.cache_info()
+        if reset:
+            self._metrics.reset()
+            if self._cache is not None:
+                self._cache.reset_counters()
+
+        return stats
+
+    def add_hook(self, hook):
+        """
+        Call hook(op, duration, n_bytes, error) after every operation, e.g. to export the metrics to Prometheus or to record OpenTelemetry spans. duration is in seconds and n_bytes is the size of the value read or written (0 for other operations). Exceptions raised by the hook are ignored. Enables the metrics if they aren't enabled yet.
+        """
+        if self._metrics is None:
+            self._metrics = Metrics()
+        self._metrics.add_hook(hook)
+
+    def remove_hook(self, hook):
+        if self._metrics is not None:
+            self._metrics.remove_hook(hook)
+
+    def migrate_layout(self, shard_depth: int):
+        """
+        Convert the database to another shard_depth layout. The database stays usable (also from other processes) while the files are moved. See utils.migrate_layout.
+        """
+        if self._write:
+            utils.migrate_layout(self.db_path, shard_depth)
+            self._load_layout(utils.read_meta(self.db_path))
+        else:
+            raise ValueError('File is open for read only.')
+
+
+    def _get_executor(self):
+        """
+        The thread pool for the bulk methods is only created when first needed.
+        """
+        if self._executor is None:
+            with self._executor_lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(self._max_workers, thread_name_prefix='filedbm')
+
+        return self._executor
+
+    def _map(self, func, *iterables):
+        """
+        Run func over the iterables on the thread pool. The results are returned in input order and an exception raised for an individual item is returned in its place rather than raised.
+        """
+        executor = self._get_executor()
+        futures = [executor.submit(func, *args) for args in zip(*iterables)]
+
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as err:
+                results.append(err)
+
+        return results
+
+    def _get_serializer(self, serializer=None):
+        if serializer is None:
+            return self._serializer
+        else:
+            return get_serializer(serializer)
+
+    def _load(self, value, serializer=None):
+        """
+        Deserialize a value with the given serializer or the database's one. Without either the FileObjectReadSlice is returned.
+        """
+        serializer = self._get_serializer(serializer)
+        if serializer is None:
+            return value
+        else:
+            return serializer.loads(value)
+
+    def _get_prefetched(self, key: str, serializer=None):
+        value = self._get_value(key)
+        if value is not None:
+            value.prefetch()
+            value = self._load(value, serializer)
+
+        return value
+
+    def get_many(self, keys: Iterable[str], default=None, serializer=None):
+        """
+        Get the values of many keys in parallel on the thread pool. Small values are read into memory (and deserialized) on the worker threads. Returns a list in the same order as keys: missing keys get the default and keys that failed get the exception that was raised.
+        """
+        return [default if value is None else value for value in self._map(self._get_prefetched, keys, repeat(serializer))]
+
+    def contains_many(self, keys: Iterable[str]):
+        """
+        Check whether many keys are in the database in parallel. Returns a list of bools (or exceptions) in the same order as keys.
+        """
+        return self._map(self._contains, keys)
+
+    def set_many(self, key_values: Union[Dict[str, Union[bytes, io.IOBase]], Iterable[Tuple[str, Union[bytes, io.IOBase]]]]):
+        """
+        Write many key/value pairs in parallel on the thread pool. key_values can be a dict or an iterable of (key, value) tuples. A value can also be a path (os.PathLike), whose file is copied by the kernel. Returns a list in input order with None for each successful write and the exception for each failed one.
+        """
+        if self._write:
+            if isinstance(key_values, Mapping):
+                key_values = key_values.items()
+            key_values = list(key_values)
+
+            return self._map(self._set, [key for key, value in key_values], [value for key, value in key_values])
+        else:
+            raise ValueError('File is open for read only.')
+
+    def delete_many(self, keys: Iterable[str]):
+        """
+        Delete many keys in parallel. Returns a list in input order with None for each deleted key and the exception (e.g. KeyError) for each failed one.
+        """
+        if self._write:
+            return self._map(self._delete, keys)
+        else:
+            raise ValueError('File is open for read only.')
+
+    def _manifest_entries(self):
+        """
+        The manifest entries that haven't expired.
+        """
+        entries = list(self._manifest.entries().values())
+        now = time()
+        min_mtime = None if self._ttl is None else (now - self._ttl)*1e9
+        entries = [entry for entry in entries if not utils.is_entry_expired(entry, now, min_mtime)]
+
+        return entries
+
+    def _range_keys(self, prefix=None, start=None, stop=None, reverse=False):
+        """
+        Iterate in sorted order over the keys with start <= key < stop that begin with prefix. With the manifest its sorted keys are used, so the cost depends on the number of keys returned rather than the size of the database; otherwise all keys are listed and sorted.
+        """
+        if prefix is not None:
+            if start is None or start < prefix:
+                start = prefix
+            prefix_stop = utils.prefix_stop(prefix)
+            if prefix_stop is not None and (stop is None or stop > prefix_stop):
+                stop = prefix_stop
+
+        if self._manifest is not None:
+            sorted_keys = self._manifest.sorted_keys()
+            entries = self._manifest.entries()
+            now = time()
+            min_mtime = None if self._ttl is None else (now - self._ttl)*1e9
+            for key in sorted_keys.irange(start, stop, reverse):
+                entry = entries.get(utils.hash_key(key.encode()))
+                if entry is None or entry[0] != key or utils.is_entry_expired(entry, now, min_mtime):
+                    continue
+                yield key
+        else:
+            keys = sorted(key for key in self._iter_keys_values(True, False) if (start is None or key >= start) and (stop is None or key < stop))
+            if reverse:
+                keys.reverse()
+            yield from keys
+
+    def _iter_range_values(self, keys):
+        """
+        Get the values of keys from _range_keys in parallel, skipping keys that have been deleted in the meantime.
+        """
+        for keys_chunk in utils.chunks(keys, utils.bulk_chunk_size):
+            for key, value in zip(keys_chunk, self.get_many(keys_chunk)):
+                if isinstance(value, Exception):
+                    raise value
+                if value is not None:
+                    yield key, value
+
+    def freeze(self, file_path: str):
+        """
+        Pack the database into a single read-only file for distribution, e.g. to many nodes: copying and opening one file is much faster than a folder of many small files. The data blocks are copied as stored (compressed values stay compressed, deduplicated values are written in full) in key order, followed by a hash table for O(1) lookups. Open the file with filedbm.open to serve it from a shared memory map, or write it back into a folder with filedbm.thaw. Expired values are left out. Returns the number of keys packed.
+        """
+        return packed.freeze(self.db_path, file_path, self._n_bytes_key, self._n_bytes_value, self._ttl, self._max_depth)
+
+    def _iter_key_hashes(self):
+        """
+        The key hashes of all the stored values, from the segment index and the data file names (no files are opened).
+        """
+        live = {}
+        if self._segments is not None:
+            live = self._segments.live_entries()
+            yield from live
+        for entry in utils.iter_data_entries(self.db_path, self._max_depth):
+            if entry.name not in live:
+                yield entry.name
+
+    def _open_bloom(self):
+        """
+        Open the Bloom filter that another process has enabled since this one opened the database.
+        """
+        fpr = utils.read_meta(self.db_path).get('bloom_fpr')
+        if fpr:
+            self._bloom = BloomFilter(self.db_path, fpr, self._write)
+
+    def rebuild_bloom(self):
+        """
+        Rebuild the Bloom filter from the data files, sized for twice the current number of keys. This clears the positions of deleted keys. It's rebuilt automatically once it's too full for its false-positive rate. With locking, writers in other processes wait until it's done.
+        """
+        if self._bloom is None:
+            raise ValueError('The database has no Bloom filter. Open it with bloom_fpr to create one.')
+        if not self._write:
+            raise ValueError('File is open for read only.')
+
+        with (nullcontext() if self._lock is None else self._lock.exclusive()):
+            self._bloom.build(self._iter_key_hashes)
+
+    def rebuild_manifest(self):
+        """
+        Regenerate the manifest from the data files. Use it to repair the manifest after a crash or after data files were changed without going through FileDBM. Also compacts the manifest log.
+        """
+        if self._manifest is None:
+            raise ValueError('The database has no manifest. Open it with manifest=True to create one.')
+        if self._write:
+            rebuild_manifest(self.db_path, self._n_bytes_key, self._n_bytes_value, self._max_depth)
+        else:
+            raise ValueError('File is open for read only.')
+
+    def _iter_segment_items(self, entries):
+        """
+        Generate the keys and values stored in the segments (reading each segment in one go).
+        """
+        now = time()
+        for key_hash, entry, (key_bytes, value_pos, value_len, fields, block) in self._segments.iter_blocks(entries):
+            if utils.is_expired(entry[0]/1e9, fields, self._ttl, now):
+                continue
+            value = utils.FileObjectReadSlice.from_buffer(bytes(block[value_pos:value_pos + value_len]), self._segments.segment_path(entry), None, fields)
+
+            yield key_bytes.decode(), utils.decompress_value(value, self._buffer_size)
+
+    def _read_data_files(self, file_paths, key, value):
+        """
+        Read the keys and/or (deserialized) values of a chunk of data files. Used by the worker threads when prefetching.
+        """
+        items = []
+        for file_path in file_paths:
+            try:
+                item = utils.get_data_block(file_path, key, value, self._n_bytes_key, self._n_bytes_value, self._ttl, self._buffer_size, self.db_path)
+            except FileNotFoundError:
+                ## Removed by someone else since the directory was listed
+                continue
+            if item is None:
+                continue
+
+            if key and value:
+                item[1].prefetch()
+                item = (item[0], self._load(item[1]))
+            elif value:
+                item.prefetch()
+                item = self._load(item)
+            items.append(item)
 
+        return items
 
-    def keys(self):
-        for key in utils.iter_keys_values(self.db_path, True, False, self._n_bytes_key, self._n_bytes_value, self._ttl):
+    def _iter_keys_values(self, key, value, prefetch=0):
+        """
+        Iterate over the values in the segments and then over the data files (skipping files of keys that have since been written to a segment). Values are deserialized. With prefetch > 0 the data files are read in chunks on the thread pool, keeping up to prefetch files ahead of the consumer.
+        """
+        skip = None
+        if self._segments is not None:
+            skip = self._segments.live_entries()
+            for segment_key, segment_value in self._iter_segment_items(skip):
+                if key and value:
+                    yield segment_key, self._load(segment_value)
+                elif key:
+                    yield segment_key
+                else:
+                    yield self._load(segment_value)
+
+        if not prefetch:
+            for item in utils.iter_keys_values(self.db_path, key, value, self._n_bytes_key, self._n_bytes_value, self._ttl, self._max_depth, self._buffer_size, skip):
+                if key and value:
+                    yield item[0], self._load(item[1])
+                elif value:
+                    yield self._load(item)
+                else:
+                    yield item
+            return
+
+        file_paths = utils.iter_data_paths(self.db_path, self._max_depth)
+        if skip is not None:
+            file_paths = (file_path for file_path in file_paths if file_path.name not in skip)
+
+        chunk_size = min(prefetch, utils.prefetch_chunk_size)
+        max_pending = -(-prefetch // chunk_size)
+        executor = self._get_executor()
+        pending = deque()
+        try:
+            for file_paths_chunk in utils.chunks(file_paths, chunk_size):
+                pending.append(executor.submit(self._read_data_files, file_paths_chunk, key, value))
+                if len(pending) > max_pending:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+        finally:
+            ## The consumer stopped early
+            for future in pending:
+                future.cancel()
+
+    def keys(self, prefix: str=None, start: str=None, stop: str=None, reverse: bool=False):
+        """
+        Iterate over the keys. Given a prefix, start (inclusive) or stop (exclusive), or with reverse=True, only the keys in that range are returned, in sorted (or reverse sorted) order. Range queries use the sorted keys of the manifest, so they only cost as much as the keys returned when the database has a manifest; without it every key is listed.
+        """
+        if prefix is not None or start is not None or stop is not None or reverse:
+            yield from self._range_keys(prefix, start, stop, reverse)
+            return
+
+        if self._manifest is not None:
+            for key, size, mtime, expiry in self._manifest_entries():
+                yield key
+            return
+
+        for key in self._iter_keys_values(True, False):
             yield key
 
-    def items(self, keys: List[str]=None):
-        if keys is None:
-            for key, value in utils.iter_keys_values(self.db_path, True, True, self._n_bytes_key, self._n_bytes_value, self._ttl):
+    def items(self, keys: List[str]=None, prefetch: int=0, prefix: str=None, start: str=None, stop: str=None, reverse: bool=False):
+        """
+        Iterate over the keys and values. With prefetch > 0, up to that many data files are read ahead (in chunks) on the thread pool while the items are consumed, so a full scan isn't limited by the latency of reading one file at a time. When keys are given they are always read in parallel with get_many. prefix, start, stop and reverse select a sorted range of keys as in keys(), and the values are read in parallel too.
+        """
+        if prefix is not None or start is not None or stop is not None or reverse:
+            yield from self._iter_range_values(self._range_keys(prefix, start, stop, reverse))
+        elif keys is None:
+            for key, value in self._iter_keys_values(True, True, prefetch):
                 yield key, value
         else:
-            for key in keys:
-                value = utils.get_value(self.db_path, key.encode(), self._n_bytes_key, self._n_bytes_value, self._ttl)
-                yield key, value
+            for keys_chunk in utils.chunks(keys, utils.bulk_chunk_size):
+                for key, value in zip(keys_chunk, self.get_many(keys_chunk)):
+                    if isinstance(value, Exception):
+                        raise value
+                    yield key, value
 
-    def values(self, keys: List[str]=None):
-        if keys is None:
-            for value in utils.iter_keys_values(self.db_path, False, True, self._n_bytes_key, self._n_bytes_value, self._ttl):
+    def values(self, keys: List[str]=None, prefetch: int=0, prefix: str=None, start: str=None, stop: str=None, reverse: bool=False):
+        """
+        Iterate over the values. See items for prefetch and the key range parameters.
+        """
+        if prefix is not None or start is not None or stop is not None or reverse:
+            for key, value in self._iter_range_values(self._range_keys(prefix, start, stop, reverse)):
                 yield value
-        else:
-            for key in keys:
-                value = utils.get_value(self.db_path, key.encode(), self._n_bytes_key, self._n_bytes_value, self._ttl)
+        elif keys is None:
+            for value in self._iter_keys_values(False, True, prefetch):
                 yield value
+        else:
+            for keys_chunk in utils.chunks(keys, utils.bulk_chunk_size):
+                for value in self.get_many(keys_chunk):
+                    if isinstance(value, Exception):
+                        raise value
+                    yield value
 
     def __iter__(self):
         return self.keys()
 
     def __len__(self):
+        if self._metrics is None:
+            return self._count()
+
+        start = perf_counter()
+        try:
+            count = self._count()
+        except Exception:
+            self._metrics.record('len', perf_counter() - start, error=True)
+            raise
+        self._metrics.record('len', perf_counter() - start)
+
+        return count
+
+    def _count(self):
+        if self._manifest is not None:
+            return len(self._manifest_entries())
+
         count = 0
 
-        for file_path in self.db_path.iterdir():
-            if file_path.is_file():
-                if self._ttl is not None:
-                    if (time() - os.path.getmtime(file_path)) > self._ttl:
-                        file_path.unlink()
+        ## The listing only checks the database ttl (against the mtimes)
+        now = time()
+        skip = {}
+        if self._segments is not None:
+            skip = self._segments.live_entries()
+            for entry in skip.values():
+                if self._ttl is None or (now - entry[0]/1e9) <= self._ttl:
+                    count += 1
+
+        for entry in utils.iter_data_entries(self.db_path, self._max_depth):
+            if entry.name in skip:
+                continue
+            if self._ttl is not None:
+                try:
+                    if (now - entry.stat().st_mtime) > self._ttl:
                         continue
-                count += 1
+                except FileNotFoundError:
+                    continue
+            count += 1
 
-        return count
+        return count - self._count_expired(now, skip)
+
+    def _count_expired(self, now, segment_entries):
+        """
+        The number of values that have expired by their per-key ttl but are still within the database ttl, i.e. the values that _count would count although get and keys hide them. Only the keys in the expiry buckets up to the current one can have expired, so only those are checked.
+        """
+        key_hashes = set()
+        for bucket in self._expiry_index.due_buckets(now, True):
+            key_hashes.update(self._expiry_index.read_bucket(bucket))
+
+        n_expired = 0
+        for key_hash in key_hashes:
+            entry = segment_entries.get(key_hash)
+            if entry is not None:
+                block = self._segments.read_block(entry)
+                if block is None:
+                    continue
+                mtime = entry[0]/1e9
+                fields = block[3]
+            else:
+                for shard_depth in self._lookup_depths():
+                    try:
+                        block = utils.open_data_block(utils.key_file_path(self.db_path, key_hash, shard_depth), self._n_bytes_key, self._n_bytes_value, 0)
+                        break
+                    except FileNotFoundError:
+                        continue
+                else:
+                    continue
+                utils.close_data_block(block)
+                mtime = block.stat.st_mtime
+                fields = block.fields
+
+            if (self._ttl is None or (now - mtime) <= self._ttl) and utils.is_expired(mtime, fields, None, now):
+                n_expired += 1
+
+        return n_expired
 
     def __contains__(self, key: str):
+        return self._contains(key)
+
+    def _contains(self, key: str):
+        if self._metrics is None:
+            return self._find_key(key)
+
+        start = perf_counter()
+        try:
+            found = self._find_key(key)
+        except Exception:
+            self._metrics.record('contains', perf_counter() - start, error=True)
+            raise
+        self._metrics.record('contains', perf_counter() - start, miss=not found)
+
+        return found
+
+    def _find_key(self, key: str):
         key_hash_hex = utils.hash_key(key.encode())
-        file_path = self.db_path.joinpath(key_hash_hex)
+        if self._bloom is not None and not self._bloom.might_contain(key_hash_hex):
+            return False
 
-        if file_path.is_file():
-            if self._ttl is not None:
-                if (time() - os.path.getmtime(file_path)) > self._ttl:
-                    file_path.unlink()
-                    return False
+        found, mtime_ns = self._find_stored_key(key_hash_hex)
+        pending = self._pending.get(key, not found or (mtime_ns is not None and self._pending.is_recent(mtime_ns)))
+        if pending is not None:
+            value = self._read_pending_value(key, key.encode(), *pending)
+            if value is None:
+                return False
+            value.close()
             return True
-        else:
-            return False
 
-    def get(self, key: str, default=None):
-        value = utils.get_value(self.db_path, key.encode(), self._n_bytes_key, self._n_bytes_value, self._ttl)
+        return found
+
+    def _find_stored_key(self, key_hash_hex):
+        """
+        Whether a key has a stored value that hasn't expired, and the mtime in ns of its data file (None for a value in a segment or a missing value).
+        """
+        if self._segments is not None:
+            found = self._segments.get_block(key_hash_hex, False)
+            if found is not None:
+                return not utils.is_expired(found[0][0]/1e9, found[1][3], self._ttl), None
+
+        for shard_depth in self._lookup_depths():
+            file_path = utils.key_file_path(self.db_path, key_hash_hex, shard_depth)
+
+            try:
+                block = utils.open_data_block(file_path, self._n_bytes_key, self._n_bytes_value, 0)
+            except (FileNotFoundError, IsADirectoryError):
+                continue
+            utils.close_data_block(block)
+
+            return not utils.is_expired(block.stat.st_mtime, block.fields, self._ttl), block.stat.st_mtime_ns
+
+        return False, None
+
+    def export(self, key: str, dest):
+        """
+        Copy a value straight to a file (a path or a file object), a file descriptor or a socket. Values that aren't in memory are copied by the kernel with copy_file_range or sendfile, so the data never passes through Python. Returns the number of bytes copied. Raises KeyError if the key doesn't exist.
+        """
+        value = self._get_value(key)
+        if value is None:
+            raise KeyError(key)
+
+        with value:
+            if isinstance(dest, (str, os.PathLike)):
+                with io.open(dest, 'wb') as f:
+                    return value.copy_to(f)
+            else:
+                return value.copy_to(dest)
+
+    def get(self, key: str, default=None, serializer=None):
+        """
+        Get a value, or default if the key isn't in the database. The serializer (a name or a Serializer) overrides the database's serializer for this call.
+        """
+        value = self._get_value(key)
 
         if value is None:
             return default
         else:
-            return value
+            return self._load(value, serializer)
 
     def update(self, key_value_dict: Union[Dict[str, bytes], Dict[str, io.IOBase]]):
         """
-
+        Write all the key/value pairs using set_many. The first error (if any) is raised after all writes have been attempted.
         """
         if self._write:
-            for key, value in key_value_dict.items():
-                self[key.encode()] = value
+            for result in self.set_many(key_value_dict):
+                if isinstance(result, Exception):
+                    raise result
         else:
             raise ValueError('File is open for read only.')
 
 
     def __getitem__(self, key: str):
-        value = utils.get_value(self.db_path, key.encode(), self._n_bytes_key, self._n_bytes_value, self._ttl)
+        value = self._get_value(key)
 
         if value is None:
             raise KeyError(key)
         else:
-            return value
+            return self._load(value)
 
 
-    def __setitem__(self, key: str, value: Union[bytes, io.IOBase]):
+    def __setitem__(self, key: str, value: Union[bytes, io.IOBase, os.PathLike, Iterable[bytes]]):
         if self._write:
-            utils.write_data_block(self.db_path, key.encode(), value, self._n_bytes_key, self._n_bytes_value, self._buffer_size)
+            self._set(key, value)
         else:
             raise ValueError('File is open for read only.')
 
-    def __delitem__(self, key: str):
+    def set(self, key: str, value: Any, ttl: int=None, serializer=None):
+        """
+        Like db[key] = value, but the value can be given its own ttl (in seconds) and serializer. It expires at the earlier of its own ttl and the database ttl.
+        """
+        if self._write:
+            self._set(key, value, ttl, serializer)
+        else:
+            raise ValueError('File is open for read only.')
+
+    def _set(self, key: str, value: Any, ttl: int=None, serializer=None):
+        if isinstance(value, os.PathLike):
+            ## Store the contents of the file, which is copied by the kernel
+            with io.open(value, 'rb') as f:
+                return self._set(key, f, ttl, serializer)
+
+        serializer = self._get_serializer(serializer)
+        if serializer is not None:
+            value = serializer.dumps(value)
+
+        if utils.is_stream(value):
+            ## Read before the key is locked, so a slow source doesn't hold up other writers
+            writer = ValueWriter(self, key, ttl)
+            try:
+                writer.write_from(value)
+            except BaseException:
+                writer.abort()
+                raise
+            writer.close()
+        else:
+            self._store(key, value, ttl)
+
+    def _store(self, key: str, value, ttl: int=None):
+        """
+        Store a serialized value: bytes, a file object of known length or a DataBlockWriter that holds a streamed value.
+        """
+        key_bytes = key.encode()
+        key_hash = utils.hash_key(key_bytes)
+
+        now = time()
+        try:
+            if self._metrics is None:
+                with self._write_lock(key_hash):
+                    self._write_value(key, key_bytes, key_hash, value, ttl, now)
+            else:
+                if isinstance(value, bytes):
+                    value_len = len(value)
+                elif isinstance(value, utils.DataBlockWriter):
+                    value_len = value.length
+                else:
+                    value_len = utils.determine_obj_size(value)
+                start = perf_counter()
+                try:
+                    with self._write_lock(key_hash):
+                        self._write_value(key, key_bytes, key_hash, value, ttl, now)
+                except Exception:
+                    self._metrics.record('set', perf_counter() - start, error=True, written=True)
+                    raise
+                self._metrics.record('set', perf_counter() - start, value_len, written=True)
+        except BaseException:
+            if isinstance(value, utils.DataBlockWriter):
+                value.abort()
+            raise
+
+        self._after_write(now)
+
+    def _after_write(self, now):
+        """
+        The maintenance triggered by writes. Called outside of the key locks, as expire and eviction take the locks of other keys.
+        """
+        if self._sweep_stop is None and now >= self._next_expire:
+            self._next_expire = now + utils.expire_check_interval
+            self.expire()
+        if self._bloom is not None and self._bloom.needs_rebuild:
+            self.rebuild_bloom()
+        if self._evictor is not None:
+            self._evict()
+
+    def open_writer(self, key: str, ttl: int=None):
+        """
+        Open a ValueWriter to store a value of unknown length (e.g. from a pipe, socket or HTTP body) by writing it in chunks, in constant memory. Use it as a context manager: the value is stored when the block exits (or on close()) and discarded if the block raises (or on abort()). Until then readers keep seeing the old value. The value can be given its own ttl; the serializer isn't applied.
+        """
         if self._write:
-            key_hash = utils.hash_key(key.encode())
-            file_path = self.db_path.joinpath(key_hash)
+            return ValueWriter(self, key, ttl)
+        else:
+            raise ValueError('File is open for read only.')
 
-            if not file_path.exists():
+    def batch(self, durability: str=None):
+        """
+        Open a Batch to write and delete several keys together. Use it as a context manager: the writes and deletes are staged (the values are written to staged files, nothing is visible yet) and applied together when the block exits, or discarded if it raises. Committed batches are recorded in a log before they're applied, so a batch interrupted by a crash is completed by the next writer that opens the database; one that wasn't committed yet is discarded. The staged files are fsynced concurrently and the whole batch is made durable with a single barrier, so with per-write or group durability a batch is much cheaper than the same writes done one by one. durability overrides the database durability for the batch. Values in a batch always get their own data files (they aren't put in segments or deduplicated).
+        """
+        if self._write:
+            if durability is None:
+                durability = self._durability
+            else:
+                utils.check_durability(durability)
+            return batch.Batch(self, durability)
+        else:
+            raise ValueError('File is open for read only.')
+
+    def _apply_batch(self, path, ops, commit_ns, durability):
+        """
+        Apply the operations of a committed batch in order, make them durable with a single commit at the end and remove the batch. Staged files that are gone have already been applied (by an attempt that was interrupted). An operation on a key that has been written (or deleted from a segment) since the commit is skipped, so a replay doesn't undo newer writes.
+        """
+        if durability == 'none':
+            committer = None
+        else:
+            durability = 'group'
+            committer = utils.GroupCommitter(len(ops) + 1)
+
+        now = time()
+        for key, op, *args in ops:
+            key_bytes = key.encode()
+            key_hash = utils.hash_key(key_bytes)
+            if op == 'set':
+                file_name, ttl, set_time = args
+                try:
+                    value = utils.DataBlockWriter.from_file(path.joinpath(file_name), self._n_bytes_key, self._n_bytes_value)
+                except FileNotFoundError:
+                    continue
+                with self._write_lock(key_hash):
+                    if self._is_newer(key_hash, commit_ns):
+                        value.abort()
+                    else:
+                        self._write_value(key, key_bytes, key_hash, value, ttl, set_time, durability, committer)
+            else:
+                try:
+                    with self._write_lock(key_hash):
+                        if not self._is_newer(key_hash, commit_ns):
+                            self._delete_value(key, key_hash, durability, committer)
+                except KeyError:
+                    pass
+
+        if committer is not None:
+            committer.commit()
+        batch.remove_batch(path)
+
+        self._after_write(now)
+
+    def _is_newer(self, key_hash, commit_ns):
+        mtime_ns = self._stored_mtime_ns(key_hash)
+
+        return mtime_ns is not None and mtime_ns > commit_ns
+
+    def _recover_batches(self):
+        """
+        Apply the batches that were committed but not completely applied (e.g. after a crash) and remove the ones that were never committed. Batches still in use by other processes are left alone.
+        """
+        for path in batch.iter_batches(self.db_path):
+            lock_fd = batch.claim_batch(path)
+            if lock_fd is None:
+                continue
+            try:
+                log = batch.read_log(path)
+                if log is None:
+                    batch.remove_batch(path)
+                else:
+                    ops, commit_ns = log
+                    self._apply_batch(path, ops, commit_ns, self._durability)
+            finally:
+                batch.release_batch(lock_fd)
+
+    def _evict(self):
+        """
+        Evict values until the database is back within max_size and max_entries, but at most evict_batch_size per call so that a write never has to wait for a large backlog; the next writes continue. Only one thread at a time evicts, the others skip it.
+        """
+        if not self._evict_lock.acquire(blocking=False):
+            return
+        n_evicted = 0
+        try:
+            while n_evicted < evict_batch_size and self._evictor.over_capacity():
+                victim = self._evictor.next_victim()
+                if victim is None:
+                    break
+                key_hash, key = victim
+                try:
+                    with self._write_lock(key_hash):
+                        self._delete_value(key, key_hash)
+                except KeyError:
+                    continue
+                n_evicted += 1
+            if n_evicted:
+                self._evictor.maintain()
+        finally:
+            self._evict_lock.release()
+
+        if n_evicted and self._metrics is not None:
+            self._metrics.add_evicted(n_evicted)
+
+    def append(self, key: str, data: bytes, atomic: bool=True, durability: str=None):
+        """
+        Append data to a value, creating the value if the key doesn't exist. The value isn't rewritten through Python: a copy of the data file is made by the kernel (a reflink where the filesystem supports it), patched with data and renamed into place, so readers see either the old or the new value. With atomic=False the data file is patched in place instead, so only data (and the few bytes of the header and trailer) is written and growing a large or log-like value costs O(len(data)); but a concurrent reader may see a partly written append, and values already returned that map the file (e.g. memory-mapped numpy arrays) change under their owner. Only opt in when nobody reads the value while it's patched. durability overrides the database durability for the patch. A stored crc32 or crc32c checksum is continued with data, so it keeps the append O(len(data)); a checksum of another algorithm is recomputed by reading the value back from the file in chunks. Compressed, deduplicated and segment values can't be patched and are rewritten in full (streamed from the old value, so a large value isn't held in memory). The per-key ttl of the value is kept.
+        """
+        if self._write:
+            self._patch('append', key, None, data, atomic, durability)
+        else:
+            raise ValueError('File is open for read only.')
+
+    def write_at(self, key: str, offset: int, data: bytes, atomic: bool=True, durability: str=None):
+        """
+        Overwrite part of a value with data starting at offset, without rewriting the rest of the value. The value is extended if data goes past its end; offset can be at most the length of the value. Raises KeyError if the key doesn't exist. The atomic and durability options are the same as for append. A stored checksum is recomputed by reading the value back from the file in chunks, which costs O(length of the value) reads but no extra memory.
+        """
+        if self._write:
+            self._patch('write_at', key, offset, data, atomic, durability)
+        else:
+            raise ValueError('File is open for read only.')
+
+    def _patch(self, op, key, offset, data, atomic, durability):
+        data = bytes(data)
+        if durability is None:
+            durability = self._durability
+        else:
+            utils.check_durability(durability)
+            if durability == 'group' and self._committer is None:
+                self._committer = utils.GroupCommitter()
+        key_bytes = key.encode()
+        key_hash = utils.hash_key(key_bytes)
+
+        now = time()
+        if self._metrics is None:
+            with self._write_lock(key_hash):
+                self._patch_value(key, key_bytes, key_hash, offset, data, atomic, durability)
+        else:
+            start = perf_counter()
+            try:
+                with self._write_lock(key_hash):
+                    self._patch_value(key, key_bytes, key_hash, offset, data, atomic, durability)
+            except Exception:
+                self._metrics.record(op, perf_counter() - start, error=True, written=True)
+                raise
+            self._metrics.record(op, perf_counter() - start, len(data), written=True)
+
+        self._after_write(now)
+
+    def _patch_value(self, key, key_bytes, key_hash, offset, data, atomic, durability):
+        if self._cache is not None:
+            self._cache.pop(key)
+        if self._bloom is not None:
+            self._bloom.add(key_hash)
+
+        if self._segments is None or self._segments.get_block(key_hash) is None:
+            for shard_depth in self._lookup_depths():
+                file_path = utils.key_file_path(self.db_path, key_hash, shard_depth)
+                try:
+                    patched = utils.patch_data_block(self.db_path, file_path, offset, data, self._n_bytes_key, self._n_bytes_value, durability, self._committer, atomic, self._ttl)
+                except (FileNotFoundError, IsADirectoryError):
+                    continue
+                if patched is None:
+                    break
+                stat, value_len, fields = patched
+                expiry = None
+                if utils.field_expiry in fields:
+                    expiry = utils.expiry_struct.unpack(fields[utils.field_expiry])[0]
+                index_expiry = utils.get_expiry(stat.st_mtime, fields, self._ttl)
+                if index_expiry is not None:
+                    self._expiry_index.add(key_hash, index_expiry)
+                if self._manifest is not None:
+                    self._manifest.add(key_hash, key, value_len, stat.st_mtime_ns, expiry)
+                return
+
+        ## The value can't be patched (or doesn't exist or has expired), so write it in full
+        now = time()
+        ttl = None
+        value = self._read_value(key)
+        if value is None:
+            if offset is not None:
                 raise KeyError(key)
+            self._write_value(key, key_bytes, key_hash, data, ttl, now)
+            return
 
-            file_path.unlink()
+        with value:
+            if utils.field_expiry in value.fields:
+                ttl = utils.expiry_struct.unpack(value.fields[utils.field_expiry])[0] - now
+            if offset is not None and (offset < 0 or offset > value.length):
+                raise ValueError('offset must be between 0 and the length of the value ({}).'.format(value.length))
+            if value.length <= self._buffer_size:
+                old_value = value.read()
+                if offset is None:
+                    offset = len(old_value)
+                new_value = old_value[:offset] + data + old_value[offset + len(data):]
+            else:
+                ## Streamed from the old value to a temporary data file rather than read into memory
+                new_value = utils.DataBlockWriter(self.db_path, key_bytes, self._n_bytes_key, self._n_bytes_value, self._compressor, None, self._checksum)
+                try:
+                    new_value.write_from(utils.patched_chunks(value, offset, data, self._buffer_size), self._buffer_size)
+                except BaseException:
+                    new_value.abort()
+                    raise
+            self._write_value(key, key_bytes, key_hash, new_value, ttl, now)
+
+    def _write_lock(self, key_hash):
+        """
+        The inter-process locks for writing a key, if locking is enabled.
+        """
+        if self._lock is None:
+            return nullcontext()
+        else:
+            return self._lock.write(key_hash)
+
+    def _write_value(self, key, key_bytes, key_hash, value, ttl, now, durability=None, committer=None):
+        if durability is None:
+            durability = self._durability
+            committer = self._committer
+        if self._cache is not None:
+            self._cache.pop(key)
+        if self._bloom is not None:
+            self._bloom.add(key_hash)
+        fields = {}
+        expiry = None
+        if ttl is not None:
+            expiry = now + ttl
+            fields[utils.field_expiry] = utils.expiry_struct.pack(expiry)
+
+        ## A streamed value has already been written to its temporary data file, so it always gets its own file
+        streamed = isinstance(value, utils.DataBlockWriter)
+        if (self._segment_max_value_size or self._dedup) and not streamed:
+            if isinstance(value, bytes):
+                value_len = len(value)
+            else:
+                value_len = utils.determine_obj_size(value)
+        in_segment = bool(self._segment_max_value_size) and not streamed and value_len <= self._segment_max_value_size
+        in_blob = self._dedup and not streamed and not in_segment and value_len >= utils.dedup_min_size
+
+        if in_segment:
+            if not isinstance(value, bytes):
+                value = value.read()
+            block = utils.make_data_block(key_bytes, value, self._n_bytes_key, self._n_bytes_value, fields, self._compressor, self._checksum)
+            entry = self._segments.put(key_hash, block)
+            self._commit_segment(entry, durability, committer)
+            mtime_ns = entry[0]
+            block_len = len(block)
+
+            ## Remove the data file of an earlier value
+            file_path = utils.key_file_path(self.db_path, key_hash, self._shard_depth)
+            try:
+                self._unlink_data_file(file_path, True, durability, committer)
+            except FileNotFoundError:
+                pass
+        elif in_blob:
+            stat = utils.write_dedup_block(self.db_path, key_bytes, value, self._n_bytes_key, self._n_bytes_value, self._buffer_size, self._shard_depth, durability, committer, fields, self._compressor, self._checksum)
+            mtime_ns = stat.st_mtime_ns
+        else:
+            old_content_hash = None
+            if self._has_blobs:
+                old_content_hash = utils.read_blob_field(utils.key_file_path(self.db_path, key_hash, self._shard_depth), self._n_bytes_key, self._n_bytes_value)
+
+            stat = utils.write_data_block(self.db_path, key_bytes, value, self._n_bytes_key, self._n_bytes_value, self._buffer_size, self._shard_depth, durability, committer, fields, self._compressor, None, self._checksum)
+            mtime_ns = stat.st_mtime_ns
+            block_len = stat.st_size
+
+            if old_content_hash is not None:
+                utils.release_blob(self.db_path, old_content_hash, key_hash, durability, committer)
+
+            ## Hide an earlier value stored in a segment
+            if self._segments is not None:
+                tombstone = self._segments.delete(key_hash)
+                if tombstone is not None:
+                    self._commit_segment(tombstone, durability, committer)
+
+        index_expiry = utils.get_expiry(mtime_ns/1e9, fields, self._ttl)
+        if index_expiry is not None:
+            self._expiry_index.add(key_hash, index_expiry)
+        if self._manifest is not None:
+            if in_blob:
+                size = value_len
+            elif streamed:
+                size = value.value_len
+            else:
+                trailer_len = len(utils.encode_trailer(fields)) if fields else 0
+                size = block_len - self._n_bytes_key - self._n_bytes_value - len(key_bytes) - trailer_len
+            self._manifest.add(key_hash, key, size, mtime_ns, expiry)
+        if self._prev_shard_depth is not None:
+            ## Remove a stale copy that hasn't been migrated yet
+            old_path = utils.key_file_path(self.db_path, key_hash, self._prev_shard_depth)
+            try:
+                self._unlink_data_file(old_path, False, durability, committer)
+            except FileNotFoundError:
+                pass
+        if self._bloom is None and time() >= self._next_bloom_check:
+            ## Checked after the write: a filter built from now on lists this key, and one built before is added to. Between the checks a new filter waits for the writes before listing the keys
+            self._next_bloom_check = time() + bloom_check_interval
+            if bloom_filter_exists(self.db_path):
+                self._open_bloom()
+                if self._bloom is not None:
+                    self._bloom.add(key_hash)
+
+    def __delitem__(self, key: str):
+        if self._write:
+            self._delete(key)
         else:
             raise ValueError('File is open for read only.')
 
+    def _delete(self, key: str):
+        key_hash = utils.hash_key(key.encode())
+
+        if self._metrics is None:
+            with self._write_lock(key_hash):
+                self._delete_value(key, key_hash)
+            return
+
+        start = perf_counter()
+        try:
+            with self._write_lock(key_hash):
+                self._delete_value(key, key_hash)
+        except KeyError:
+            self._metrics.record('delete', perf_counter() - start, miss=True)
+            raise
+        except Exception:
+            self._metrics.record('delete', perf_counter() - start, error=True)
+            raise
+        self._metrics.record('delete', perf_counter() - start)
+
+    def _delete_value(self, key, key_hash, durability=None, committer=None):
+        if self._cache is not None:
+            self._cache.pop(key)
+        if self._bloom is not None:
+            self._bloom.discard(key_hash)
+
+        deleted = False
+        if self._segments is not None:
+            tombstone = self._segments.delete(key_hash)
+            if tombstone is not None:
+                deleted = True
+                self._commit_segment(tombstone, durability, committer)
+
+        for shard_depth in self._lookup_depths():
+            file_path = utils.key_file_path(self.db_path, key_hash, shard_depth)
+            try:
+                self._unlink_data_file(file_path, True, durability, committer)
+                deleted = True
+            except FileNotFoundError:
+                pass
+
+        if not deleted:
+            raise KeyError(key)
+
+        if self._manifest is not None:
+            self._manifest.remove(key_hash)
+
+    def expire(self, max_items: int=utils.expire_batch_size, scan: bool=False):
+        """
+        Remove expired values. The buckets of the expiry index that are due (including the one the current time falls in, so values are removed as soon as they expire) are processed (oldest first) until max_items entries have been checked, so a call is bounded; call it again or use sweep_interval to continue. Writes also run it once a minute when there's no sweeper. With scan=True every data file is checked instead, which also covers values written without the expiry index (e.g. by older versions). Returns the number of values removed.
+        """
+        if not self._write:
+            raise ValueError('File is open for read only.')
+
+        if self._metrics is None:
+            return self._expire(max_items, scan)
+
+        start = perf_counter()
+        try:
+            n_removed = self._expire(max_items, scan)
+        except Exception:
+            self._metrics.record('expire', perf_counter() - start, error=True)
+            raise
+        self._metrics.record('expire', perf_counter() - start)
+        self._metrics.add_expired(n_removed)
+
+        return n_removed
+
+    def _expire(self, max_items, scan):
+        now = time()
+        n_removed = 0
+
+        with self._expire_lock:
+            if scan:
+                for file_path in list(utils.iter_data_paths(self.db_path, self._max_depth)):
+                    n_removed += self._expire_file(file_path, now)
+                if self._segments is not None:
+                    for key_hash, entry, (_, _, _, fields, _) in list(self._segments.iter_blocks()):
+                        n_removed += self._expire_segment_entry(key_hash, entry, fields, now)
+
+                return n_removed
+
+            n_checked = 0
+            current_bucket = self._expiry_index.bucket_of(now)
+            for bucket in self._expiry_index.due_buckets(now, True):
+                key_hashes = self._expiry_index.read_bucket(bucket)
+                ## The current bucket keeps the keys that haven't expired yet
+                keep = []
+                for i, key_hash in enumerate(key_hashes):
+                    if max_items is not None and n_checked >= max_items:
+                        self._expiry_index.update_bucket(bucket, key_hashes, keep + key_hashes[i:])
+                        return n_removed
+                    n_checked += 1
+                    removed = 0
+                    if self._segments is not None:
+                        found = self._segments.get_block(key_hash)
+                        if found is not None:
+                            removed += self._expire_segment_entry(key_hash, found[0], found[1][3], now)
+                    for shard_depth in self._lookup_depths():
+                        removed += self._expire_file(utils.key_file_path(self.db_path, key_hash, shard_depth), now)
+                    n_removed += removed
+                    if not removed and bucket >= current_bucket:
+                        keep.append(key_hash)
+                self._expiry_index.update_bucket(bucket, key_hashes, keep)
+
+        return n_removed
+
+    def _expire_file(self, file_path, now):
+        """
+        Remove a data file if it has expired. Returns 1 if it was removed, otherwise 0.
+        """
+        try:
+            block = utils.open_data_block(file_path, self._n_bytes_key, self._n_bytes_value, 0)
+        except FileNotFoundError:
+            return 0
+        utils.close_data_block(block)
+
+        if not utils.is_expired(block.stat.st_mtime, block.fields, self._ttl, now):
+            return 0
+
+        with self._write_lock(file_path.name):
+            try:
+                ## Leave it if it was overwritten in the meantime
+                if os.stat(file_path).st_ino != block.stat.st_ino:
+                    return 0
+                self._unlink_data_file(file_path)
+            except FileNotFoundError:
+                return 0
+
+            if self._manifest is not None:
+                self._manifest.remove(file_path.name)
+
+        return 1
+
+    def _expire_segment_entry(self, key_hash, entry, fields, now):
+        """
+        Add a tombstone for a value in a segment if it has expired. Returns 1 if it was removed, otherwise 0.
+        """
+        if not utils.is_expired(entry[0]/1e9, fields, self._ttl, now):
+            return 0
+
+        with self._write_lock(key_hash):
+            ## Leave it if it was overwritten in the meantime
+            tombstone = self._segments.delete(key_hash, entry)
+            if tombstone is None:
+                return 0
+
+            self._commit_segment(tombstone)
+            if self._manifest is not None:
+                self._manifest.remove(key_hash)
+
+        return 1
+
+    def _sweep(self):
+        """
+        The background sweeper thread.
+        """
+        while not self._sweep_stop.wait(self._sweep_interval):
+            try:
+                self.expire()
+            except Exception:
+                pass
+
+    def _unlink_data_file(self, file_path, commit=True, durability=None, committer=None):
+        """
+        Remove a data file and release the blob it refers to. Raises FileNotFoundError if it doesn't exist. durability and committer default to the database's.
+        """
+        if durability is None:
+            durability = self._durability
+            committer = self._committer
+        if self._has_blobs:
+            utils.unlink_data_file(self.db_path, file_path, self._n_bytes_key, self._n_bytes_value, durability, committer)
+        else:
+            file_path.unlink()
+        if commit:
+            self._commit_unlink(file_path, durability, committer)
+
+    def _commit_unlink(self, file_path, durability=None, committer=None):
+        if durability is None:
+            durability = self._durability
+            committer = self._committer
+        if durability == 'per-write':
+            utils.fsync_dir(file_path.parent)
+        elif durability == 'group':
+            committer.add(file_path, False)
+
+    def _commit_segment(self, entry, durability=None, committer=None):
+        if durability is None:
+            durability = self._durability
+            committer = self._committer
+        if durability == 'per-write':
+            self._segments.sync()
+            utils.fsync_dir(self._segments.path)
+        elif durability == 'group':
+            committer.add(self._segments.segment_path(entry))
+
+    def sync(self):
+        """
+        Make all writes and deletes done so far durable. Only needed with durability='group' (per-write is already durable and none never fsyncs).
+        """
+        if self._committer is not None:
+            self._committer.commit()
+
     def __enter__(self):
         return self
 
@@ -168,29 +1759,109 @@ class FileDBM(MutableMapping):
 
     def clear(self):
         if self._write:
-            for file in self.db_path.iterdir():
-                if file.is_file():
+            with (nullcontext() if self._lock is None else self._lock.exclusive()):
+                for file in list(utils.iter_data_paths(self.db_path, self._max_depth)):
                     file.unlink()
+                utils.remove_empty_shard_dirs(self.db_path)
+                if self._has_blobs:
+                    shutil.rmtree(self.db_path.joinpath(utils.sys_dir_name, utils.blobs_dir_name), ignore_errors=True)
+                if self._segments is not None:
+                    self._segments.clear()
+                if self._cache is not None:
+                    self._cache.clear()
+                if self._manifest is not None:
+                    self._manifest.rewrite([])
+                self._expiry_index.clear()
+                if self._bloom is not None:
+                    self._bloom.build(lambda: [])
+                if self._access is not None:
+                    self._access.clear()
         else:
             raise ValueError('File is open for read only.')
 
     def close(self):
-        pass
+        if self._sweep_stop is not None:
+            self._sweep_stop.set()
+            self._sweep_stop = None
+        self.sync()
+        if self._access is not None:
+            self._access.flush()
+        if self._manifest is not None:
+            if self._write and self._manifest.needs_compaction():
+                self._manifest.compact()
+            self._manifest.close()
+        if self._segments is not None:
+            self._segments.close()
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        if self._bloom is not None:
+            self._bloom.close()
+        if self._lock is not None:
+            self._lock.close()
+            self._lock = None
+        _open_dbs.pop(id(self), None)
+
+    def __reduce__(self):
+        """
+        Pickling (e.g. to pass the database to a multiprocessing worker) reopens the database in the other process with the same settings. A database created with flag 'n' or 'c' is reopened with 'w'.
+        """
+        return (self.__class__, self._open_args)
+
+    def _after_fork(self):
+        """
+        Reset the per-process state in the child after a fork: threads don't survive a fork, locks may have been held by another thread and the child must append to its own segment and take its own file locks.
+        """
+        self._executor = None
+        self._executor_lock = Lock()
+        self._expire_lock = Lock()
+        if self._committer is not None:
+            self._committer = utils.GroupCommitter()
+        if self._cache is not None:
+            self._cache.after_fork()
+        if self._manifest is not None:
+            self._manifest.after_fork()
+        if self._segments is not None:
+            self._segments.after_fork()
+        if self._lock is not None:
+            self._lock.after_fork()
+        if self._metrics is not None:
+            self._metrics.after_fork()
+        if self._bloom is not None:
+            self._bloom.after_fork()
+        if self._evictor is not None:
+            self._evict_lock = Lock()
+            self._evictor.after_fork()
+        if self._access is not None:
+            self._access.after_fork()
+        self._pending.after_fork()
+        if self._sweep_stop is not None:
+            self._sweep_stop = Event()
+            Thread(target=self._sweep, name='filedbm-sweeper', daemon=True).start()
 
     # def __del__(self):
     #     self.close()
 
 
 
+def _after_fork_in_child():
+    for db in list(_open_dbs.values()):
+        db._after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
 def open(
-    db_path: str, flag: str = "r", buffer_size: int=512000, n_bytes_key: int=2, n_bytes_value: int=4, ttl: int=None):
+    db_path: str, flag: str = "r", buffer_size: int=512000, n_bytes_key: int=2, n_bytes_value: int=4, ttl: int=None, shard_depth: int=None, max_workers: int=None, durability: str='none', cache_size: int=0, cache_max_value_size: int=1048576, manifest: bool=None, sweep_interval: float=None, compression: str=None, compression_level: int=None, compression_min_size: int=256, segment_max_value_size: int=None, segment_size: int=67108864, dedup: bool=None, serializer: str=None, locking: bool=False, metrics: bool=False, bloom_fpr: float=None, max_size: int=None, max_entries: int=None, eviction: str=None, checksum: str=None, verify_checksums: bool=False):
     """
     Open a persistent dictionary for reading and writing. All keys and values are stored in individual files within the db_path. Keys must be strings and values must be either bytes or file-objects. In the future, I might add more flexibility for inputs and outputs.
 
     Parameters
     -----------
     db_path : str or pathlib.Path
-        It must be a path to a folder. If the folder doesn't exist, it will be created if flags 'c' or 'n' are passed.
+        It must be a path to a folder. If the folder doesn't exist, it will be created if flags 'c' or 'n' are passed. A path to a file made by FileDBM.freeze opens it read-only as a PackedFileDBM (only buffer_size, ttl and serializer apply).
 
     flag : str
         Flag associated with how the file is opened according to the dbm style. See below for details.
@@ -205,11 +1876,77 @@ def open(
         The number of bytes to represent an integer of the max length of each value.
 
     ttl : int or None
-        Give the database a Time To Live (ttl) lifetime in seconds. All objects will persist in the database for at least this length. The objects will be removed when any query is performed on the database. The default None will not assign a ttl. The ttl will only be used if the flag parameter is set to anything but "r".
+        Give the database a Time To Live (ttl) lifetime in seconds. All objects will persist in the database for at least this length. Expired objects are no longer returned by any query and are removed by expire (run by the background sweeper, see sweep_interval, or otherwise once a minute by writes). Individual values can be given their own ttl with set. The default None will not assign a ttl. The ttl will only be used if the flag parameter is set to anything but "r".
+
+    shard_depth : int or None
+        The number of levels of subdirectories (named by the leading hex characters of the key hash) that the data files are nested in. 0 puts all files directly in the db_path, 2 creates a layout like ab/cd/<hash>. Very large databases should use 1 or 2 to keep each directory small. The layout is recorded in the database when it is created; the default None uses the recorded layout (or 0 for a new database). Existing databases can be converted with migrate_layout.
+
+    max_workers : int or None
+        The number of threads used by the bulk methods (get_many, set_many, delete_many, contains_many, update, and items/values with keys). The default None uses the ThreadPoolExecutor default.
+
+    durability : str
+        How writes (and deletes) are made durable. Writes are always atomic: values are written to a temporary file and renamed into place, so readers (and crashes) never see a partially written value. 'none' never fsyncs and leaves it to the OS. 'per-write' fsyncs the file and its directory before each write returns. 'group' batches the fsyncs of many writes into one commit, made after 1000 pending writes, after 1 second, or when sync() or close() is called; only writes before the last commit are guaranteed to survive a crash.
+
+    cache_size : int
+        The total bytes of values to keep in an in-memory LRU cache. 0 disables the cache. Cached values are validated against the data file's inode, mtime and size with a single stat on every get, so changes from other processes are picked up. See cache_info for the hit, miss and eviction counters.
+
+    cache_max_value_size : int
+        Values larger than this (in bytes) are never cached.
+
+    manifest : bool or None
+        Keep a persistent manifest (an append-only log mapping each key hash to its key, value size and mtime) so that keys() and len() don't need to list the directory and open every data file. It also keeps the keys in sorted order for keys(prefix=..., start=..., stop=..., reverse=...) and the same range queries of items and values, which then cost as much as the keys returned. It's maintained by every write and delete and recorded in the database, so the default None uses whatever the database was created with. True on an existing database builds the manifest from the data files and False removes it. If data files are changed without going through FileDBM (or after a crash), repair it with rebuild_manifest.
+
+    sweep_interval : float or None
+        Run a background thread that calls expire every sweep_interval seconds to remove expired values in bounded batches. Only used when the database is open for writing.
+
+    compression : str or None
+        Compress values as they are written with 'zlib', 'lzma', 'zstd' (needs the zstandard package), 'lz4' (needs the lz4 package) or 'auto' (zstd if available, otherwise zlib). Values are compressed and decompressed in buffer_size chunks. The codec is recorded with each value, so values are always read correctly regardless of this setting. None (the default) doesn't compress new values.
+
+    compression_level : int or None
+        The compression level passed to the codec. None uses the codec's default.
+
+    compression_min_size : int
+        Values smaller than this (in bytes) are not compressed. Values that don't shrink when compressed are also stored as is.
+
+    segment_max_value_size : int or None
+        Store values of up to this many bytes packed together in shared, append-only segment files (in the .filedbm folder) instead of one file per key, which saves an inode and a filesystem block per value and makes small writes much cheaper. Larger values keep their own files. The setting is recorded in the database, so the default None uses whatever the database was created with; 0 stops new values from going into segments (existing ones are still read). Values written by other processes are picked up within a second (immediately if a key isn't found, unless it was already found missing within the last second). Overwritten and deleted values are reclaimed in the background by compacting segments that are at least half dead, or with compact_segments. Enable it while no other process has the database open.
+
+    segment_size : int
+        The size in bytes at which a segment file is closed and a new one started. Defaults to 64 MiB.
+
+    serializer : str, Serializer or None
+        Serialize values on set and deserialize them on get with 'pickle', 'json', 'msgpack' (needs the msgpack package), 'numpy' (needs numpy) or 'bytes' (get returns bytes instead of a file object). A filedbm.serializers.Serializer can be passed for a custom format. get and set also take a serializer for a single call. The 'numpy' serializer stores arrays in the .npy format and get returns a read-only array directly over the memory map of the data file, so even very large arrays load in constant time and memory (values that are compressed are decompressed into memory instead). The default None takes and returns bytes/file objects as is. The serializer isn't recorded in the database.
+
+    locking : bool
+        Coordinate writers in different processes with fcntl locks in the .filedbm folder. Each write or delete holds the lock of its key (keys are striped over 4096 byte-range locks) and a shared database lock; clear and flag='n' take the database lock exclusively so they never run while another process is writing. Readers never lock, as values are replaced by atomic renames. All processes writing to the database should enable it. Not available on Windows.
+
+    bloom_fpr : float or None
+        Keep a Bloom filter over the stored keys with this false-positive rate (e.g. 0.01), so that a lookup (get or contains) of a key that isn't stored returns without touching the filesystem. The filter is a shared memory map in the .filedbm folder that is updated by every write in every process, and it's rebuilt (at twice the size) whenever it has filled up beyond its rate. It uses about -1.44*log2(fpr) bytes per key (a byte per position rather than a bit, so that processes can set positions concurrently without locking). The setting is recorded in the database, so the default None uses whatever the database was created with; 0 removes the filter. Writers in different processes should enable locking so that a rebuild can't miss their writes.
+
+    max_size : int or None
+        Bound the total bytes of the stored values (as written, i.e. after compression) to use the database as a disk cache. Once a write takes the database over max_size or max_entries, values are evicted according to eviction. The database can go over the bound by up to a few values while writes are in progress, as every write evicts at most 16 values and concurrent writes skip the eviction. Needs the manifest (it's enabled automatically), which keeps the totals for every process. The bounds and the policy are recorded in the database, so the default None uses whatever the database was created with; 0 removes a bound.
+
+    max_entries : int or None
+        Bound the number of stored values. See max_size.
+
+    eviction : str or None
+        The eviction policy: 'lru' evicts the least recently read or written values, 'lfu' the least often read values (the least recently used among equals), 'fifo' the oldest writes. Reads are only recorded in memory and are appended in batches to an access log in the .filedbm folder shared by all processes (and on close), so they cost no writes. Defaults to 'lru'.
+
+    checksum : str or None
+        Store a checksum with every value written: 'crc32', 'crc32c' (needs the crc32c package), 'xxhash' (needs the xxhash package, xxh3_64) or 'blake2b' (128 bits). The checksum of the value as stored (i.e. after compression) is computed while the value is written and recorded with its algorithm in the value's trailer, so it isn't recorded in the database and values with different or no checksums can be mixed. Check the whole database with FileDBM.verify. None (the default) doesn't add checksums to new values.
+
+    verify_checksums : bool
+        Check values that have a checksum as they are read. A value read from start to end (in any number of reads) raises a filedbm.checksums.ChecksumError from the read that completes it if it doesn't match; values that are only read in part (or out of order) aren't checked. Values in the value cache were checked when they were loaded. Defaults to False.
+
+    metrics : bool
+        Count and time every get, set, delete, contains, len and expire call (latency histograms, bytes read and written, expired values). Read them with FileDBM.stats(). Hooks added with FileDBM.add_hook are called after every operation to export them (e.g. to Prometheus or OpenTelemetry). Disabled by default, which costs nothing beyond a None check per call.
+
+    dedup : bool or None
+        Store each distinct value only once. Values are hashed (blake2b) as they are written and a value whose content is already in the database isn't written again; the key just gets a hard link to the stored copy (a blob in the .filedbm folder). The link count of a blob is its reference count, and a blob is removed when the last key referring to it is deleted or overwritten. Values under 4096 bytes (and values stored in segments) aren't deduplicated. The setting is recorded in the database, so the default None uses whatever the database was created with. Needs a filesystem with hard links.
 
     Returns
     -------
-    FileDBM
+    FileDBM or PackedFileDBM
 
     The optional *flag* argument can be:
 
@@ -229,4 +1966,9 @@ def open(
     |         | for reading and writing                   |
     +---------+-------------------------------------------+
     """
-    return FileDBM(db_path, flag, buffer_size, n_bytes_key, n_bytes_value, ttl)
+    if os.path.isfile(db_path):
+        if flag != 'r':
+            raise ValueError('A packed database can only be opened with flag r.')
+        return packed.PackedFileDBM(db_path, buffer_size, ttl, serializer)
+
+    return FileDBM(db_path, flag, buffer_size, n_bytes_key, n_bytes_value, ttl, shard_depth, max_workers, durability, cache_size, cache_max_value_size, manifest, sweep_interval, compression, compression_level, compression_min_size, segment_max_value_size, segment_size, dedup, serializer, locking, metrics, bloom_fpr, max_size, max_entries, eviction, checksum, verify_checksums)
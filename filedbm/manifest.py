@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Persistent key manifest.
+
+The manifest is an append-only log in the .filedbm directory that maps each key hash to its key, value size and mtime. It's kept up to date by every write and delete, so keys() and len() don't need to list the directory or open the data files. The keys are also kept in sorted order (built on the first range or prefix query), and a compacted log is written in key order so that it loads already sorted.
+"""
+import os
+import io
+import struct
+from bisect import bisect_left, insort
+from threading import Lock
+from typing import Iterable, Tuple
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from . import utils, segments
+
+############################################
+### Parameters
+
+## op, key hash, value size, mtime (ns), expiry (seconds since the epoch, 0 for none), key length
+record_struct = struct.Struct('<c{}sQqdI'.format(utils.key_hash_len))
+
+op_set = b'S'
+op_delete = b'D'
+
+## The log is compacted when it holds more than this many records per live entry (plus the minimum below)
+compact_ratio = 2
+compact_min_records = 1000
+
+## The sorted keys are held in sublists of between this and twice this many keys
+sorted_load = 1000
+
+
+#######################################################
+### Classes
+
+
+class SortedKeys:
+    """
+    A sorted collection of keys, split into sublists of up to 2*sorted_load keys with a list of their maxes. Adding or removing a key only shifts a short sublist, and a range of keys is found by bisection, so a range scan costs O(log n + the number of keys returned).
+    """
+    def __init__(self, keys: Iterable[str]=()):
+        keys = sorted(keys)
+        self._lists = [keys[i:i + sorted_load] for i in range(0, len(keys), sorted_load)]
+        self._maxes = [keys_list[-1] for keys_list in self._lists]
+        self._len = len(keys)
+
+    def __len__(self):
+        return self._len
+
+    def add(self, key: str):
+        if not self._maxes:
+            self._lists.append([key])
+            self._maxes.append(key)
+            self._len += 1
+            return
+
+        i = bisect_left(self._maxes, key)
+        if i == len(self._maxes):
+            i -= 1
+            self._lists[i].append(key)
+            self._maxes[i] = key
+        else:
+            keys_list = self._lists[i]
+            j = bisect_left(keys_list, key)
+            if j < len(keys_list) and keys_list[j] == key:
+                return
+            keys_list.insert(j, key)
+        self._len += 1
+
+        keys_list = self._lists[i]
+        if len(keys_list) > 2*sorted_load:
+            half = keys_list[sorted_load:]
+            del keys_list[sorted_load:]
+            self._maxes[i] = keys_list[-1]
+            self._lists.insert(i + 1, half)
+            self._maxes.insert(i + 1, half[-1])
+
+    def remove(self, key: str):
+        i = bisect_left(self._maxes, key)
+        if i == len(self._maxes):
+            return
+        keys_list = self._lists[i]
+        j = bisect_left(keys_list, key)
+        if j == len(keys_list) or keys_list[j] != key:
+            return
+
+        del keys_list[j]
+        self._len -= 1
+        if not keys_list:
+            del self._lists[i]
+            del self._maxes[i]
+        elif j == len(keys_list):
+            self._maxes[i] = keys_list[-1]
+
+    def irange(self, start: str=None, stop: str=None, reverse: bool=False):
+        """
+        Iterate over the keys with start <= key < stop (None for no bound), in reverse order with reverse=True.
+        """
+        lists = self._lists
+        if not reverse:
+            if start is None:
+                i, j = 0, 0
+            else:
+                i = bisect_left(self._maxes, start)
+                j = bisect_left(lists[i], start) if i < len(lists) else 0
+            while i < len(lists):
+                for key in lists[i][j:]:
+                    if stop is not None and key >= stop:
+                        return
+                    yield key
+                i += 1
+                j = 0
+        else:
+            if stop is None:
+                i = len(lists) - 1
+                j = None
+            else:
+                i = bisect_left(self._maxes, stop)
+                if i == len(lists):
+                    i -= 1
+                    j = None
+                else:
+                    j = bisect_left(lists[i], stop)
+            while i >= 0:
+                keys_list = lists[i][:j]
+                for key in reversed(keys_list):
+                    if start is not None and key < start:
+                        return
+                    yield key
+                i -= 1
+                j = None
+
+
+class Manifest:
+    """
+    In-memory view of the manifest log. Records appended by other processes are picked up by refresh(), which only reads the new tail of the log (or the whole log if it has been rewritten by a rebuild/compaction).
+    """
+    def __init__(self, db_path):
+        self.path = db_path.joinpath(utils.sys_dir_name, utils.manifest_file_name)
+        self._entries = {}
+        self._n_records = 0
+        self._offset = 0
+        self._ino = None
+        self._total_size = 0
+        self._fd = None
+        self._sorted = None
+        self._lock = Lock()
+        ## Called with the key hash and entry of every set record read (see eviction.Evictor)
+        self.listener = None
+
+    def _reset(self):
+        self._entries = {}
+        self._n_records = 0
+        self._offset = 0
+        self._ino = None
+        self._total_size = 0
+        self._sorted = None
+
+    def _read_records(self, data):
+        """
+        Apply the complete records in data. Returns the number of bytes used; an incomplete record at the end (a write in progress or a crash) is left for the next refresh.
+        """
+        pos = 0
+        data_len = len(data)
+        sorted_keys = self._sorted
+        while pos + record_struct.size <= data_len:
+            op, key_hash, size, mtime, expiry, key_len = record_struct.unpack_from(data, pos)
+            end = pos + record_struct.size + key_len
+            if end > data_len:
+                break
+            key_hash = key_hash.hex()
+            if op == op_set:
+                key = data[pos + record_struct.size:end].decode()
+                old = self._entries.get(key_hash)
+                entry = self._entries[key_hash] = (key, size, mtime, expiry or None)
+                if self.listener is not None:
+                    self.listener(key_hash, entry)
+                self._total_size += size - (0 if old is None else old[1])
+                if sorted_keys is not None and (old is None or old[0] != key):
+                    if old is not None:
+                        sorted_keys.remove(old[0])
+                    sorted_keys.add(key)
+            else:
+                old = self._entries.pop(key_hash, None)
+                if old is not None:
+                    self._total_size -= old[1]
+                    if sorted_keys is not None:
+                        sorted_keys.remove(old[0])
+            self._n_records += 1
+            pos = end
+
+        return pos
+
+    def refresh(self):
+        """
+        Read any records added since the last refresh.
+        """
+        with self._lock:
+            try:
+                stat = os.stat(self.path)
+            except FileNotFoundError:
+                self._reset()
+                return
+
+            if stat.st_ino != self._ino:
+                self._reset()
+                self._ino = stat.st_ino
+
+            if stat.st_size > self._offset:
+                with io.open(self.path, 'rb') as f:
+                    f.seek(self._offset)
+                    data = f.read(stat.st_size - self._offset)
+                self._offset += self._read_records(data)
+
+    def _append(self, record):
+        """
+        Append a record (see utils.append_log). The fd is reopened if the log was replaced by a rebuild or compaction in the meantime.
+        """
+        with self._lock:
+            self._fd = utils.append_log(self.path, record, self._fd)
+
+    def add(self, key_hash: str, key: str, size: int, mtime: int, expiry: float=None):
+        key_bytes = key.encode()
+        self._append(record_struct.pack(op_set, bytes.fromhex(key_hash), size, mtime, expiry or 0, len(key_bytes)) + key_bytes)
+
+    def remove(self, key_hash: str):
+        self._append(record_struct.pack(op_delete, bytes.fromhex(key_hash), 0, 0, 0, 0))
+
+    def entries(self):
+        """
+        The current entries as a dict of key hash -> (key, value size, mtime in ns, expiry or None).
+        """
+        self.refresh()
+
+        return self._entries
+
+    def sorted_keys(self):
+        """
+        The keys in sorted order as a SortedKeys. It's built from the entries on first use and then kept up to date as records are read.
+        """
+        self.refresh()
+        with self._lock:
+            if self._sorted is None:
+                self._sorted = SortedKeys(entry[0] for entry in self._entries.values())
+
+            return self._sorted
+
+    def __len__(self):
+        return len(self.entries())
+
+    @property
+    def total_size(self):
+        """
+        The sum of the value sizes of the current entries.
+        """
+        self.refresh()
+
+        return self._total_size
+
+    def needs_compaction(self):
+        self.refresh()
+
+        return self._n_records > compact_ratio*len(self._entries) + compact_min_records
+
+    def _write_tmp(self, entries):
+        tmp_path = self.path.with_name(self.path.name + '.' + os.urandom(6).hex() + '.tmp')
+        with io.open(tmp_path, 'wb') as f:
+            for key_hash, key, size, mtime, expiry in entries:
+                key_bytes = key.encode()
+                f.write(record_struct.pack(op_set, bytes.fromhex(key_hash), size, mtime, expiry or 0, len(key_bytes)) + key_bytes)
+
+        return tmp_path
+
+    def rewrite(self, entries: Iterable[Tuple[str, str, int, int, float]]):
+        """
+        Replace the log with one set record per entry (key hash, key, value size, mtime, expiry). The new log is written to a temporary file and renamed into place. The records appended by other processes while the entries were generated (e.g. scanned by rebuild_manifest) are carried over to the new log, as they are newer than the entries.
+        """
+        try:
+            stat = os.stat(self.path)
+            start = (stat.st_ino, stat.st_size)
+        except FileNotFoundError:
+            start = None
+        tmp_path = self._write_tmp(entries)
+
+        with utils.locked_log(self.path) as fd:
+            stat = os.fstat(fd)
+            ## All of it if the log was replaced in the meantime
+            offset = start[1] if start is not None and start[0] == stat.st_ino else 0
+            tail = os.pread(fd, max(0, stat.st_size - offset), offset)
+            if tail:
+                with io.open(tmp_path, 'ab') as f:
+                    f.write(tail)
+            os.replace(tmp_path, self.path)
+        self.refresh()
+
+    def compact(self):
+        """
+        Rewrite the log without the overwritten and deleted records. The records are written in key order, so the sorted keys are cheap to build when the log is loaded. The log is read and replaced while appends are locked out (see utils.locked_log), so no record is lost; without fcntl that isn't possible and the log isn't compacted.
+        """
+        if fcntl is None:
+            return
+
+        with utils.locked_log(self.path):
+            entries = self.entries()
+            tmp_path = self._write_tmp(sorted(((key_hash,) + entry for key_hash, entry in entries.items()), key=lambda entry: entry[1]))
+            os.replace(tmp_path, self.path)
+        self.refresh()
+
+    def after_fork(self):
+        ## The flocks taken on the fd would be shared with the parent, so the child opens its own
+        self._lock = Lock()
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def close(self):
+        with self._lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+
+#######################################################
+### Functions
+
+
+def scan_entries(db_path, n_bytes_key, n_bytes_value, max_depth=0):
+    """
+    Generate the manifest entries from the segments and the data files.
+    """
+    live = {}
+    if db_path.joinpath(utils.sys_dir_name, segments.segments_dir_name).exists():
+        store = segments.SegmentStore(db_path, n_bytes_key, n_bytes_value, False)
+        live = store.live_entries()
+        for key_hash, entry, (key, value_pos, value_len, fields, block) in store.iter_blocks(live):
+            yield key_hash, key.decode(), value_len, entry[0], utils.get_expiry(entry[0]/1e9, fields)
+        store.close()
+
+    for file_path in utils.iter_data_paths(db_path, max_depth):
+        if file_path.name in live:
+            continue
+        try:
+            block = utils.open_data_block(file_path, n_bytes_key, n_bytes_value, 0)
+        except FileNotFoundError:
+            continue
+        utils.close_data_block(block)
+
+        blob_field = block.fields.get(utils.field_blob)
+        if blob_field is not None:
+            value_len = utils.blob_struct.unpack(blob_field)[1]
+        else:
+            value_len = block.value_len
+
+        yield file_path.name, block.key.decode(), value_len, block.stat.st_mtime_ns, utils.get_expiry(block.stat.st_mtime, block.fields)
+
+
+def rebuild_manifest(db_path, n_bytes_key=2, n_bytes_value=4, max_depth=0):
+    """
+    Regenerate the manifest from the data files, e.g. after a crash or after files were changed without going through FileDBM.
+    """
+    manifest = Manifest(db_path)
+    manifest.rewrite(scan_entries(db_path, n_bytes_key, n_bytes_value, max_depth))
+
+    return manifest
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Operation metrics and hooks.
+
+When enabled, every get, set, delete, contains, len and expire call is counted and timed into a latency histogram, together with the bytes read and written the number of expired values and the number of evicted values (in capacity-bounded databases). Hooks are called after every operation, e.g. to export the metrics to Prometheus or OpenTelemetry. When disabled the hot paths only check for None.
+"""
+from bisect import bisect_left
+from threading import Lock
+
+############################################
+### Parameters
+
+## Upper bounds (in seconds) of the latency histogram buckets; the last bucket is unbounded
+latency_buckets = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+#######################################################
+### Classes
+
+
+class OperationStats:
+    __slots__ = ('count', 'errors', 'misses', 'total', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.misses = 0
+        self.total = 0.0
+        self.buckets = [0]*(len(latency_buckets) + 1)
+
+    def to_dict(self):
+        histogram = {str(bound): n for bound, n in zip(latency_buckets, self.buckets)}
+        histogram['+Inf'] = self.buckets[-1]
+
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'misses': self.misses,
+            'total_s': self.total,
+            'mean_ms': self.total/self.count*1e3 if self.count else None,
+            'histogram': histogram,
+            }
+
+
+class Metrics:
+    """
+    Thread-safe operation counters and latency histograms. Hooks are callables taking (op, duration in seconds, bytes read or written, error) that are called after every operation; exceptions raised by hooks are ignored.
+    """
+    def __init__(self):
+        self._lock = Lock()
+        self._hooks = []
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._ops = {}
+            self.bytes_read = 0
+            self.bytes_written = 0
+            self.expired = 0
+            self.evicted = 0
+
+    def record(self, op: str, duration: float, n_bytes: int=0, error: bool=False, miss: bool=False, written: bool=False):
+        with self._lock:
+            stats = self._ops.get(op)
+            if stats is None:
+                stats = self._ops[op] = OperationStats()
+            stats.count += 1
+            stats.total += duration
+            stats.buckets[bisect_left(latency_buckets, duration)] += 1
+            if error:
+                stats.errors += 1
+            if miss:
+                stats.misses += 1
+            if written:
+                self.bytes_written += n_bytes
+            else:
+                self.bytes_read += n_bytes
+
+        for hook in self._hooks:
+            try:
+                hook(op, duration, n_bytes, error)
+            except Exception:
+                pass
+
+    def add_expired(self, n: int):
+        with self._lock:
+            self.expired += n
+
+    def add_evicted(self, n: int):
+        with self._lock:
+            self.evicted += n
+
+    def add_hook(self, hook):
+        self._hooks = self._hooks + [hook]
+
+    def remove_hook(self, hook):
+        self._hooks = [h for h in self._hooks if h is not hook]
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'ops': {op: stats.to_dict() for op, stats in self._ops.items()},
+                'bytes_read': self.bytes_read,
+                'bytes_written': self.bytes_written,
+                'expired': self.expired,
+                'evicted': self.evicted,
+                }
+
+    def after_fork(self):
+        self._lock = Lock()
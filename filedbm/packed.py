@@ -0,0 +1,463 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Packed read-only databases.
+
+A database can be frozen into a single file for distribution: the data blocks of all keys (as they are stored in the data files, so compressed values stay compressed) in key order, followed by a sorted array of the block offsets and a hash table over the key hashes. PackedFileDBM serves it read-only through one memory map shared by all its readers, with O(1) lookups and range scans by bisection. thaw writes it back into a database folder.
+
+Layout: header | data blocks | entries (offset, mtime in ns) in key order plus an end sentinel | hash table slots (key hash, entry index + 1).
+"""
+import os
+import io
+import mmap
+import pathlib
+import struct
+from collections.abc import Mapping
+from itertools import repeat
+from time import time
+from typing import Any, Iterable, List
+
+from . import utils, segments
+from .serializers import get_serializer
+
+############################################
+### Parameters
+
+magic = b'FDBMPACK'
+version = 1
+
+## magic, version, n_bytes_key, n_bytes_value, flags, number of entries, number of hash table slots, position of the entries, position of the hash table
+header_struct = struct.Struct('<8sHBBIQQQQ')
+entry_struct = struct.Struct('<Qq')
+slot_struct = struct.Struct('<{}s3xQ'.format(utils.key_hash_len))
+
+## Set when any value has a per-key expiry
+flag_expiry = 1
+
+## The hash table has at least this many slots per entry
+slots_per_entry = 2
+min_slots = 8
+
+
+#######################################################
+### Classes
+
+
+class PackedFileDBM(Mapping):
+    """
+    Read-only database over a file created by FileDBM.freeze. Values are returned as FileObjectReadSlices over the shared memory map (no copy) or deserialized with the serializer. Open it with filedbm.open on the file.
+    """
+    def __init__(self, file_path: str, buffer_size: int=512000, ttl: int=None, serializer: str=None):
+        self.file_path = pathlib.Path(file_path)
+        self._buffer_size = buffer_size
+        self._ttl = ttl
+        self._serializer = get_serializer(serializer) if serializer else None
+        self._write = False
+
+        with io.open(self.file_path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            file_magic, file_version, self._n_bytes_key, self._n_bytes_value, self._flags, self._n_entries, n_slots, self._entries_pos, self._table_pos = header_struct.unpack_from(self._mm, 0)
+        except struct.error:
+            file_magic = None
+        if file_magic != magic:
+            self._mm.close()
+            raise ValueError(str(file_path) + ' is not a packed FileDBM file.')
+        if file_version != version:
+            self._mm.close()
+            raise ValueError('Unsupported packed file version: ' + str(file_version))
+
+        self._mask = n_slots - 1
+        self._buf = memoryview(self._mm)
+
+    def _find(self, key_bytes):
+        """
+        The entry index of a key, or None.
+        """
+        key_hash = bytes.fromhex(utils.hash_key(key_bytes))
+        slot = int.from_bytes(key_hash[:8], 'little') & self._mask
+        while True:
+            slot_hash, index = slot_struct.unpack_from(self._mm, self._table_pos + slot*slot_struct.size)
+            if index == 0:
+                return None
+            if slot_hash == key_hash:
+                return index - 1
+            slot = (slot + 1) & self._mask
+
+    def _entry(self, index):
+        """
+        Parse the data block of an entry. Returns the key, the value's start and end in the file, the trailer fields and the mtime in seconds.
+        """
+        offset, mtime_ns = entry_struct.unpack_from(self._mm, self._entries_pos + index*entry_struct.size)
+        end = entry_struct.unpack_from(self._mm, self._entries_pos + (index + 1)*entry_struct.size)[0]
+        key_bytes, value_pos, value_len, fields = utils.parse_data_block(self._buf[offset:end], self._n_bytes_key, self._n_bytes_value)
+
+        return key_bytes, offset + value_pos, offset + value_pos + value_len, fields, mtime_ns/1e9
+
+    def _key_at(self, index):
+        offset = entry_struct.unpack_from(self._mm, self._entries_pos + index*entry_struct.size)[0]
+        n_bytes_header = self._n_bytes_key + self._n_bytes_value
+        key_len = utils.bytes_to_int(self._mm[offset:offset + self._n_bytes_key])
+
+        return self._mm[offset + n_bytes_header:offset + n_bytes_header + key_len]
+
+    def _value(self, index):
+        """
+        The value of an entry, or None if it has expired.
+        """
+        key_bytes, start, end, fields, mtime = self._entry(index)
+        if utils.is_expired(mtime, fields, self._ttl):
+            return None
+        value = utils.FileObjectReadSlice.from_buffer(self._buf[start:end], self.file_path, None, fields)
+
+        return utils.decompress_value(value, self._buffer_size)
+
+    def _get_value(self, key: str):
+        if self._mm.closed:
+            raise ValueError('The database is closed.')
+        key_bytes = key.encode()
+        index = self._find(key_bytes)
+        if index is None or self._key_at(index) != key_bytes:
+            return None
+
+        return self._value(index)
+
+    def _is_live(self, index):
+        if self._ttl is None and not self._flags & flag_expiry:
+            return True
+        key_bytes, start, end, fields, mtime = self._entry(index)
+
+        return not utils.is_expired(mtime, fields, self._ttl)
+
+    def _load(self, value, serializer=None):
+        serializer = self._serializer if serializer is None else get_serializer(serializer)
+        if serializer is None:
+            return value
+        else:
+            return serializer.loads(value)
+
+    def _bisect(self, key_bytes):
+        """
+        The index of the first entry whose key isn't smaller than key_bytes.
+        """
+        lo = 0
+        hi = self._n_entries
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key_at(mid) < key_bytes:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        return lo
+
+    def _range_indexes(self, prefix=None, start=None, stop=None, reverse=False):
+        """
+        The entry indexes of the keys with start <= key < stop that begin with prefix, in key order (the entries are sorted).
+        """
+        if prefix is not None:
+            if start is None or start < prefix:
+                start = prefix
+            prefix_stop = utils.prefix_stop(prefix)
+            if prefix_stop is not None and (stop is None or stop > prefix_stop):
+                stop = prefix_stop
+
+        first = 0 if start is None else self._bisect(start.encode())
+        last = self._n_entries if stop is None else self._bisect(stop.encode())
+        indexes = range(first, max(first, last))
+        if reverse:
+            indexes = reversed(indexes)
+
+        return (index for index in indexes if self._is_live(index))
+
+    def keys(self, prefix: str=None, start: str=None, stop: str=None, reverse: bool=False):
+        """
+        Iterate over the keys in sorted order. prefix, start (inclusive), stop (exclusive) and reverse select a range of keys in O(log n + the number of keys returned).
+        """
+        for index in self._range_indexes(prefix, start, stop, reverse):
+            yield self._key_at(index).decode()
+
+    def items(self, keys: List[str]=None, prefetch: int=0, prefix: str=None, start: str=None, stop: str=None, reverse: bool=False):
+        """
+        Iterate over the keys and values (in sorted order unless keys are given). prefetch is accepted for compatibility with FileDBM; the values are already mapped.
+        """
+        if keys is not None:
+            for key in keys:
+                yield key, self.get(key)
+            return
+
+        for index in self._range_indexes(prefix, start, stop, reverse):
+            value = self._value(index)
+            if value is not None:
+                yield self._key_at(index).decode(), self._load(value)
+
+    def values(self, keys: List[str]=None, prefetch: int=0, prefix: str=None, start: str=None, stop: str=None, reverse: bool=False):
+        for key, value in self.items(keys, prefetch, prefix, start, stop, reverse):
+            yield value
+
+    def __iter__(self):
+        return self.keys()
+
+    def __len__(self):
+        if self._ttl is None and not self._flags & flag_expiry:
+            return self._n_entries
+
+        return sum(1 for _ in self._range_indexes())
+
+    def __contains__(self, key: str):
+        key_bytes = key.encode()
+        index = self._find(key_bytes)
+        if index is None or self._key_at(index) != key_bytes:
+            return False
+
+        return self._is_live(index)
+
+    def get(self, key: str, default=None, serializer=None):
+        value = self._get_value(key)
+        if value is None:
+            return default
+        else:
+            return self._load(value, serializer)
+
+    def __getitem__(self, key: str):
+        value = self._get_value(key)
+        if value is None:
+            raise KeyError(key)
+        else:
+            return self._load(value)
+
+    def get_many(self, keys: Iterable[str], default=None, serializer=None):
+        return [self.get(key, default, serializer) for key in keys]
+
+    def contains_many(self, keys: Iterable[str]):
+        return [key in self for key in keys]
+
+    def export(self, key: str, dest):
+        """
+        Copy a value to a file (a path or a file object), a file descriptor or a socket. Returns the number of bytes copied.
+        """
+        value = self._get_value(key)
+        if value is None:
+            raise KeyError(key)
+
+        with value:
+            if isinstance(dest, (str, os.PathLike)):
+                with io.open(dest, 'wb') as f:
+                    return value.copy_to(f)
+            else:
+                return value.copy_to(dest)
+
+    def __setitem__(self, key: str, value: Any):
+        raise ValueError('File is open for read only.')
+
+    def __delitem__(self, key: str):
+        raise ValueError('File is open for read only.')
+
+    def cache_info(self):
+        return None
+
+    def stats(self, reset: bool=False):
+        return None
+
+    def sync(self):
+        pass
+
+    def close(self):
+        if not self._mm.closed:
+            self._buf.release()
+            try:
+                self._mm.close()
+            except BufferError:
+                ## Values handed out are still in use; the mapping is unmapped once they are garbage collected
+                pass
+
+    def __reduce__(self):
+        return (self.__class__, (str(self.file_path), self._buffer_size, self._ttl, self._serializer))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+#######################################################
+### Functions
+
+
+def _list_sources(db_path, n_bytes_key, n_bytes_value, max_depth, store):
+    """
+    The keys of the database with where their data block is: a key hash in the segments or a data file.
+    """
+    sources = []
+    live = {}
+    if store is not None:
+        live = store.live_entries()
+        for key_hash, entry, (key_bytes, value_pos, value_len, fields, block) in store.iter_blocks(live):
+            sources.append((bytes(key_bytes), key_hash, None))
+
+    for file_path in utils.iter_data_paths(db_path, max_depth):
+        if file_path.name in live:
+            continue
+        try:
+            block = utils.open_data_block(file_path, n_bytes_key, n_bytes_value, 0)
+        except FileNotFoundError:
+            continue
+        utils.close_data_block(block)
+        sources.append((block.key, file_path.name, file_path))
+
+    return sources
+
+
+def _write_block(fd, db_path, file_path, key_bytes, n_bytes_key, n_bytes_value, ttl, now):
+    """
+    Copy the data block of a data file into the packed file. A deduplicated value is written in full (from its blob). Returns the number of bytes written, the fields and the mtime in ns, or None if the file is gone or has expired.
+    """
+    try:
+        block = utils.open_data_block(file_path, n_bytes_key, n_bytes_value, 0)
+    except FileNotFoundError:
+        return None
+
+    try:
+        mtime_ns = block.stat.st_mtime_ns
+        if utils.is_expired(block.stat.st_mtime, block.fields, ttl, now):
+            return None
+
+        if utils.field_blob in block.fields:
+            block = utils.open_blob_block(db_path, block, n_bytes_key, n_bytes_value)
+            fields = dict(block.fields)
+            del fields[utils.field_blob]
+            n = utils.write_all(fd, utils.int_to_bytes(len(key_bytes), n_bytes_key) + utils.int_to_bytes(block.value_len, n_bytes_value) + key_bytes)
+            if block.data is not None:
+                n += utils.write_all(fd, block.data[block.value_pos:block.value_pos + block.value_len])
+            else:
+                n += utils.copy_fd_range(fd, block.fd, block.value_pos, block.value_len)
+            if fields:
+                n += utils.write_all(fd, utils.encode_trailer(fields))
+        else:
+            fields = block.fields
+            n = utils.copy_fd_range(fd, block.fd, 0, block.stat.st_size)
+    finally:
+        utils.close_data_block(block)
+
+    return n, fields, mtime_ns
+
+
+def freeze(db_path, file_path, n_bytes_key: int=2, n_bytes_value: int=4, ttl: int=None, max_depth: int=0):
+    """
+    Pack the keys and values of a database folder into a single file (see FileDBM.freeze). Expired values are left out. The file is written to a temporary file next to it and renamed into place. Returns the number of keys packed.
+    """
+    db_path = pathlib.Path(db_path)
+    file_path = pathlib.Path(file_path)
+    store = None
+    if db_path.joinpath(utils.sys_dir_name, segments.segments_dir_name).exists():
+        store = segments.SegmentStore(db_path, n_bytes_key, n_bytes_value, False)
+
+    tmp_path = file_path.with_name(file_path.name + '.' + os.urandom(6).hex() + '.tmp')
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try:
+        sources = _list_sources(db_path, n_bytes_key, n_bytes_value, max_depth, store)
+        sources.sort(key=lambda source: source[0])
+
+        now = time()
+        pos = utils.write_all(fd, bytes(header_struct.size))
+        entries = []
+        key_hashes = []
+        flags = 0
+        for key_bytes, key_hash, source_path in sources:
+            if source_path is None:
+                found = store.get_block(key_hash)
+                if found is None:
+                    continue
+                entry, (_, _, _, fields, block) = found
+                mtime_ns = entry[0]
+                if utils.is_expired(mtime_ns/1e9, fields, ttl, now):
+                    continue
+                n = utils.write_all(fd, block)
+            else:
+                written = _write_block(fd, db_path, source_path, key_bytes, n_bytes_key, n_bytes_value, ttl, now)
+                if written is None:
+                    continue
+                n, fields, mtime_ns = written
+
+            if utils.field_expiry in fields:
+                flags |= flag_expiry
+            entries.append(entry_struct.pack(pos, mtime_ns))
+            key_hashes.append(bytes.fromhex(key_hash))
+            pos += n
+
+        n_entries = len(entries)
+        entries.append(entry_struct.pack(pos, 0))
+        entries_pos = pos
+        pos += utils.write_all(fd, b''.join(entries))
+
+        n_slots = min_slots
+        while n_slots < slots_per_entry*n_entries:
+            n_slots *= 2
+        mask = n_slots - 1
+        table = bytearray(n_slots*slot_struct.size)
+        for index, key_hash in enumerate(key_hashes):
+            slot = int.from_bytes(key_hash[:8], 'little') & mask
+            while slot_struct.unpack_from(table, slot*slot_struct.size)[1]:
+                slot = (slot + 1) & mask
+            slot_struct.pack_into(table, slot*slot_struct.size, key_hash, index + 1)
+        table_pos = pos
+        utils.write_all(fd, table)
+
+        os.pwrite(fd, header_struct.pack(magic, version, n_bytes_key, n_bytes_value, flags, n_entries, n_slots, entries_pos, table_pos), 0)
+        os.fsync(fd)
+        os.close(fd)
+        fd = None
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        if fd is not None:
+            os.close(fd)
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    finally:
+        if store is not None:
+            store.close()
+
+    return n_entries
+
+
+def thaw(file_path, db_path, flag: str='n', **kwargs):
+    """
+    Write the keys and values of a packed file into a database folder, e.g. to modify a frozen database. The database is opened with flag and any other parameters of filedbm.open (the per-key ttls are kept, but the mtimes restart). Returns the number of keys written.
+    """
+    from .main import FileDBM
+
+    packed = PackedFileDBM(file_path)
+    db = FileDBM(db_path, flag, **kwargs)
+    n = 0
+    try:
+        now = time()
+        indexes = packed._range_indexes()
+        for chunk in utils.chunks(indexes, utils.bulk_chunk_size):
+            keys = []
+            values = []
+            ttls = []
+            for index in chunk:
+                value = packed._value(index)
+                if value is None:
+                    continue
+                keys.append(packed._key_at(index).decode())
+                values.append(value)
+                expiry_field = value.fields.get(utils.field_expiry)
+                ttls.append(None if expiry_field is None else utils.expiry_struct.unpack(expiry_field)[0] - now)
+
+            for result in db._map(db._set, keys, values, ttls, repeat('bytes')):
+                if isinstance(result, Exception):
+                    raise result
+            for value in values:
+                value.close()
+            n += len(keys)
+    finally:
+        db.close()
+        packed.close()
+
+    return n
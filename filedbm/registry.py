@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Registries of the algorithms of one kind: those that are recorded by id in the trailers of the data blocks (compression codecs and checksums) and the value serializers.
+"""
+
+
+#######################################################
+### Classes
+
+
+class Registry:
+    """
+    The algorithms of one kind by name and by id (id_attr is None for algorithms that aren't recorded). An algorithm listed in packages (name -> (package name, imported module or None)) can only be used when its package is installed. option is the name of the open parameter that selects the algorithm and kind is used in the error messages.
+    """
+    def __init__(self, option: str, kind: str, items, id_attr: str, packages: dict):
+        self.option = option
+        self.kind = kind
+        self.items = {item.name: item for item in items}
+        self.ids = {getattr(item, id_attr): item for item in items} if id_attr is not None else {}
+        self.packages = packages
+
+    def available(self, name: str):
+        """
+        Whether the algorithm exists and its package (if any) is installed.
+        """
+        if name in self.packages:
+            return self.packages[name][1] is not None
+        else:
+            return name in self.items
+
+    def _check_available(self, name, action):
+        if not self.available(name):
+            raise ImportError('The ' + self.packages[name][0] + ' package must be installed to ' + action + ' ' + name + ' ' + self.kind + '.')
+
+    def get(self, name: str, extra_choices: tuple=()):
+        """
+        Get an algorithm by name.
+        """
+        if name not in self.items:
+            raise ValueError(self.option + ' must be one of ' + str(tuple(self.items) + tuple(extra_choices)) + '.')
+        self._check_available(name, 'use')
+
+        return self.items[name]
+
+    def get_by_id(self, item_id: int):
+        """
+        Get the algorithm of an id read from a data block.
+        """
+        item = self.ids.get(item_id)
+        if item is None:
+            raise ValueError('Unknown ' + self.option + ' id: ' + str(item_id))
+        self._check_available(item.name, 'read values with')
+
+        return item
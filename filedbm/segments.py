@@ -0,0 +1,650 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Packed segment storage for small values.
+
+Instead of getting a file of its own, a small value is appended (as a complete data block) to a shared, log-structured segment file in .filedbm/segments. An offset index maps each key hash to the newest record of the key, so a get is still a single pread. Overwritten and deleted records are reclaimed by compaction, which copies the live records of mostly dead segments into the active segment and removes the old segments.
+
+Each writing process appends to its own active segment and holds a shared flock on it, so compaction (in any process) never touches a segment that is still being written. Other processes pick up new records by scanning the segment tails, at most every refresh_interval seconds and whenever a key isn't found. A segment that is no longer anyone's active segment never changes again, so it's sealed and only the segments that are still being written are checked for new records (and the folder is only listed again when it has changed). A read of a key that was found missing less than refresh_interval seconds ago doesn't check the segments again.
+
+A delete record (tombstone) is copied forward by compaction for as long as another segment still holds an older record of its key; the segments holding the overwritten records of each key are tracked for this (and saved with the index snapshot).
+"""
+import os
+import io
+import struct
+from time import time_ns, monotonic
+from threading import RLock, Lock, Thread
+from collections import defaultdict
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from . import utils
+
+############################################
+### Parameters
+
+segments_dir_name = 'segments'
+index_file_name = 'index'
+
+## Block length, timestamp (ns), op and key hash
+record_struct = struct.Struct('<IQB{}s'.format(utils.key_hash_len))
+
+op_delete = 0
+op_set = 1
+
+## The active segment is rotated once it reaches this size
+segment_size = 64*2**20
+
+## How often (in seconds) the segments are checked for records written by other processes
+refresh_interval = 1.0
+
+## Segments with at least this fraction of overwritten or deleted bytes are compacted
+compact_min_dead_ratio = 0.5
+
+## The max number of key hashes in the negative cache of reads
+miss_cache_size = 100000
+
+## The index snapshot: number of segments, then the name length, name and scanned length of each, then the number of entries and the entries, then the number of keys with overwritten records and, for each, the key hash and the segments holding them
+snapshot_count_struct = struct.Struct('<Q')
+snapshot_segment_struct = struct.Struct('<HQ')
+snapshot_entry_struct = struct.Struct('<{}sQIQIB'.format(utils.key_hash_len))
+snapshot_dead_struct = struct.Struct('<{}sH'.format(utils.key_hash_len))
+snapshot_dead_segment_struct = struct.Struct('<I')
+
+
+#######################################################
+### Classes
+
+
+class SegmentStore:
+    """
+    The segment files of a database and their offset index. The index is a dict of key hash -> (timestamp, segment name, record offset, block length, live); the record with the newest timestamp wins, and delete records (tombstones) hide older records of the key in other segments. The index is saved to a snapshot on close and after compaction so that opening a database only needs to scan what was appended since.
+    """
+    def __init__(self, db_path, n_bytes_key: int, n_bytes_value: int, write: bool, max_segment_size: int=segment_size):
+        self.path = db_path.joinpath(utils.sys_dir_name, segments_dir_name)
+        self._n_bytes_key = n_bytes_key
+        self._n_bytes_value = n_bytes_value
+        self._write = write
+        self.max_segment_size = max_segment_size
+        self._index = {}
+        self._scanned = {}
+        self._dead = {}
+        self._names = None
+        self._open_names = []
+        self._dir_mtime = None
+        self._sealed = set()
+        self._misses = {}
+        self._read_fds = {}
+        self._active = None
+        self._active_fd = None
+        self._active_size = 0
+        self._last_refresh = None
+        self._lock = RLock()
+        self._compact_lock = Lock()
+        self._compact_thread = None
+
+        if write:
+            self.path.mkdir(parents=True, exist_ok=True)
+        self._load_snapshot()
+        self.refresh(True)
+
+    def _segment_path(self, name):
+        return self.path.joinpath(name)
+
+    def _apply(self, key_hash, entry):
+        """
+        Add a record to the index unless the index already has a newer record of the key. A record with the same timestamp is a copy made by compaction and replaces the original. The segment of the record that loses is added to the key's dead segments.
+        """
+        old = self._index.get(key_hash)
+        if old is None or entry[0] >= old[0]:
+            self._index[key_hash] = entry
+            if old is not None:
+                self._add_dead(key_hash, old[1])
+        else:
+            self._add_dead(key_hash, entry[1])
+
+    def _add_dead(self, key_hash, name):
+        names = self._dead.get(key_hash, ())
+        if name not in names:
+            self._dead[key_hash] = names + (name,)
+
+    def _forget_segment(self, name, data):
+        """
+        Remove a segment (whose contents are data) from the dead segments of the keys it holds records of.
+        """
+        pos = 0
+        while pos + record_struct.size <= len(data):
+            block_len, ts, op, key_hash = record_struct.unpack_from(data, pos)
+            key_hash = key_hash.hex()
+            names = self._dead.get(key_hash)
+            if names is not None and name in names:
+                names = tuple(n for n in names if n != name)
+                if names:
+                    self._dead[key_hash] = names
+                else:
+                    del self._dead[key_hash]
+            pos += record_struct.size + block_len
+
+    def _has_older_records(self, key_hash, name):
+        """
+        Whether a segment other than name (still) holds an overwritten record of the key.
+        """
+        return any(n != name and n in self._scanned for n in self._dead.get(key_hash, ()))
+
+    def _scan(self, name, start):
+        """
+        Add the records of a segment from start to the index. An incomplete record at the end (a write in progress) is left for the next scan.
+        """
+        try:
+            with io.open(self._segment_path(name), 'rb') as f:
+                f.seek(start)
+                data = f.read()
+        except FileNotFoundError:
+            return
+
+        pos = 0
+        data_len = len(data)
+        while pos + record_struct.size <= data_len:
+            block_len, ts, op, key_hash = record_struct.unpack_from(data, pos)
+            end = pos + record_struct.size + block_len
+            if end > data_len:
+                break
+            self._apply(key_hash.hex(), (ts, name, start + pos, block_len, op == op_set))
+            pos = end
+
+        self._scanned[name] = start + pos
+
+    def _reset(self):
+        self._index = {}
+        self._scanned = {}
+        self._dead = {}
+        self._sealed = set()
+        for fd in self._read_fds.values():
+            os.close(fd)
+        self._read_fds = {}
+
+    def refresh(self, force: bool=False):
+        """
+        Pick up the records appended by other processes. The periodic refresh (at most every refresh_interval seconds) lists the segments, checks the sizes of those that aren't sealed and seals the ones that are no longer written to. A forced refresh (after a miss) only lists the segments again if the folder's mtime has changed and only checks the segments that aren't sealed. When a segment has been removed by a compaction the whole index is rebuilt (including the records of the own active segment), because its records now live elsewhere.
+        """
+        now = monotonic()
+        periodic = self._last_refresh is None or (now - self._last_refresh) >= refresh_interval
+        if not force and not periodic:
+            return
+
+        with self._lock:
+            if periodic:
+                self._last_refresh = now
+            try:
+                dir_mtime = os.stat(self.path).st_mtime_ns
+            except FileNotFoundError:
+                dir_mtime = None
+
+            if periodic or self._names is None or dir_mtime != self._dir_mtime:
+                self._dir_mtime = dir_mtime
+                try:
+                    names = set(name for name in os.listdir(self.path) if is_segment_name(name))
+                except FileNotFoundError:
+                    names = set()
+                if any(name not in names for name in self._scanned):
+                    self._reset()
+                if names != self._names:
+                    self._misses = {}
+                self._names = names
+                self._sealed &= names
+                self._open_names = sorted(name for name in names if name not in self._sealed)
+
+            for name in self._open_names:
+                ## The own active segment is only scanned again after a reset, which drops its records from the index too
+                if name == self._active and name in self._scanned:
+                    continue
+                start = self._scanned.get(name, 0)
+                try:
+                    size = os.stat(self._segment_path(name)).st_size
+                except FileNotFoundError:
+                    continue
+                if size > start or name not in self._scanned:
+                    self._scan(name, start)
+                    self._misses = {}
+                elif periodic:
+                    self._seal(name)
+
+            if periodic:
+                self._open_names = [name for name in self._open_names if name not in self._sealed]
+
+    def _seal(self, name):
+        """
+        Seal a segment if no process holds it as its active segment (see _rotate), after picking up its last records. A new segment is only sealed once it has been written to, as its writer creates it before locking it.
+        """
+        if fcntl is None:
+            return
+        try:
+            fd = os.open(self._segment_path(name), os.O_RDONLY)
+        except FileNotFoundError:
+            return
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            if os.fstat(fd).st_size:
+                self._scan(name, self._scanned.get(name, 0))
+                self._sealed.add(name)
+        finally:
+            os.close(fd)
+
+    def _load_snapshot(self):
+        try:
+            with io.open(self.path.joinpath(index_file_name), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+
+        try:
+            pos = 0
+            n_segments, = snapshot_count_struct.unpack_from(data, pos)
+            pos += snapshot_count_struct.size
+            names = []
+            scanned = {}
+            for _ in range(n_segments):
+                name_len, size = snapshot_segment_struct.unpack_from(data, pos)
+                pos += snapshot_segment_struct.size
+                name = data[pos:pos + name_len].decode()
+                pos += name_len
+                names.append(name)
+                scanned[name] = size
+
+            n_entries, = snapshot_count_struct.unpack_from(data, pos)
+            pos += snapshot_count_struct.size
+            index = {}
+            for key_hash, ts, i, offset, block_len, live in snapshot_entry_struct.iter_unpack(data[pos:pos + n_entries*snapshot_entry_struct.size]):
+                index[key_hash.hex()] = (ts, names[i], offset, block_len, bool(live))
+            if len(index) != n_entries:
+                return
+            pos += n_entries*snapshot_entry_struct.size
+
+            ## Without the dead segments (a snapshot of an older version) the tombstones couldn't be dropped safely
+            n_dead, = snapshot_count_struct.unpack_from(data, pos)
+            pos += snapshot_count_struct.size
+            dead = {}
+            for _ in range(n_dead):
+                key_hash, n = snapshot_dead_struct.unpack_from(data, pos)
+                pos += snapshot_dead_struct.size
+                dead[key_hash.hex()] = tuple(names[i] for i, in snapshot_dead_segment_struct.iter_unpack(data[pos:pos + n*snapshot_dead_segment_struct.size]))
+                pos += n*snapshot_dead_segment_struct.size
+        except (struct.error, IndexError, UnicodeDecodeError):
+            ## A damaged snapshot is ignored; the segments are scanned instead
+            return
+
+        self._index = index
+        self._scanned = scanned
+        self._dead = dead
+
+    def write_snapshot(self):
+        """
+        Save the index so that the next open only needs to scan the segment tails.
+        """
+        with self._lock:
+            names = list(self._scanned)
+            positions = {name: i for i, name in enumerate(names)}
+            parts = [snapshot_count_struct.pack(len(names))]
+            for name in names:
+                name_bytes = name.encode()
+                parts.append(snapshot_segment_struct.pack(len(name_bytes), self._scanned[name]) + name_bytes)
+            parts.append(snapshot_count_struct.pack(len(self._index)))
+            parts.extend(snapshot_entry_struct.pack(bytes.fromhex(key_hash), ts, positions[name], offset, block_len, live) for key_hash, (ts, name, offset, block_len, live) in self._index.items())
+            dead = {key_hash: [positions[name] for name in dead_names if name in positions] for key_hash, dead_names in self._dead.items()}
+            dead = {key_hash: indexes for key_hash, indexes in dead.items() if indexes}
+            parts.append(snapshot_count_struct.pack(len(dead)))
+            parts.extend(snapshot_dead_struct.pack(bytes.fromhex(key_hash), len(indexes)) + b''.join(snapshot_dead_segment_struct.pack(i) for i in indexes) for key_hash, indexes in dead.items())
+
+        tmp_path = self.path.joinpath(index_file_name + '.' + os.urandom(6).hex() + '.tmp')
+        try:
+            with io.open(tmp_path, 'wb') as f:
+                f.write(b''.join(parts))
+            os.replace(tmp_path, self.path.joinpath(index_file_name))
+        except FileNotFoundError:
+            ## The segments were removed (e.g. by clear)
+            pass
+
+    def _rotate(self):
+        """
+        Start a new active segment. The old one is released so that it can be compacted.
+        """
+        if self._active is not None:
+            ## Nothing is appended to it any more
+            self._sealed.add(self._active)
+        self._close_active()
+        name = new_segment_name()
+        fd = os.open(self._segment_path(name), os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_EXCL, 0o666)
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_SH)
+        self._active = name
+        self._active_fd = fd
+        self._active_size = 0
+        self._scanned[name] = 0
+
+    def _close_active(self):
+        if self._active_fd is not None:
+            os.close(self._active_fd)
+            self._active_fd = None
+            self._active = None
+            self._active_size = 0
+
+    def _append(self, key_hash, op, block, ts=None):
+        """
+        Append a record to the active segment with a single write. New records get a timestamp newer than the key's current record; copies made by compaction keep the timestamp of the original. Returns the index entry of the record.
+        """
+        rotated = False
+        with self._lock:
+            if ts is None:
+                ts = time_ns()
+                old = self._index.get(key_hash)
+                if old is not None and ts <= old[0]:
+                    ts = old[0] + 1
+
+            record = record_struct.pack(len(block), ts, op, bytes.fromhex(key_hash)) + block
+            if self._active is None or (self._active_size and self._active_size + len(record) > self.max_segment_size):
+                rotated = self._active is not None
+                self._rotate()
+
+            offset = self._active_size
+            os.write(self._active_fd, record)
+            self._active_size += len(record)
+            self._scanned[self._active] = self._active_size
+            entry = (ts, self._active, offset, len(block), op == op_set)
+            self._apply(key_hash, entry)
+
+        if rotated:
+            self.compact_in_background()
+
+        return entry
+
+    def put(self, key_hash: str, block: bytes):
+        """
+        Store a data block (see utils.make_data_block). Returns the index entry of the new record (the index itself may already hold a newer record written by another process).
+        """
+        return self._append(key_hash, op_set, block)
+
+    def delete(self, key_hash: str, entry=None):
+        """
+        Add a tombstone if the key has a live record (or only if its record is still the given index entry). Returns the index entry of the tombstone, or None if none was added.
+        """
+        with self._lock:
+            current = self.find(key_hash)
+            if current is None or (entry is not None and current != entry):
+                return None
+            return self._append(key_hash, op_delete, b'')
+
+    def lookup_any(self, key_hash: str):
+        """
+        The index entry of the newest record of a key (including tombstones) or None.
+        """
+        return self._index.get(key_hash)
+
+    def lookup(self, key_hash: str):
+        """
+        The index entry of the live record of a key or None.
+        """
+        entry = self._index.get(key_hash)
+        if entry is not None and entry[4]:
+            return entry
+        else:
+            return None
+
+    def find(self, key_hash: str, fresh: bool=True):
+        """
+        Like lookup, but refreshes the index from the segments first (periodically, or always with a miss). With fresh=False (for reads) a key that was found missing less than refresh_interval seconds ago isn't checked again.
+        """
+        self.refresh()
+        entry = self.lookup(key_hash)
+        if entry is None:
+            now = monotonic()
+            missed = self._misses.get(key_hash)
+            if fresh or missed is None or now - missed >= refresh_interval:
+                self.refresh(True)
+                entry = self.lookup(key_hash)
+                if entry is None:
+                    if len(self._misses) >= miss_cache_size:
+                        self._misses = {}
+                    self._misses[key_hash] = now
+
+        return entry
+
+    def segment_path(self, entry):
+        return self._segment_path(entry[1])
+
+    def _get_fd(self, name):
+        with self._lock:
+            fd = self._read_fds.get(name)
+            if fd is None:
+                fd = os.open(self._segment_path(name), os.O_RDONLY)
+                self._read_fds[name] = fd
+
+        return fd
+
+    def read_block(self, entry):
+        """
+        Read the data block of an index entry with a single pread. Returns the key, value position, value length, fields and the block as a memoryview, or None if the segment has been removed in the meantime.
+        """
+        ts, name, offset, block_len, live = entry
+        try:
+            data = os.pread(self._get_fd(name), record_struct.size + block_len, offset)
+        except FileNotFoundError:
+            return None
+        if len(data) < record_struct.size + block_len:
+            return None
+
+        block = memoryview(data)[record_struct.size:]
+        key, value_pos, value_len, fields = utils.parse_data_block(block, self._n_bytes_key, self._n_bytes_value)
+
+        return key, value_pos, value_len, fields, block
+
+    def get_block(self, key_hash: str, fresh: bool=True):
+        """
+        Read the data block of the live record of a key. Returns the index entry and the output of read_block, or None if the key has no live record. See find for fresh.
+        """
+        entry = self.find(key_hash, fresh)
+        if entry is None:
+            return None
+
+        result = self.read_block(entry)
+        if result is None:
+            ## The segment was compacted away; the record has moved
+            self.refresh(True)
+            entry = self.lookup(key_hash)
+            if entry is None:
+                return None
+            result = self.read_block(entry)
+            if result is None:
+                return None
+
+        return entry, result
+
+    def live_entries(self):
+        """
+        A dict of key hash -> index entry of all the live records.
+        """
+        self.refresh()
+        with self._lock:
+            return {key_hash: entry for key_hash, entry in self._index.items() if entry[4]}
+
+    def iter_blocks(self, entries=None):
+        """
+        Generate (key hash, index entry, read_block output) for the live records, reading each segment in one go.
+        """
+        if entries is None:
+            entries = self.live_entries()
+
+        by_segment = defaultdict(list)
+        for key_hash, entry in entries.items():
+            by_segment[entry[1]].append((entry[2], key_hash, entry))
+
+        for name in sorted(by_segment):
+            try:
+                with io.open(self._segment_path(name), 'rb') as f:
+                    data = memoryview(f.read())
+            except FileNotFoundError:
+                ## Compacted in the meantime, so read the records one by one from where they are now
+                self.refresh(True)
+                for offset, key_hash, entry in by_segment[name]:
+                    found = self.get_block(key_hash)
+                    if found is not None:
+                        yield key_hash, found[0], found[1]
+                continue
+
+            for offset, key_hash, entry in sorted(by_segment[name]):
+                block = data[offset + record_struct.size:offset + record_struct.size + entry[3]]
+                key, value_pos, value_len, fields = utils.parse_data_block(block, self._n_bytes_key, self._n_bytes_value)
+                yield key_hash, entry, (key, value_pos, value_len, fields, block)
+
+    def compact(self, min_dead_ratio: float=compact_min_dead_ratio):
+        """
+        Copy the live records (and tombstones) of the segments that are at least min_dead_ratio overwritten or deleted into the active segment and remove them. Segments that are being written by a process (including this one) are skipped. Returns the number of bytes reclaimed.
+        """
+        if not self._write:
+            raise ValueError('File is open for read only.')
+
+        reclaimed = 0
+        with self._compact_lock:
+            self.refresh(True)
+            with self._lock:
+                entries = defaultdict(list)
+                for key_hash, entry in self._index.items():
+                    entries[entry[1]].append((key_hash, entry))
+                names = [name for name in sorted(self._scanned) if name != self._active]
+
+            for name in names:
+                segment_path = self._segment_path(name)
+                live_bytes = sum(record_struct.size + entry[3] for key_hash, entry in entries[name])
+                try:
+                    fd = os.open(segment_path, os.O_RDONLY)
+                except FileNotFoundError:
+                    continue
+                try:
+                    size = os.fstat(fd).st_size
+                    if not size or (size - live_bytes)/size < min_dead_ratio:
+                        continue
+                    if fcntl is not None:
+                        try:
+                            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        except BlockingIOError:
+                            ## Still the active segment of a writer
+                            continue
+
+                    ## Pick up anything appended since the last refresh
+                    with self._lock:
+                        self._scan(name, self._scanned.get(name, 0))
+                        moving = [(key_hash, entry) for key_hash, entry in self._index.items() if entry[1] == name]
+                        ## A tombstone is only needed while another segment holds an older record of its key
+                        dropped = [(key_hash, entry) for key_hash, entry in moving if not entry[4] and not self._has_older_records(key_hash, name)]
+                        if dropped:
+                            dropped_hashes = set(key_hash for key_hash, entry in dropped)
+                            moving = [item for item in moving if item[0] not in dropped_hashes]
+
+                    data = os.pread(fd, size, 0)
+                    for key_hash, (ts, _, offset, block_len, live) in sorted(moving, key=lambda item: item[1][2]):
+                        block = data[offset + record_struct.size:offset + record_struct.size + block_len]
+                        self._append(key_hash, op_set if live else op_delete, block, ts)
+
+                    os.unlink(segment_path)
+                    reclaimed += size - live_bytes
+                finally:
+                    os.close(fd)
+
+                with self._lock:
+                    self._scanned.pop(name, None)
+                    self._sealed.discard(name)
+                    if self._names is not None:
+                        self._names.discard(name)
+                    self._forget_segment(name, data)
+                    for key_hash, entry in dropped:
+                        if self._index.get(key_hash) == entry:
+                            del self._index[key_hash]
+                    read_fd = self._read_fds.pop(name, None)
+                    if read_fd is not None:
+                        os.close(read_fd)
+
+            if reclaimed:
+                self.write_snapshot()
+
+        return reclaimed
+
+    def _background_compact(self):
+        try:
+            self.compact()
+        except Exception:
+            pass
+
+    def compact_in_background(self):
+        """
+        Run compact on a background thread unless one is already running.
+        """
+        if self._compact_thread is None or not self._compact_thread.is_alive():
+            self._compact_thread = Thread(target=self._background_compact, name='filedbm-compact', daemon=True)
+            self._compact_thread.start()
+
+    def clear(self):
+        """
+        Remove all the segments.
+        """
+        with self._compact_lock, self._lock:
+            self._close_active()
+            self._reset()
+            self._names = None
+            try:
+                names = os.listdir(self.path)
+            except FileNotFoundError:
+                return
+            for name in names:
+                try:
+                    os.unlink(self._segment_path(name))
+                except FileNotFoundError:
+                    pass
+
+    def sync(self):
+        """
+        fsync the active segment.
+        """
+        with self._lock:
+            if self._active_fd is not None:
+                os.fsync(self._active_fd)
+
+    def after_fork(self):
+        """
+        A forked child starts its own active segment. Closing the inherited fd doesn't release the parent's flock, as the parent still has the file open.
+        """
+        self._lock = RLock()
+        self._compact_lock = Lock()
+        self._compact_thread = None
+        self._close_active()
+
+    def close(self):
+        if self._compact_thread is not None:
+            self._compact_thread.join()
+            self._compact_thread = None
+        with self._lock:
+            if self._write:
+                self.write_snapshot()
+            self._close_active()
+            for fd in self._read_fds.values():
+                os.close(fd)
+            self._read_fds = {}
+
+
+#######################################################
+### Functions
+
+
+def new_segment_name():
+    """
+    Segment names start with the creation time so they sort by age. The pid and random suffix keep the names of concurrent writers apart.
+    """
+    return '{:020d}-{}-{}'.format(time_ns(), os.getpid(), os.urandom(3).hex())
+
+
+def is_segment_name(name):
+    return name[:20].isdigit() and name.count('-') == 2 and not name.endswith('.tmp')
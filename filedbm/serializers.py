@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Value serializers.
+
+A serializer turns objects into values on set and values (FileObjectReadSlices) back into objects on get. pickle, json and raw bytes are always available; msgpack and numpy are used when the msgpack and numpy packages are installed. The serializer isn't recorded in the database, so the same one must be used for reading and writing a value.
+"""
+import io
+import json
+import pickle
+
+from .registry import Registry
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+#######################################################
+### Classes
+
+
+class Serializer:
+    """
+    dumps(obj) returns bytes or a file object to be written and loads(value) creates the object from a FileObjectReadSlice. loads is responsible for closing the value.
+    """
+    def __init__(self, name: str, dumps, loads):
+        self.name = name
+        self.dumps = dumps
+        self.loads = loads
+
+
+class BuffersReader(io.IOBase):
+    """
+    A read-only file object over a sequence of buffers, so that a value made of several parts (e.g. a header and an array's memory) can be written without joining them into one copy first.
+    """
+    def __init__(self, buffers):
+        self._buffers = [memoryview(buffer).cast('B') for buffer in buffers]
+        self.length = sum(len(buffer) for buffer in self._buffers)
+        self.offset = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.offset = offset
+        elif whence == io.SEEK_CUR:
+            self.offset += offset
+        elif whence == io.SEEK_END:
+            self.offset = self.length + offset
+        else:
+            raise IOError(offset, whence)
+        return self.offset
+
+    def tell(self):
+        return self.offset
+
+    def read(self, size=-1):
+        if size < 0:
+            size = self.length - self.offset
+        end = min(self.offset + size, self.length)
+
+        out = []
+        pos = 0
+        for buffer in self._buffers:
+            buffer_end = pos + len(buffer)
+            if buffer_end > self.offset and pos < end:
+                out.append(buffer[max(self.offset - pos, 0):end - pos])
+            pos = buffer_end
+            if pos >= end:
+                break
+        self.offset = max(self.offset, end)
+
+        return b''.join(out)
+
+
+#######################################################
+### Functions
+
+
+def read_value(value):
+    """
+    Read a whole value and close it.
+    """
+    try:
+        return value.read()
+    finally:
+        value.close()
+
+
+def bytes_dumps(obj):
+    if isinstance(obj, (bytes, io.IOBase)):
+        return obj
+    else:
+        return bytes(obj)
+
+
+def pickle_dumps(obj):
+    return pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def pickle_loads(value):
+    return pickle.loads(read_value(value))
+
+
+def json_dumps(obj):
+    return json.dumps(obj).encode()
+
+
+def json_loads(value):
+    return json.loads(read_value(value))
+
+
+def msgpack_dumps(obj):
+    return msgpack.packb(obj)
+
+
+def msgpack_loads(value):
+    return msgpack.unpackb(read_value(value))
+
+
+def numpy_dumps(arr):
+    """
+    Arrays are stored in the .npy format. The array's memory is written directly after the header without making a copy (unless it isn't contiguous).
+    """
+    arr = np.asanyarray(arr)
+    if arr.dtype.hasobject:
+        raise ValueError('numpy arrays of Python objects cannot be stored with the numpy serializer. Use pickle instead.')
+    if not (arr.flags.c_contiguous or arr.flags.f_contiguous):
+        arr = np.ascontiguousarray(arr)
+
+    header = io.BytesIO()
+    header_data = np.lib.format.header_data_from_array_1_0(arr)
+    try:
+        np.lib.format.write_array_header_1_0(header, header_data)
+    except ValueError:
+        ## The header is too large for version 1.0
+        header = io.BytesIO()
+        np.lib.format.write_array_header_2_0(header, header_data)
+
+    return BuffersReader([header.getvalue(), arr.ravel(order='K')])
+
+
+def numpy_loads(value):
+    """
+    The array is created over the value's buffer, which for a large value is a read-only memory map of the data file. So it loads in constant time and memory and the pages are only read as they are used. The array is read-only and keeps the mapping alive for as long as it exists.
+    """
+    version = np.lib.format.read_magic(value)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(value)
+    elif version == (2, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(value)
+    else:
+        value.close()
+        raise ValueError('Unsupported .npy format version: ' + str(version))
+
+    count = 1
+    for dim in shape:
+        count *= dim
+
+    buffer = value.view(count*dtype.itemsize)
+    arr = np.frombuffer(buffer, dtype, count).reshape(shape, order='F' if fortran_order else 'C')
+    value.close()
+
+    return arr
+
+
+registry = Registry('serializer', 'serializer', [
+    Serializer('bytes', bytes_dumps, read_value),
+    Serializer('pickle', pickle_dumps, pickle_loads),
+    Serializer('json', json_dumps, json_loads),
+    Serializer('msgpack', msgpack_dumps, msgpack_loads),
+    Serializer('numpy', numpy_dumps, numpy_loads),
+    ], None, {'msgpack': ('msgpack', msgpack), 'numpy': ('numpy', np)})
+
+serializers = registry.items
+serializer_available = registry.available
+
+
+def get_serializer(serializer):
+    """
+    Get a serializer by name. A Serializer object is returned as is, so custom serializers can be used too.
+    """
+    if isinstance(serializer, Serializer):
+        return serializer
+
+    return registry.get(serializer, ('a Serializer',))
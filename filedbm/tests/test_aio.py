@@ -0,0 +1,83 @@
+import os
+import time
+import asyncio
+
+import pytest
+
+import filedbm
+from filedbm import aio, utils
+
+
+def open_fds():
+    return len(os.listdir('/proc/self/fd'))
+
+
+def test_get_set_delete(tmp_path):
+    async def main():
+        async with await filedbm.open_async(tmp_path, 'n') as db:
+            await db.set('a', b'1')
+            await db.set_many({'b': b'2', 'c': b'3'})
+            value = await db.get('a')
+            assert await value.read() == b'1'
+            assert await db.contains('b')
+            await db.delete('b')
+            assert await db.get('b') is None
+            assert sorted([key async for key in db.keys()]) == ['a', 'c']
+            assert await db.len() == 2
+
+    asyncio.run(main())
+
+
+def test_get_many_serializer(tmp_path):
+    async def main():
+        async with await filedbm.open_async(tmp_path, 'n') as db:
+            await db.set('a', {'x': 1}, serializer='json')
+            assert await db.get_many(['a', 'missing'], serializer='json') == [{'x': 1}, None]
+
+    asyncio.run(main())
+
+
+def test_get_many_in_chunks(tmp_path, monkeypatch):
+    monkeypatch.setattr(aio, 'iter_max_open_values', 4)
+
+    async def main():
+        async with await filedbm.open_async(tmp_path, 'n', max_workers=32) as db:
+            await db.set_many({str(i): str(i).encode() for i in range(50)})
+            get_prefetched = db.db._get_prefetched
+            running = []
+            max_running = []
+
+            def counted(*args):
+                running.append(1)
+                max_running.append(len(running))
+                time.sleep(0.01)
+                running.pop()
+                return get_prefetched(*args)
+
+            db.db._get_prefetched = counted
+            values = await db.get_many([str(i) for i in range(50)] + ['missing'])
+            assert [await value.read() for value in values[:-1]] == [str(i).encode() for i in range(50)]
+            assert values[-1] is None
+            assert max(max_running) <= 4
+
+    asyncio.run(main())
+
+
+@pytest.mark.skipif(not os.path.isdir('/proc/self/fd'), reason='needs /proc')
+@pytest.mark.parametrize('kwargs', [{}, {'prefix': 'k'}, {'keys': ['k{:03d}'.format(i) for i in range(300)]}])
+def test_items_bound_open_files(tmp_path, kwargs):
+    large = b'x'*(2*utils.pread_max_size)
+
+    async def main():
+        async with await filedbm.open_async(tmp_path, 'n', manifest=True) as db:
+            await db.set_many({'k{:03d}'.format(i): large for i in range(300)})
+            base = open_fds()
+            n = 0
+            async for key, value in db.items(**kwargs):
+                assert open_fds() - base <= 2*aio.iter_max_open_values
+                assert len(await value.read(10)) == 10
+                await value.close()
+                n += 1
+            assert n == 300
+
+    asyncio.run(main())
@@ -0,0 +1,138 @@
+import os
+import time
+
+import pytest
+
+import filedbm
+from filedbm import batch, utils
+
+
+def batches_dir(db_path):
+    return db_path.joinpath(utils.sys_dir_name, batch.batches_dir_name)
+
+
+def commit_without_applying(db, sets=(), deletes=()):
+    """
+    Commit a batch like a process that dies right after the commit point.
+    """
+    b = db.batch()
+    for key, value in sets:
+        b[key] = value
+    for key in deletes:
+        del b[key]
+    ops = [(key,) + op for key, op in b._ops.items()]
+    batch.write_log(b.path, ops, False)
+    os.close(b._lock_fd)
+
+    return b
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'manifest': True, 'durability': 'group'}, {'segment_max_value_size': 100}])
+def test_batch(tmp_path, kwargs):
+    with filedbm.open(tmp_path, 'n', **kwargs) as db:
+        db['gone'] = b'1'
+        with db.batch() as b:
+            b['a'] = b'x'*1000
+            b.set('b', b'y', ttl=100)
+            del b['gone']
+            del b['missing']
+            assert 'a' not in db
+            assert 'gone' in db
+        assert db['a'].read() == b'x'*1000
+        assert db['b'].read() == b'y'
+        assert 'gone' not in db
+        assert os.listdir(batches_dir(tmp_path)) == []
+
+
+def test_abort(tmp_path):
+    with filedbm.open(tmp_path, 'n') as db:
+        with pytest.raises(RuntimeError):
+            with db.batch() as b:
+                b['a'] = b'x'
+                raise RuntimeError
+        assert 'a' not in db
+        assert os.listdir(batches_dir(tmp_path)) == []
+
+
+def test_recovery(tmp_path):
+    with filedbm.open(tmp_path, 'n', manifest=True) as db:
+        db['old'] = b'1'
+        commit_without_applying(db, [('k1', b'v1'), ('k2', b'v2')], ['old'])
+        ## Never committed
+        b = db.batch()
+        b['k3'] = b'v3'
+        os.close(b._lock_fd)
+
+    with filedbm.open(tmp_path, 'w') as db:
+        assert db['k1'].read() == b'v1'
+        assert 'old' not in db
+        assert 'k3' not in db
+        assert sorted(db.keys()) == ['k1', 'k2']
+        assert os.listdir(batches_dir(tmp_path)) == []
+
+
+def test_readers_see_committed_batch(tmp_path):
+    with filedbm.open(tmp_path, 'n') as db:
+        db['old'] = b'1'
+        db['k1'] = b'before'
+        commit_without_applying(db, [('k1', b'v1'), ('k2', b'v2')], ['old'])
+
+        with filedbm.open(tmp_path, 'r') as reader:
+            assert reader['k1'].read() == b'v1'
+            assert reader['k2'].read() == b'v2'
+            assert 'k2' in reader
+            assert 'old' not in reader
+            assert reader.get('old') is None
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'segment_max_value_size': 100}])
+def test_replay_skips_newer_writes(tmp_path, kwargs):
+    with filedbm.open(tmp_path, 'n', **kwargs) as db:
+        db['old'] = b'1'
+        db['deleted'] = b'1'
+        commit_without_applying(db, [('new', b'batch'), ('deleted', b'batch')], ['old'])
+        time.sleep(0.05)
+        ## Written after the commit, before the batch was replayed
+        db['new'] = b'later'
+        db['old'] = b'later'
+        assert db['new'].read() == b'later'
+        assert db['old'].read() == b'later'
+
+    with filedbm.open(tmp_path, 'w', **kwargs) as db:
+        assert db['new'].read() == b'later'
+        assert db['old'].read() == b'later'
+        assert db['deleted'].read() == b'batch'
+
+
+def test_bloom_knows_pending_keys(tmp_path, monkeypatch):
+    with filedbm.open(tmp_path, 'n', bloom_fpr=0.01) as db:
+        ## The process dies between the commit and applying the batch
+        monkeypatch.setattr(db, '_apply_batch', lambda *args: None)
+        with db.batch() as b:
+            b['new'] = b'v'
+        with filedbm.open(tmp_path, 'r') as reader:
+            assert reader['new'].read() == b'v'
+            assert 'new' in reader
+
+
+def test_reads_skip_batch_checks(tmp_path, monkeypatch):
+    monkeypatch.setattr(batch, 'dir_mtime_margin', 0)
+    with filedbm.open(tmp_path, 'n', bloom_fpr=0.01) as db:
+        db['a'] = b'x'
+        with filedbm.open(tmp_path, 'r') as reader:
+            assert reader['a'].read() == b'x'
+            stats = []
+            stat = os.stat
+            monkeypatch.setattr(os, 'stat', lambda path, *args, **kwargs: (stats.append(path), stat(path, *args, **kwargs))[1])
+
+            ## Keys ruled out by the Bloom filter don't touch the filesystem
+            for i in range(200):
+                assert reader.get('miss-{}'.format(i)) is None
+                assert 'miss-{}'.format(i) not in reader
+            assert not stats
+
+            ## Reading an existing value doesn't check the batches folder again
+            for _ in range(100):
+                assert reader['a'].read() == b'x'
+                assert 'a' in reader
+            assert batches_dir(tmp_path) not in stats
@@ -0,0 +1,29 @@
+import json
+
+from filedbm import bench
+
+
+def test_parse_numbers():
+    assert bench.parse_numbers('1k,10,2M') == [1000, 10, 2000000]
+
+
+def test_run_and_compare(tmp_path, capsys):
+    report = bench.run([20], [100, 1000], base_path=tmp_path)
+    ops = {r['op'] for r in report['results']}
+    assert ops == set(bench.operations)
+    assert {(r['n_keys'], r['value_size']) for r in report['results']} == {(20, 100), (20, 1000)}
+
+    comparisons = bench.compare(report, report)
+    assert comparisons
+    assert not any(c['regression'] for c in comparisons)
+
+    faster = json.loads(json.dumps(report))
+    for r in faster['results']:
+        if r['items_per_s']:
+            r['items_per_s'] *= 1000
+    assert all(c['regression'] for c in bench.compare(report, faster))
+
+    baseline_path = tmp_path.joinpath('baseline.json')
+    baseline_path.write_text(json.dumps(faster))
+    assert bench.main(['--keys', '20', '--sizes', '100', '--ops', 'set,get', '--path', str(tmp_path), '--output', str(tmp_path.joinpath('out.json')), '--baseline', str(baseline_path), '--fail-on-regression']) == 1
+    assert {r['op'] for r in json.loads(tmp_path.joinpath('out.json').read_text())['results']} == {'set', 'get'}
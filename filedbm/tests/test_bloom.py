@@ -0,0 +1,98 @@
+import pytest
+
+import filedbm
+from filedbm import bloom, utils
+
+
+def filled_positions(db):
+    mm, m, k = db._bloom._filter
+    return mm[bloom.header_struct.size:].count(1)
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'segment_max_value_size': 100}, {'manifest': True}])
+def test_no_false_negatives(tmp_path, kwargs):
+    with filedbm.open(tmp_path, 'n', bloom_fpr=0.01, **kwargs) as db:
+        for i in range(3000):
+            db[str(i)] = b'x'
+        assert all(str(i) in db for i in range(3000))
+        misses = sum(db._bloom.might_contain(utils.hash_key('miss-{}'.format(i).encode())) for i in range(10000))
+        assert misses < 10000*0.1
+        del db['1']
+        assert '1' not in db
+
+    with filedbm.open(tmp_path, 'r') as db:
+        assert '2' in db
+        assert db.get('miss') is None
+
+
+def test_fill_count(tmp_path):
+    with filedbm.open(tmp_path, 'n', bloom_fpr=0.01) as db:
+        for i in range(500):
+            db[str(i)] = b'x'
+        n_set, = bloom.count_struct.unpack_from(db._bloom._filter[0], bloom.count_pos)
+        assert n_set == filled_positions(db)
+        db.rebuild_bloom()
+        n_set, = bloom.count_struct.unpack_from(db._bloom._filter[0], bloom.count_pos)
+        assert n_set == filled_positions(db)
+
+
+def test_writer_opened_before_the_filter(tmp_path):
+    old = filedbm.open(tmp_path, 'n')
+    old['before'] = b'x'
+    with filedbm.open(tmp_path, 'w', bloom_fpr=0.01):
+        pass
+    old['after'] = b'x'
+    with filedbm.open(tmp_path, 'r') as reader:
+        assert reader._bloom is not None
+        assert 'before' in reader
+        assert 'after' in reader
+    old.close()
+
+
+def test_keys_written_during_rebuild(tmp_path):
+    db = filedbm.open(tmp_path, 'n', bloom_fpr=0.01)
+    other = filedbm.open(tmp_path, 'w')
+    db['a'] = b'x'
+    iter_key_hashes = db._iter_key_hashes
+    calls = []
+
+    def key_hashes():
+        calls.append(1)
+        if len(calls) == 2:
+            ## Written by another instance while the new filter is being filled
+            other['during'] = b'x'
+        return iter_key_hashes()
+
+    db._bloom.build(key_hashes)
+    with filedbm.open(tmp_path, 'r') as reader:
+        assert 'during' in reader
+        assert 'a' in reader
+    other.close()
+    db.close()
+
+
+def test_writes_check_for_the_filter_on_a_timer(tmp_path, monkeypatch):
+    from filedbm import main
+
+    calls = []
+    exists = main.bloom_filter_exists
+    monkeypatch.setattr(main, 'bloom_filter_exists', lambda db_path: calls.append(1) or exists(db_path))
+    with filedbm.open(tmp_path, 'n') as db:
+        for i in range(100):
+            db[str(i)] = b'x'
+    assert len(calls) <= 2
+
+    with filedbm.open(tmp_path, 'w', bloom_fpr=0.01) as db:
+        stat = bloom.os.stat
+
+        def counted_stat(path, *args, **kwargs):
+            if str(path).endswith(bloom.bloom_file_name):
+                calls.append(path)
+            return stat(path, *args, **kwargs)
+
+        monkeypatch.setattr(bloom.os, 'stat', counted_stat)
+        calls.clear()
+        for i in range(100):
+            db[str(i)] = b'x'
+        assert not calls
+        assert all(str(i) in db for i in range(100))
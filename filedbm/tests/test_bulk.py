@@ -0,0 +1,46 @@
+import pytest
+
+import filedbm
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'max_workers': 8}, {'segment_max_value_size': 100}, {'manifest': True}])
+def test_bulk_operations(tmp_path, kwargs):
+    with filedbm.open(tmp_path, 'n', **kwargs) as db:
+        assert db.set_many({str(i): str(i).encode()*3 for i in range(300)}) == [None]*300
+        assert len(db) == 300
+
+        values = db.get_many(['1', 'missing', '299'], default='D')
+        assert values[0].read() == b'111'
+        assert values[1] == 'D'
+        assert values[2].read() == b'299'*3
+
+        assert db.contains_many(['1', 'missing']) == [True, False]
+        results = db.delete_many(['1', 'missing'])
+        assert results[0] is None
+        assert isinstance(results[1], KeyError)
+        assert '1' not in db
+        assert len(db) == 299
+
+        assert [(key, value.read()) for key, value in db.items(keys=['2', '3'])] == [('2', b'222'), ('3', b'333')]
+        assert db.set_many([]) == []
+
+
+def test_set_many_reports_errors(tmp_path):
+    with filedbm.open(tmp_path, 'n') as db:
+        results = db.set_many([('a', b'1'), ('b', 5)])
+        assert results[0] is None
+        assert isinstance(results[1], Exception)
+        assert db['a'].read() == b'1'
+        assert 'b' not in db
+
+        db.update({'z': b'zz'})
+        assert db['z'].read() == b'zz'
+
+
+def test_read_only(tmp_path):
+    filedbm.open(tmp_path, 'n').close()
+    with filedbm.open(tmp_path, 'r') as db:
+        with pytest.raises(ValueError):
+            db.set_many({'a': b'1'})
+        with pytest.raises(ValueError):
+            db.delete_many(['a'])
@@ -0,0 +1,58 @@
+import filedbm
+
+
+def test_hits_and_limits(tmp_path):
+    with filedbm.open(tmp_path, 'n', cache_size=1000, cache_max_value_size=300) as db:
+        for i in range(20):
+            db[str(i)] = b'x'*100
+        db['big'] = b'y'*500
+
+        for _ in range(3):
+            for i in range(5):
+                assert db[str(i)].read() == b'x'*100
+        info = db.cache_info()
+        assert info['misses'] == 5
+        assert info['hits'] == 10
+        assert info['entries'] == 5
+        assert info['size'] == 500
+
+        ## Values over cache_max_value_size are never cached
+        db['big'].read()
+        db['big'].read()
+        assert db.cache_info()['misses'] == 7
+
+        ## The cache is bounded by cache_size (LRU eviction)
+        for i in range(20):
+            db[str(i)].read()
+        info = db.cache_info()
+        assert info['size'] <= 1000
+        assert info['evictions'] > 0
+
+
+def test_invalidated_by_other_writers(tmp_path):
+    db = filedbm.open(tmp_path, 'n', cache_size=10000)
+    db['a'] = b'old'
+    assert db['a'].read() == b'old'
+    with filedbm.open(tmp_path, 'w') as other:
+        other['a'] = b'new value'
+    assert db['a'].read() == b'new value'
+
+    db['a'] = b'own write'
+    assert db['a'].read() == b'own write'
+    del db['a']
+    assert db.get('a') is None
+    db.close()
+
+
+def test_cached_values_are_handles(tmp_path):
+    with filedbm.open(tmp_path, 'n', cache_size=10000) as db:
+        db['a'] = b'abcdef'
+        db['a'].read()
+        value = db['a']
+        assert bytes(value.view(3)) == b'abc'
+        assert value.read() == b'def'
+
+
+def test_disabled(tmp_path):
+    with filedbm.open(tmp_path, 'n') as db:
+        assert db.cache_info() is None
@@ -0,0 +1,92 @@
+import os
+
+import pytest
+
+import filedbm
+from filedbm import checksums, compression, segments, utils
+
+algorithms = [name for name in checksums.checksums if checksums.checksum_available(name)]
+
+
+def flip_byte(file_path, pos):
+    with open(file_path, 'r+b') as f:
+        f.seek(pos)
+        byte = f.read(1)
+        f.seek(pos)
+        f.write(bytes((byte[0] ^ 1,)))
+
+
+@pytest.mark.parametrize('algorithm', algorithms)
+@pytest.mark.parametrize('kwargs', [{}, {'compression': 'zlib'}, {'segment_max_value_size': 1000}, {'dedup': True}])
+def test_checksums_verify(tmp_path, algorithm, kwargs):
+    values = {'a': b'x'*10, 'b': b'hello '*2000, 'c': os.urandom(10000)}
+    with filedbm.open(tmp_path, 'n', checksum=algorithm, verify_checksums=True, **kwargs) as db:
+        for key, value in values.items():
+            db[key] = value
+        with db.batch() as b:
+            b['d'] = b'batch'*1000
+        values['d'] = b'batch'*1000
+        for key, value in values.items():
+            assert db[key].read() == value
+        result = db.verify()
+        assert result['checked'] >= 4
+        assert result['unverified'] == 0
+        assert result['corrupt'] == []
+
+
+def test_corruption_and_quarantine(tmp_path):
+    with filedbm.open(tmp_path, 'n', checksum='crc32', manifest=True) as db:
+        db['bad'] = b'a'*1000
+        db['short'] = b'b'*1000
+        db['good'] = b'c'*1000
+    flip_byte(utils.key_file_path(tmp_path, utils.hash_key(b'bad')), 20)
+    short_path = utils.key_file_path(tmp_path, utils.hash_key(b'short'))
+    os.truncate(short_path, 500)
+
+    with filedbm.open(tmp_path, 'r', verify_checksums=True) as db:
+        with pytest.raises(checksums.ChecksumError):
+            db['bad'].read()
+        assert db['good'].read() == b'c'*1000
+        result = db.verify()
+        assert {problem['problem'] for problem in result['corrupt']} == {'checksum mismatch', 'truncated'}
+        assert len(db.verify(processes=True, max_workers=2)['corrupt']) == 2
+
+    ## Without verify_checksums the damaged value is served as is
+    with filedbm.open(tmp_path, 'r') as db:
+        assert len(db['bad'].read()) == 1000
+
+    with filedbm.open(tmp_path, 'w') as db:
+        assert db.verify(quarantine=True)['quarantined'] == 2
+        assert sorted(db.keys()) == ['good']
+        assert db.verify()['corrupt'] == []
+    assert len(os.listdir(tmp_path.joinpath(utils.sys_dir_name, utils.quarantine_dir_name))) == 2
+
+
+def test_corrupt_segment_record(tmp_path):
+    with filedbm.open(tmp_path, 'n', checksum='blake2b', segment_max_value_size=100) as db:
+        db['s'] = b's'*50
+        db['t'] = b't'*50
+    segments_path = tmp_path.joinpath(utils.sys_dir_name, segments.segments_dir_name)
+    for name in os.listdir(segments_path):
+        data = segments_path.joinpath(name).read_bytes()
+        pos = data.find(b's'*50)
+        if pos >= 0:
+            flip_byte(segments_path.joinpath(name), pos + 3)
+
+    with filedbm.open(tmp_path, 'w', segment_max_value_size=100, verify_checksums=True) as db:
+        with pytest.raises(checksums.ChecksumError):
+            db['s'].read()
+        assert db.verify(quarantine=True)['quarantined'] == 1
+        assert sorted(db.keys()) == ['t']
+
+
+def test_registries():
+    with pytest.raises(ValueError):
+        checksums.get_checksum('md5')
+    with pytest.raises(ValueError):
+        compression.get_codec('brotli')
+    with pytest.raises(ValueError):
+        checksums.get_checksum_by_id(200)
+    assert checksums.get_checksum_by_id(checksums.get_checksum('crc32').checksum_id).name == 'crc32'
+    assert compression.get_codec_by_id(compression.get_codec('zlib').codec_id).name == 'zlib'
+    assert compression.get_codec('auto').name in ('zstd', 'zlib')
@@ -0,0 +1,72 @@
+import io
+import os
+
+import pytest
+
+import filedbm
+from filedbm import compression, utils
+
+codecs = [name for name in compression.codecs if compression.codec_available(name)]
+
+
+def stored_size(db_path, key):
+    return os.path.getsize(utils.key_file_path(db_path, utils.hash_key(key.encode())))
+
+
+@pytest.mark.parametrize('codec', codecs + ['auto'])
+def test_round_trip(tmp_path, codec):
+    data = b''.join(str(i).encode() for i in range(100000))
+    random_data = os.urandom(5000)
+    with filedbm.open(tmp_path, 'n', compression=codec, buffer_size=1000) as db:
+        db['big'] = data
+        db['small'] = b'abc'
+        db['random'] = random_data
+        db['file'] = io.BytesIO(data)
+
+        value = db['big']
+        assert value.length == len(data)
+        assert value.read(10) == data[:10]
+        value.seek(100000)
+        assert value.read(5) == data[100000:100005]
+        value.seek(3)
+        assert value.read(4) == data[3:7]
+        value.seek(0)
+        assert value.read() == data
+        buf = bytearray(20)
+        db['big'].readinto(buf)
+        assert bytes(buf) == data[:20]
+
+        assert db['file'].read() == data
+        assert db['random'].read() == random_data
+        assert db['small'].read() == b'abc'
+
+        assert stored_size(tmp_path, 'big') < len(data)
+        ## Incompressible values are stored as is
+        assert stored_size(tmp_path, 'random') < len(random_data) + 100
+
+    ## Reading doesn't need the compression option
+    with filedbm.open(tmp_path, 'r') as db:
+        assert db['big'].read() == data
+        assert sorted(db.keys()) == ['big', 'file', 'random', 'small']
+
+
+def test_mixed_codecs(tmp_path):
+    data = b'abc'*10000
+    with filedbm.open(tmp_path, 'n') as db:
+        db['plain'] = data
+    with filedbm.open(tmp_path, 'w', compression='zlib') as db:
+        db['zlib'] = data
+        assert db['plain'].read() == data
+        assert db['zlib'].read() == data
+    assert stored_size(tmp_path, 'zlib') < stored_size(tmp_path, 'plain')
+
+
+def test_min_size(tmp_path):
+    with filedbm.open(tmp_path, 'n', compression='zlib', compression_min_size=10000) as db:
+        db['a'] = b'a'*5000
+        assert stored_size(tmp_path, 'a') > 5000
+
+
+def test_unknown_codec(tmp_path):
+    with pytest.raises(ValueError):
+        filedbm.open(tmp_path, 'n', compression='brotli')
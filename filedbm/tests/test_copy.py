@@ -0,0 +1,67 @@
+import io
+import os
+import socket
+import threading
+
+import pytest
+
+import filedbm
+
+data = os.urandom(3000000)
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'compression': 'zlib'}, {'dedup': True}, {'segment_max_value_size': 4000000}, {'cache_size': 10**7, 'cache_max_value_size': 10**7}])
+def test_ingest_and_export(tmp_path, kwargs):
+    src = tmp_path.joinpath('src.bin')
+    src.write_bytes(data)
+    out = tmp_path.joinpath('out.bin')
+
+    with filedbm.open(tmp_path.joinpath('db'), 'n', **kwargs) as db:
+        db['path'] = src
+        with open(src, 'rb') as f:
+            f.read(10)
+            f.seek(0)
+            db['file'] = f
+            if not kwargs.get('dedup'):
+                ## The position of the source file is moved past the copied data
+                assert f.tell() == len(data)
+        db.set_many({'many': src, 'small': b'small'})
+        for key in ('path', 'file', 'many'):
+            assert db[key].read() == data
+
+        ## A value of another database is copied like a file
+        with filedbm.open(tmp_path.joinpath('db2'), 'n') as db2:
+            db2['copy'] = db['path']
+            assert db2['copy'].read() == data
+
+        assert db.export('path', out) == len(data)
+        assert out.read_bytes() == data
+        with open(out, 'wb') as f:
+            f.write(b'hdr')
+            db.export('path', f)
+            f.write(b'end')
+        assert out.read_bytes() == b'hdr' + data + b'end'
+
+        bio = io.BytesIO()
+        db.export('small', bio)
+        assert bio.getvalue() == b'small'
+
+        with pytest.raises(KeyError):
+            db.export('missing', out)
+
+        db.append('path', b'zz')
+        assert db['path'].read() == data + b'zz'
+
+
+def test_export_to_socket(tmp_path):
+    with filedbm.open(tmp_path, 'n') as db:
+        db['a'] = data
+        sock_a, sock_b = socket.socketpair()
+        received = []
+        thread = threading.Thread(target=lambda: received.append(b''.join(iter(lambda: sock_b.recv(1 << 20), b''))))
+        thread.start()
+        db.export('a', sock_a)
+        sock_a.close()
+        thread.join()
+        sock_b.close()
+        assert received[0] == data
@@ -0,0 +1,71 @@
+import io
+import os
+
+import filedbm
+from filedbm import utils
+
+
+def canonical_blobs(db_path):
+    blobs_path = db_path.joinpath(utils.sys_dir_name, utils.blobs_dir_name)
+    if not blobs_path.exists():
+        return []
+    return sorted(name for d in os.listdir(blobs_path) for name in os.listdir(blobs_path.joinpath(d)) if '.' not in name)
+
+
+def test_reference_counting(tmp_path):
+    data = os.urandom(100000)
+    with filedbm.open(tmp_path, 'n', dedup=True, manifest=True) as db:
+        for i in range(5):
+            db['v{}'.format(i)] = data
+        db['f'] = io.BytesIO(data)
+        db['small'] = b'x'
+
+        ## Small values aren't deduplicated
+        assert len(canonical_blobs(tmp_path)) == 1
+        canonical = utils.blob_path(tmp_path, canonical_blobs(tmp_path)[0])
+        assert os.stat(canonical).st_nlink == 7
+        assert db['v3'].read() == data
+        assert db['f'].read() == data
+        assert sorted(db.keys()) == ['f', 'small', 'v0', 'v1', 'v2', 'v3', 'v4']
+
+        db['v0'] = b'y'*5000
+        assert os.stat(canonical).st_nlink == 6
+        del db['v1']
+        db['v2'] = b'z'
+        assert os.stat(canonical).st_nlink == 4
+        assert db['v4'].read() == data
+
+        ## The blob goes away with its last reference
+        for key in ('v3', 'v4', 'f'):
+            del db[key]
+        assert not canonical.exists()
+        assert len(canonical_blobs(tmp_path)) == 1
+
+        db.clear()
+        assert not canonical_blobs(tmp_path)
+
+
+def test_expired_values_release_blobs(tmp_path):
+    data = os.urandom(10000)
+    with filedbm.open(tmp_path, 'n', dedup=True) as db:
+        db['a'] = data
+        db.set('t', data, ttl=-1)
+        assert db.expire(scan=True) == 1
+        assert db['a'].read() == data
+        del db['a']
+        assert not canonical_blobs(tmp_path)
+
+
+def test_with_segments_and_compression(tmp_path):
+    data = os.urandom(10000)
+    with filedbm.open(tmp_path, 'n', dedup=True, segment_max_value_size=100, compression='zlib', shard_depth=1) as db:
+        db['a'] = data
+        db['b'] = data
+        db['c'] = b'tiny'
+        assert len(canonical_blobs(tmp_path)) == 1
+        assert db['b'].read() == data
+        assert db['c'].read() == b'tiny'
+        db['a'] = b'tiny2'
+        assert db['a'].read() == b'tiny2'
+        del db['b']
+        assert not canonical_blobs(tmp_path)
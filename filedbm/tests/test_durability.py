@@ -0,0 +1,87 @@
+import os
+
+import pytest
+
+import filedbm
+from filedbm import utils
+
+
+class FailingFile:
+    def tell(self):
+        return 0
+
+    def seek(self, *args):
+        return 10
+
+    def read(self, n):
+        raise RuntimeError('read failed')
+
+
+def count_fsyncs(monkeypatch):
+    calls = []
+    fsync = os.fsync
+
+    def counting_fsync(fd):
+        calls.append(fd)
+        fsync(fd)
+
+    monkeypatch.setattr(os, 'fsync', counting_fsync)
+
+    return calls
+
+
+def tmp_files(db_path):
+    return os.listdir(db_path.joinpath(utils.sys_dir_name, utils.tmp_dir_name))
+
+
+@pytest.mark.parametrize('durability', utils.durability_levels)
+def test_durability_levels(tmp_path, durability):
+    with filedbm.open(tmp_path, 'n', durability=durability, shard_depth=1) as db:
+        for i in range(100):
+            db[str(i)] = b'abc'*i
+        del db['3']
+        db.sync()
+        assert len(db) == 99
+        assert db['5'].read() == b'abc'*5
+        assert not tmp_files(tmp_path)
+
+    with filedbm.open(tmp_path, 'r') as db:
+        assert db['99'].read() == b'abc'*99
+
+
+def test_fsyncs(tmp_path, monkeypatch):
+    calls = count_fsyncs(monkeypatch)
+    with filedbm.open(tmp_path, 'n', durability='none') as db:
+        for i in range(10):
+            db[str(i)] = b'x'
+        assert not calls
+
+    with filedbm.open(tmp_path, 'w', durability='per-write') as db:
+        for i in range(10):
+            db[str(i)] = b'y'
+        assert len(calls) >= 20
+
+    with filedbm.open(tmp_path, 'w', durability='group') as db:
+        del calls[:]
+        for i in range(10):
+            db[str(i)] = b'z'
+        assert not calls
+        db.sync()
+        assert len(calls) >= 10
+
+
+def test_failed_write_leaves_nothing(tmp_path):
+    with filedbm.open(tmp_path, 'n') as db:
+        db['x'] = b'old'
+        with pytest.raises(RuntimeError):
+            db['x'] = FailingFile()
+        with pytest.raises(RuntimeError):
+            db['y'] = FailingFile()
+        assert db['x'].read() == b'old'
+        assert 'y' not in db
+        assert not tmp_files(tmp_path)
+
+
+def test_bad_durability(tmp_path):
+    with pytest.raises(ValueError):
+        filedbm.open(tmp_path, 'n', durability='always')
@@ -0,0 +1,117 @@
+import os
+import time
+import multiprocessing
+
+import pytest
+
+import filedbm
+from filedbm import eviction, utils
+
+
+def open_db(path, flag='c', **kwargs):
+    return filedbm.open(path, flag, manifest=True, **kwargs)
+
+
+@pytest.mark.parametrize('policy', ['lru', 'lfu', 'fifo'])
+def test_max_entries(tmp_path, policy):
+    with open_db(tmp_path, 'n', max_entries=50, eviction=policy) as db:
+        for i in range(200):
+            db[str(i)] = b'x'
+        assert len(db) == 50
+        assert len(list(utils.iter_data_paths(tmp_path))) == 50
+        ## The oldest values are evicted first
+        assert '0' not in db
+        assert '199' in db
+
+
+def test_lru_keeps_read_values(tmp_path):
+    with open_db(tmp_path, 'n', max_entries=20, eviction='lru') as db:
+        for i in range(20):
+            db[str(i)] = b'x'
+        for _ in range(3):
+            db['0'].read()
+        for i in range(20, 30):
+            db[str(i)] = b'x'
+        assert '0' in db
+        assert '1' not in db
+        assert len(db) == 20
+
+
+def test_lfu_keeps_frequently_read_values(tmp_path):
+    with open_db(tmp_path, 'n', max_entries=20, eviction='lfu') as db:
+        for i in range(20):
+            db[str(i)] = b'x'
+        for i in range(10):
+            for _ in range(3):
+                db[str(i)].read()
+        for i in range(20, 30):
+            db[str(i)] = b'x'
+        assert all(str(i) in db for i in range(10))
+        assert len(db) == 20
+
+
+def test_max_size(tmp_path):
+    with open_db(tmp_path, 'n', max_size=10000) as db:
+        for i in range(100):
+            db[str(i)] = b'x'*1000
+        assert db._manifest.total_size <= 10000
+
+
+def test_victim_checks_are_bounded(tmp_path, monkeypatch):
+    with open_db(tmp_path, 'n', max_entries=1000, eviction='lru') as db:
+        for i in range(1000):
+            db[str(i)] = b'x'
+        ## Reading every value makes all the heap scores stale
+        for i in range(1000):
+            db[str(i)].read()
+        calls = []
+        score = db._evictor.score
+        monkeypatch.setattr(db._evictor, 'score', lambda key_hash, entry: (calls.append(key_hash), score(key_hash, entry))[1])
+        db['new'] = b'x'
+        assert len(calls) <= eviction.max_victim_checks*eviction.evict_batch_size
+        for i in range(20):
+            db['new-{}'.format(i)] = b'x'
+        assert len(db) == 1000
+        assert '0' not in db
+
+
+def _read_key(db_path, key, event):
+    event.wait()
+    access = eviction.AccessLog(db_path)
+    access.touch(utils.hash_key(key.encode()))
+    access.flush()
+
+
+@pytest.mark.skipif(utils.fcntl is None, reason='needs fcntl')
+def test_access_log_compaction_keeps_concurrent_reads(tmp_path, monkeypatch):
+    monkeypatch.setattr(eviction, 'compact_ratio', 0)
+    monkeypatch.setattr(eviction, 'compact_min_records', 0)
+    with open_db(tmp_path, 'n', max_entries=100) as db:
+        for i in range(100):
+            db[str(i)] = b'x'
+            db[str(i)].read()
+            db[str(i)].read()
+        db._access.flush()
+
+        ## Another process records a read while the log is being compacted
+        ctx = multiprocessing.get_context('fork')
+        event = ctx.Event()
+        proc = ctx.Process(target=_read_key, args=(tmp_path, '0', event))
+        proc.start()
+        replace = os.replace
+
+        def slow_replace(src, dst):
+            event.set()
+            time.sleep(0.2)
+            replace(src, dst)
+
+        monkeypatch.setattr(os, 'replace', slow_replace)
+        db._access.compact(db._manifest.entries())
+        monkeypatch.setattr(os, 'replace', replace)
+        proc.join()
+        assert proc.exitcode == 0
+
+    access = eviction.AccessLog(tmp_path)
+    access.refresh()
+    assert access.get(utils.hash_key(b'0'))[1] == 3
+    assert access.get(utils.hash_key(b'1'))[1] == 2
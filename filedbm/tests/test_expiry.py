@@ -0,0 +1,80 @@
+import time
+
+import pytest
+
+import filedbm
+from filedbm import expiry, utils
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'manifest': True}, {'segment_max_value_size': 100}])
+def test_len_hides_expired_keys(tmp_path, kwargs):
+    with filedbm.open(tmp_path, 'n', **kwargs) as db:
+        db['keep'] = b'1'
+        db.set('gone', b'2', ttl=0.05)
+        db.set('later', b'3', ttl=3600)
+        time.sleep(0.1)
+        assert 'gone' not in db
+        assert sorted(db.keys()) == ['keep', 'later']
+        assert len(db) == 2
+
+
+def test_len_with_database_ttl(tmp_path):
+    with filedbm.open(tmp_path, 'n', ttl=3600) as db:
+        db['keep'] = b'1'
+        db.set('gone', b'2', ttl=0.05)
+        time.sleep(0.1)
+        assert len(db) == len(list(db.keys())) == 1
+
+
+def test_expire_removes_due_buckets(tmp_path, monkeypatch):
+    with filedbm.open(tmp_path, 'n') as db:
+        db.set('gone', b'2', ttl=1)
+        db['keep'] = b'1'
+        ## Pretend the bucket of the expiry has passed
+        now = time.time() + 2*expiry.bucket_size
+        monkeypatch.setattr('filedbm.main.time', lambda: now)
+        assert db.expire() == 1
+        assert list(db.keys()) == ['keep']
+
+
+def test_expire_scan(tmp_path):
+    with filedbm.open(tmp_path, 'n') as db:
+        db.set('gone', b'2', ttl=0.05)
+        db['keep'] = b'1'
+        time.sleep(0.1)
+        assert db.expire(scan=True) == 1
+        assert len(db) == 1
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'segment_max_value_size': 100}])
+def test_expire_right_after_expiry(tmp_path, monkeypatch, kwargs):
+    with filedbm.open(tmp_path, 'n', **kwargs) as db:
+        db.set('gone', b'2', ttl=0.05)
+        db.set('soon', b'3', ttl=expiry.bucket_size/2)
+        db['keep'] = b'1'
+        time.sleep(0.1)
+        assert db.expire() == 1
+        assert sorted(db.keys()) == ['keep', 'soon']
+        assert not utils.key_file_path(tmp_path, utils.hash_key(b'gone')).exists()
+
+        ## The key that hasn't expired yet is still in the index
+        now = time.time() + expiry.bucket_size
+        monkeypatch.setattr('filedbm.main.time', lambda: now)
+        assert db.expire() == 1
+        assert list(db.keys()) == ['keep']
+        assert db._expiry_index.due_buckets(now, True) == []
+
+
+def test_update_bucket_keeps_new_hashes(tmp_path):
+    index = expiry.ExpiryIndex(tmp_path)
+    now = time.time()
+    bucket = index.bucket_of(now)
+    index.add('a'*26, now)
+    index.add('b'*26, now)
+    read_hashes = index.read_bucket(bucket)
+    ## Added by another writer while the bucket was being processed
+    index.add('c'*26, now)
+    index.update_bucket(bucket, read_hashes, ['b'*26])
+    assert index.read_bucket(bucket) == ['b'*26, 'c'*26]
+    index.update_bucket(bucket, index.read_bucket(bucket), [])
+    assert index.due_buckets(now, True) == []
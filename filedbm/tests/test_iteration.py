@@ -0,0 +1,40 @@
+import os
+
+import pytest
+
+import filedbm
+
+
+@pytest.fixture
+def db_values(tmp_path):
+    values = {'k{}'.format(i): os.urandom(200000 if i % 100 == 0 else 100) for i in range(500)}
+    with filedbm.open(tmp_path, 'n', shard_depth=1) as db:
+        db.update(values)
+
+    return values
+
+
+@pytest.mark.parametrize('prefetch', [0, 1, 5, 64, 1000])
+def test_prefetch(tmp_path, db_values, prefetch):
+    with filedbm.open(tmp_path, 'r') as db:
+        assert {key: value.read() for key, value in db.items(prefetch=prefetch)} == db_values
+        assert sorted(value.read() for value in db.values(prefetch=prefetch)) == sorted(db_values.values())
+        assert len(db) == len(db_values)
+
+
+def test_partial_iteration(tmp_path, db_values):
+    with filedbm.open(tmp_path, 'r') as db:
+        items = db.items(prefetch=100)
+        key, value = next(items)
+        assert value.read() == db_values[key]
+        items.close()
+
+
+def test_mixed_stores(tmp_path, db_values):
+    with filedbm.open(tmp_path, 'w', segment_max_value_size=150, ttl=1000) as db:
+        db['new'] = b'z'
+        db.set('expired', b'x', -1)
+        items = dict(db.items(prefetch=50))
+        assert len(items) == len(db_values) + 1
+        assert items['new'].read() == b'z'
+        assert sorted(db.keys()) == sorted(list(db_values) + ['new'])
@@ -0,0 +1,75 @@
+import os
+
+import pytest
+
+import filedbm
+from filedbm import utils
+
+
+def shard_dirs(db_path):
+    return [name for name in os.listdir(db_path) if utils.is_shard_dir_name(name)]
+
+
+def test_sharded_layout(tmp_path):
+    with filedbm.open(tmp_path, 'n', shard_depth=2) as db:
+        for i in range(100):
+            db[str(i)] = str(i).encode()
+        assert len(db) == 100
+        assert db['42'].read() == b'42'
+        key_hash = utils.hash_key(b'42')
+        assert utils.key_file_path(tmp_path, key_hash, 2).exists()
+        assert utils.key_file_path(tmp_path, key_hash, 2).parent.parent.parent == tmp_path
+
+    assert not list(utils.iter_data_paths(tmp_path))
+    assert shard_dirs(tmp_path)
+
+    ## The depth is stored with the database
+    with filedbm.open(tmp_path, 'r') as db:
+        assert db._shard_depth == 2
+        assert sorted(db.keys(), key=int) == [str(i) for i in range(100)]
+
+    with pytest.raises(ValueError):
+        filedbm.open(tmp_path, 'w', shard_depth=1)
+
+
+def test_migrate_layout(tmp_path):
+    db = filedbm.open(tmp_path, 'n')
+    for i in range(200):
+        db[str(i)] = b'v'*i
+    reader = filedbm.open(tmp_path, 'r')
+    assert reader['8'].read() == b'v'*8
+
+    db.migrate_layout(2)
+    assert db._shard_depth == 2
+    assert len(db) == 200
+    assert not list(utils.iter_data_paths(tmp_path))
+    assert db['7'].read() == b'v'*7
+
+    ## A reader opened before the migration follows the new layout
+    assert '7' in reader
+    assert reader['9'].read() == b'v'*9
+    assert reader._shard_depth == 2
+    reader.close()
+
+    db['x'] = b'y'
+    del db['3']
+    assert '3' not in db
+    assert len(db) == 200
+
+    db.migrate_layout(0)
+    assert db._shard_depth == 0
+    assert not shard_dirs(tmp_path)
+    assert len(list(utils.iter_data_paths(tmp_path))) == 200
+    assert db['x'].read() == b'y'
+    db.close()
+
+
+def test_clear_sharded(tmp_path):
+    with filedbm.open(tmp_path, 'n', shard_depth=1) as db:
+        for i in range(50):
+            db[str(i)] = b'x'
+        db.clear()
+        assert len(db) == 0
+        assert os.listdir(tmp_path) == [utils.sys_dir_name]
+        db['a'] = b'x'
+        assert db['a'].read() == b'x'
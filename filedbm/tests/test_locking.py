@@ -0,0 +1,165 @@
+import os
+import threading
+import multiprocessing
+
+import pytest
+
+import filedbm
+from filedbm import locking, utils
+
+pytestmark = pytest.mark.skipif(utils.fcntl is None, reason='needs fcntl')
+
+key_hash = utils.hash_key(b'key')
+
+
+def slot(key_hash):
+    return int(key_hash[:8], 16) % locking.key_lock_slots
+
+
+def _try_key_lock(path, key_hash, result):
+    fd = os.open(path, os.O_RDWR)
+    try:
+        utils.fcntl.lockf(fd, utils.fcntl.LOCK_EX | utils.fcntl.LOCK_NB, 1, slot(key_hash))
+    except OSError:
+        result.value = 1
+    else:
+        result.value = 0
+    os.close(fd)
+
+
+def key_lock_is_held(db_path, key_hash):
+    """
+    Whether another process would have to wait for the lock of the key.
+    """
+    ctx = multiprocessing.get_context('fork')
+    result = ctx.Value('i', -1)
+    proc = ctx.Process(target=_try_key_lock, args=(db_path.joinpath(utils.sys_dir_name, locking.key_lock_file_name), key_hash, result))
+    proc.start()
+    proc.join()
+
+    return result.value == 1
+
+
+def test_instances_exclude_each_other(tmp_path):
+    db1 = filedbm.open(tmp_path, 'n', locking=True)
+    db2 = filedbm.open(tmp_path, 'w', locking=True)
+    acquired = threading.Event()
+
+    def take_lock():
+        with db2._lock.key(key_hash):
+            acquired.set()
+
+    with db1._lock.key(key_hash):
+        thread = threading.Thread(target=take_lock)
+        thread.start()
+        assert not acquired.wait(0.2)
+    thread.join(5)
+    assert acquired.is_set()
+    db1.close()
+    db2.close()
+
+
+def test_closing_an_instance_keeps_the_locks_of_another(tmp_path):
+    db1 = filedbm.open(tmp_path, 'n', locking=True)
+    with db1._lock.key(key_hash):
+        db2 = filedbm.open(tmp_path, 'w', locking=True)
+        db2['other'] = b'x'
+        db2.close()
+        assert key_lock_is_held(tmp_path, key_hash)
+    assert not key_lock_is_held(tmp_path, key_hash)
+    db1.close()
+    assert not locking._key_locks
+
+
+def _increment(db_path, n):
+    with filedbm.open(db_path, 'w', locking=True) as db:
+        for _ in range(n):
+            with db._lock.write(key_hash):
+                value = int(db['counter'].read())
+                db['counter'] = str(value + 1).encode()
+
+
+def test_read_modify_write_across_processes(tmp_path):
+    with filedbm.open(tmp_path, 'n', locking=True) as db:
+        db['counter'] = b'0'
+        ctx = multiprocessing.get_context('fork')
+        procs = [ctx.Process(target=_increment, args=(tmp_path, 50)) for _ in range(3)]
+        for proc in procs:
+            proc.start()
+        ## The parent keeps its instance open (and its locks usable) while the children write
+        _increment(tmp_path, 50)
+        for proc in procs:
+            proc.join()
+            assert proc.exitcode == 0
+        assert db['counter'].read() == b'200'
+
+
+def _writer(db_path, i):
+    with filedbm.open(db_path, 'w', locking=True, dedup=True, segment_max_value_size=50) as db:
+        for j in range(200):
+            key = 'k{}'.format(j % 20)
+            db[key] = b'%d-%d' % (i, j) * (1 if j % 2 else 3000)
+            if j % 7 == 0:
+                try:
+                    del db[key]
+                except KeyError:
+                    pass
+
+
+def test_concurrent_writers(tmp_path):
+    with filedbm.open(tmp_path, 'n', locking=True, dedup=True, segment_max_value_size=50) as db:
+        db['a'] = b'hello'
+        ctx = multiprocessing.get_context('fork')
+        procs = [ctx.Process(target=_writer, args=(tmp_path, i)) for i in range(4)]
+        for proc in procs:
+            proc.start()
+        for proc in procs:
+            proc.join()
+            assert proc.exitcode == 0
+
+        for key in db.keys():
+            db[key].read()
+        assert db['a'].read() == b'hello'
+
+        ## Every blob link belongs to a key
+        blobs_path = tmp_path.joinpath(utils.sys_dir_name, utils.blobs_dir_name)
+        for d in os.listdir(blobs_path):
+            names = os.listdir(blobs_path.joinpath(d))
+            for name in names:
+                if '.' not in name:
+                    n_links = os.stat(blobs_path.joinpath(d, name)).st_nlink
+                    assert n_links - 1 == sum(other.startswith(name + '.') for other in names)
+
+
+def _read_value(db):
+    return db['a'].read()
+
+
+def test_pickle_to_spawned_processes(tmp_path):
+    with filedbm.open(tmp_path, 'n', locking=True) as db:
+        db['a'] = b'hello'
+        with multiprocessing.get_context('spawn').Pool(2) as pool:
+            assert pool.map(_read_value, [db, db]) == [b'hello', b'hello']
+
+
+def test_use_after_fork(tmp_path):
+    with filedbm.open(tmp_path, 'n', locking=True, cache_size=10**6) as db:
+        db['a'] = b'x'
+        db['a'].read()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                db['child'] = b'c'*10
+                db['child2'] = b'c'*20000
+                db['a'] = b'from child'
+                db.close()
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        db['parent'] = b'p'
+        assert db['child'].read() == b'c'*10
+        assert db['child2'].read() == b'c'*20000
+        assert db['a'].read() == b'from child'
+        assert db['parent'].read() == b'p'
+        db.clear()
+        assert len(db) == 0
@@ -0,0 +1,76 @@
+import os
+import multiprocessing
+
+import pytest
+
+import filedbm
+from filedbm import manifest, utils
+
+fcntl_required = pytest.mark.skipif(utils.fcntl is None, reason='needs fcntl')
+
+
+def data_files(db_path):
+    return sorted(entry.name for entry in utils.iter_data_entries(str(db_path)))
+
+
+def test_keys_and_len(tmp_path):
+    with filedbm.open(tmp_path, 'n', manifest=True) as db:
+        for i in range(50):
+            db[str(i)] = b'x'*i
+        del db['7']
+        assert len(db) == 49
+        assert sorted(db.keys()) == sorted(str(i) for i in range(50) if i != 7)
+
+    with filedbm.open(tmp_path, 'r') as db:
+        assert len(db) == 49
+
+
+def test_rebuild(tmp_path):
+    with filedbm.open(tmp_path, 'n', manifest=True) as db:
+        db['a'] = b'1'
+        db['b'] = b'2'
+    tmp_path.joinpath(utils.sys_dir_name, utils.manifest_file_name).unlink()
+
+    with filedbm.open(tmp_path, 'w') as db:
+        db.rebuild_manifest()
+        assert sorted(db.keys()) == ['a', 'b']
+
+
+def test_compact_keeps_entries(tmp_path, monkeypatch):
+    monkeypatch.setattr(manifest, 'compact_min_records', 10)
+    with filedbm.open(tmp_path, 'n', manifest=True) as db:
+        for i in range(100):
+            for value in (b'x', b'y', b'z'):
+                db[str(i)] = value
+    log_path = tmp_path.joinpath(utils.sys_dir_name, utils.manifest_file_name)
+    assert os.path.getsize(log_path) < 150*manifest.record_struct.size
+
+    with filedbm.open(tmp_path, 'r') as db:
+        assert len(db) == 100
+        assert list(db.keys(prefix='9')) == ['9', '90', '91', '92', '93', '94', '95', '96', '97', '98', '99']
+
+
+def _write_keys(db_path, tag):
+    manifest.compact_min_records = 10
+    for i in range(40):
+        db = filedbm.open(db_path, 'w', manifest=True, locking=True)
+        for j in range(30):
+            db['{}-{}-{}'.format(tag, i, j)] = b'x'
+            if j % 2:
+                del db['{}-{}-{}'.format(tag, i, j)]
+        db.close()
+
+
+@fcntl_required
+def test_concurrent_compaction(tmp_path):
+    filedbm.open(tmp_path, 'n', manifest=True, locking=True).close()
+    ctx = multiprocessing.get_context('fork')
+    procs = [ctx.Process(target=_write_keys, args=(tmp_path, tag)) for tag in 'abc']
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+        assert proc.exitcode == 0
+
+    with filedbm.open(tmp_path, 'r') as db:
+        assert len(db) == len(data_files(tmp_path)) == 3*40*15
@@ -0,0 +1,58 @@
+import pickle
+
+import filedbm
+
+
+def test_stats(tmp_path):
+    with filedbm.open(tmp_path, 'n', metrics=True) as db:
+        db['a'] = b'x'*100
+        db.set('b', b'y'*10, -1)
+        assert db['a'].read() == b'x'*100
+        assert db.get('missing') is None
+        assert 'a' in db
+        assert 'missing' not in db
+        len(db)
+        try:
+            del db['missing']
+        except KeyError:
+            pass
+        del db['a']
+        assert db.expire(scan=True) == 1
+
+        stats = db.stats()
+        ops = stats['ops']
+        assert ops['set']['count'] == 2
+        assert stats['bytes_written'] == 110
+        assert ops['get']['misses'] == 1
+        assert stats['bytes_read'] == 100
+        assert ops['delete']['count'] == 2
+        assert ops['delete']['misses'] == 1
+        assert ops['contains']['count'] == 2
+        assert ops['len']['count'] == 1
+        assert stats['expired'] == 1
+        assert sum(ops['set']['histogram'].values()) == 2
+
+        db.stats(reset=True)
+        assert db.stats()['ops'] == {}
+
+        ## Pickled instances keep collecting metrics
+        db2 = pickle.loads(pickle.dumps(db))
+        db2['c'] = b'z'
+        assert db2.stats()['ops']['set']['count'] == 1
+        db2.close()
+
+    with filedbm.open(tmp_path, 'w') as db:
+        assert db.stats() is None
+
+
+def test_hooks(tmp_path):
+    calls = []
+    with filedbm.open(tmp_path, 'n', metrics=True) as db:
+        db.add_hook(lambda *args: calls.append(args))
+        ## A failing hook doesn't break the operation or the other hooks
+        db.add_hook(lambda *args: 1/0)
+        db['a'] = b'x'
+        db['a'].read()
+        db.get('missing')
+        assert len(calls) == sum(op['count'] for op in db.stats()['ops'].values())
+        assert [call[0] for call in calls[-2:]] == ['get', 'get']
@@ -0,0 +1,80 @@
+import os
+import pickle
+
+import pytest
+
+import filedbm
+
+keys = ['k{:05d}'.format(i) for i in range(1000)]
+
+
+def key_value(i):
+    return keys[i].encode()*((i % 7)*300 + 1)
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'compression': 'zlib', 'compression_min_size': 1}, {'dedup': True}, {'segment_max_value_size': 1000}, {'manifest': True, 'shard_depth': 1}])
+def test_freeze_and_thaw(tmp_path, kwargs):
+    big = os.urandom(200000)
+    pack_path = tmp_path.joinpath('pack')
+    with filedbm.open(tmp_path.joinpath('db'), 'n', **kwargs) as db:
+        for i, key in enumerate(keys):
+            db[key] = key_value(i)
+        db['big'] = big
+        db['big2'] = big
+        db.set('exp', b'gone', -1)
+        db.set('ttl', b'kept', 1000)
+        assert db.freeze(pack_path) == 1003
+
+    with filedbm.open(pack_path) as p:
+        assert isinstance(p, filedbm.PackedFileDBM)
+        assert len(p) == 1003
+        assert 'exp' not in p
+        assert 'ttl' in p
+        assert p.get('missing') is None
+        for i in range(0, 1000, 97):
+            assert p[keys[i]].read() == key_value(i)
+        assert p['big'].read() == big
+        assert p['big2'].read() == big
+
+        assert list(p.keys()) == sorted(keys + ['big', 'big2', 'ttl'])
+        assert list(p.keys(prefix='k001')) == keys[100:200]
+        assert list(p.keys(start='k00998', stop='k00999z', reverse=True)) == ['k00999', 'k00998']
+        assert [k for k, v in p.items(prefix='k0000')] == keys[:10]
+
+        with pytest.raises(ValueError):
+            p['x'] = b'1'
+
+        p2 = pickle.loads(pickle.dumps(p))
+        assert p2['k00001'].read() == key_value(1)
+        p2.close()
+
+        p.export('big', tmp_path.joinpath('out'))
+        assert tmp_path.joinpath('out').read_bytes() == big
+
+    assert filedbm.thaw(pack_path, tmp_path.joinpath('db2'), **kwargs) == 1003
+    with filedbm.open(tmp_path.joinpath('db2')) as db:
+        assert len(db) == 1003
+        assert db['big'].read() == big
+        assert db['k00005'].read() == key_value(5)
+
+
+def test_empty_and_read_only(tmp_path):
+    with filedbm.open(tmp_path.joinpath('db'), 'n') as db:
+        db.freeze(tmp_path.joinpath('pack'))
+    with filedbm.open(tmp_path.joinpath('pack')) as p:
+        assert len(p) == 0
+        assert list(p.keys()) == []
+        assert 'a' not in p
+    with pytest.raises(ValueError):
+        filedbm.open(tmp_path.joinpath('pack'), 'w')
+
+
+def test_numpy_over_the_mmap(tmp_path):
+    np = pytest.importorskip('numpy')
+    with filedbm.open(tmp_path.joinpath('db'), 'n', serializer='numpy') as db:
+        db['a'] = np.arange(100000)
+        db.freeze(tmp_path.joinpath('pack'))
+    with filedbm.open(tmp_path.joinpath('pack'), serializer='numpy') as p:
+        a = p['a']
+        assert a.sum() == np.arange(100000).sum()
+        del a
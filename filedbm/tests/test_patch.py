@@ -0,0 +1,130 @@
+import os
+import tracemalloc
+
+import pytest
+
+import filedbm
+from filedbm import utils
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'compression': 'zlib', 'compression_min_size': 1}, {'segment_max_value_size': 1000}, {'dedup': True}])
+def test_append_and_write_at(tmp_path, kwargs):
+    with filedbm.open(tmp_path, 'n', **kwargs) as db:
+        db.append('log', b'abc')
+        db.append('log', b'def')
+        assert db['log'].read() == b'abcdef'
+        db.write_at('log', 1, b'XY')
+        db.write_at('log', 5, b'123')
+        assert db['log'].read() == b'aXYde123'
+        with pytest.raises(KeyError):
+            db.write_at('missing', 0, b'a')
+        with pytest.raises(ValueError):
+            db.write_at('log', 100, b'a')
+
+
+def test_ttl_is_kept(tmp_path):
+    with filedbm.open(tmp_path, 'n') as db:
+        db.set('t', b'x'*5000, 100)
+        db.append('t', b'y')
+        with db['t'] as value:
+            assert value.read() == b'x'*5000 + b'y'
+            assert utils.field_expiry in value.fields
+
+
+@pytest.mark.parametrize('atomic', [True, False])
+def test_expired_values_are_not_patched(tmp_path, atomic):
+    with filedbm.open(tmp_path, 'n', ttl=1000) as db:
+        db['first'] = b'x'
+        db.set('e', b'old', -1)
+        db['aged'] = b'old'
+        file_path = utils.key_file_path(tmp_path, utils.hash_key(b'aged'))
+        os.utime(file_path, (1, 1))
+
+        with pytest.raises(KeyError):
+            db.write_at('e', 0, b'n', atomic=atomic)
+        with pytest.raises(KeyError):
+            db.write_at('aged', 0, b'n', atomic=atomic)
+        assert 'e' not in db
+        assert 'aged' not in db
+
+        db.append('e', b'new', atomic=atomic)
+        db.append('aged', b'new', atomic=atomic)
+        assert db['e'].read() == b'new'
+        assert db['aged'].read() == b'new'
+        assert utils.field_expiry not in db['e'].fields
+
+
+def test_atomic_by_default(tmp_path):
+    with filedbm.open(tmp_path, 'n') as db:
+        db['big'] = b'x'*(2*utils.pread_max_size)
+        file_path = utils.key_file_path(tmp_path, utils.hash_key(b'big'))
+        ino = os.stat(file_path).st_ino
+        ## A large value is memory mapped, so an in-place patch would change it
+        value = db['big']
+        view = value.view(10)
+        db.write_at('big', 0, b'y'*10)
+        assert bytes(view) == b'x'*10
+        value.close()
+        assert os.stat(file_path).st_ino != ino
+        assert db['big'].read(10) == b'y'*10
+
+        ino = os.stat(file_path).st_ino
+        db.append('big', b'z', atomic=False)
+        assert os.stat(file_path).st_ino == ino
+        assert db['big'].read()[-2:] == b'xz'
+
+
+def test_patch_runs_write_maintenance(tmp_path):
+    with filedbm.open(tmp_path, 'n', metrics=True) as db:
+        db.append('a', b'x')
+        ops = db.stats()['ops']
+        assert ops['append']['count'] == 1
+        ## The first write of a process runs expire
+        assert ops['expire']['count'] == 1
+
+    with filedbm.open(tmp_path, 'n', manifest=True, max_entries=10, bloom_fpr=0.01) as db:
+        for i in range(10):
+            db[str(i)] = b'x'
+        db.append('new', b'x')
+        assert len(db) == 10
+        assert 'new' in db
+
+
+@pytest.mark.parametrize('checksum', ['crc32', 'blake2b'])
+def test_patch_keeps_checksum(tmp_path, checksum):
+    with filedbm.open(tmp_path, 'n', checksum=checksum, verify_checksums=True) as db:
+        db['a'] = b'x'*100000
+        file_path = utils.key_file_path(tmp_path, utils.hash_key(b'a'))
+        ino = os.stat(file_path).st_ino
+        db.append('a', b'abc', atomic=False)
+        db.write_at('a', 10, b'yy', atomic=False)
+        db.write_at('a', 100002, b'zzzz', atomic=False)
+        ## Patched in place rather than rewritten
+        assert os.stat(file_path).st_ino == ino
+        db.append('a', b'!')
+        expected = b'x'*10 + b'yy' + b'x'*(100000 - 12) + b'ab' + b'zzzz' + b'!'
+        assert db['a'].read() == expected
+        assert db.verify()['corrupt'] == []
+
+
+def peak_memory(func, *args):
+    tracemalloc.start()
+    try:
+        func(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+@pytest.mark.parametrize('kwargs', [{'checksum': 'crc32'}, {'compression': 'zlib'}, {'dedup': True}, {'compression': 'zlib', 'segment_max_value_size': 100}])
+def test_patch_large_value_memory(tmp_path, kwargs):
+    size = 20*2**20
+    with filedbm.open(tmp_path, 'n', **kwargs) as db:
+        db['a'] = b'0123456789abcdef'*(size//16)
+        assert peak_memory(db.append, 'a', b'abcd') < size//4
+        assert peak_memory(db.write_at, 'a', 10, b'ef') < size//4
+        with db['a'] as value:
+            assert value.length == size + 4
+            assert value.read(12)[10:] == b'ef'
+            value.seek(size)
+            assert value.read() == b'abcd'
@@ -0,0 +1,78 @@
+import random
+import asyncio
+
+import pytest
+
+import filedbm
+from filedbm import utils
+from filedbm.manifest import SortedKeys
+
+keys = ['2026/{:02d}/{:02d}'.format(m, d) for m in range(1, 13) for d in range(1, 29)]
+
+
+def test_sorted_keys():
+    rng = random.Random(1)
+    ref = set()
+    sorted_keys = SortedKeys()
+    for _ in range(20000):
+        key = str(rng.randrange(5000))
+        if rng.random() < 0.6:
+            ref.add(key)
+            sorted_keys.add(key)
+        else:
+            ref.discard(key)
+            sorted_keys.remove(key)
+
+    ref = sorted(ref)
+    assert len(sorted_keys) == len(ref)
+    assert list(sorted_keys.irange()) == ref
+    assert list(sorted_keys.irange(reverse=True)) == ref[::-1]
+    for _ in range(200):
+        start, stop = sorted(str(rng.randrange(5000)) for _ in range(2))
+        expected = [k for k in ref if start <= k < stop]
+        assert list(sorted_keys.irange(start, stop)) == expected
+        assert list(sorted_keys.irange(start, stop, True)) == expected[::-1]
+        assert list(sorted_keys.irange(start)) == [k for k in ref if k >= start]
+        assert list(sorted_keys.irange(None, stop, True)) == [k for k in ref if k < stop][::-1]
+
+
+def test_prefix_stop():
+    assert utils.prefix_stop('2026/10/') == '2026/100'
+
+
+@pytest.mark.parametrize('kwargs', [{'manifest': True}, {}, {'manifest': True, 'segment_max_value_size': 100}])
+def test_prefix_and_range_scans(tmp_path, kwargs):
+    with filedbm.open(tmp_path, 'n', **kwargs) as db:
+        for key in keys:
+            db[key] = key.encode()
+        db.set('2026/10/x', b'expired', -1)
+
+        october = [k for k in keys if k.startswith('2026/10/')]
+        assert list(db.keys(prefix='2026/10/')) == october
+        assert list(db.keys(prefix='2026/10/', reverse=True)) == october[::-1]
+        assert [k for k, v in db.items(start='2026/03/05', stop='2026/03/08')] == ['2026/03/05', '2026/03/06', '2026/03/07']
+        assert [v.read() for v in db.values(prefix='2026/12/2')] == [k.encode() for k in keys if k.startswith('2026/12/2')]
+
+        del db['2026/10/01']
+        assert list(db.keys(prefix='2026/10/'))[0] == '2026/10/02'
+        assert list(db.keys(reverse=True))[0] == '2026/12/28'
+
+    if kwargs.get('manifest'):
+        with filedbm.open(tmp_path, 'w') as db:
+            db._manifest.compact()
+        with filedbm.open(tmp_path, 'r', manifest=True) as db:
+            assert list(db.keys(prefix='2026/10/'))[:2] == ['2026/10/02', '2026/10/03']
+
+
+def test_async_scans(tmp_path):
+    with filedbm.open(tmp_path, 'n', manifest=True) as db:
+        for key in keys:
+            db[key] = key.encode()
+
+    async def main():
+        async with await filedbm.open_async(tmp_path, 'r') as db:
+            found = [k async for k in db.keys(prefix='2026/11/0')]
+            assert found == ['2026/11/0{}'.format(i) for i in range(1, 10)]
+            assert [k async for k, v in db.items(prefix='2026/11/0', reverse=True)] == found[::-1]
+
+    asyncio.run(main())
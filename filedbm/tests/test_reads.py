@@ -0,0 +1,62 @@
+import io
+import os
+
+import filedbm
+
+
+def test_read_handles(tmp_path):
+    data = os.urandom(200000)
+    with filedbm.open(tmp_path, 'n') as db:
+        db['a'] = b'hello'
+        db['big'] = data
+
+        value = db['a']
+        assert value.read(2) == b'he'
+        assert value.read() == b'llo'
+        assert value.read() == b''
+        value.seek(1)
+        assert value.read(3) == b'ell'
+
+        value = db['big']
+        assert value.length == len(data)
+        assert value.seekable() and value.readable()
+        buf = bytearray(1000)
+        assert value.readinto(buf) == 1000
+        assert bytes(buf) == data[:1000]
+        assert value.tell() == 1000
+        value.seek(150000)
+        assert value.read(10) == data[150000:150010]
+
+        with db['big'] as value:
+            assert value.read() == data
+        assert value.closed
+
+        assert io.BufferedReader(db['big']).read() == data
+
+
+def test_view(tmp_path):
+    data = os.urandom(200000)
+    with filedbm.open(tmp_path, 'n') as db:
+        db['small'] = b'abcdef'
+        db['big'] = data
+
+        value = db['small']
+        assert bytes(value.view(3)) == b'abc'
+        assert value.read() == b'def'
+
+        value = db['big']
+        value.seek(100)
+        view = value.view(10)
+        assert bytes(view) == data[100:110]
+        assert value.tell() == 110
+        ## The view stays valid after the handle is closed
+        value.close()
+        assert bytes(view) == data[100:110]
+
+
+def test_iteration_values(tmp_path):
+    with filedbm.open(tmp_path, 'n') as db:
+        for i in range(20):
+            db[str(i)] = str(i).encode()*3
+        assert sorted((key, value.read()) for key, value in db.items()) == sorted((str(i), str(i).encode()*3) for i in range(20))
+        assert sorted(value.read() for value in db.values()) == sorted(str(i).encode()*3 for i in range(20))
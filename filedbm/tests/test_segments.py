@@ -0,0 +1,197 @@
+import os
+import multiprocessing
+
+import pytest
+
+import filedbm
+from filedbm import segments, utils
+
+
+def open_db(path, flag='c', **kwargs):
+    return filedbm.open(path, flag, segment_max_value_size=100, **kwargs)
+
+
+def segment_names(db_path):
+    return [name for name in os.listdir(db_path.joinpath(utils.sys_dir_name, segments.segments_dir_name)) if segments.is_segment_name(name)]
+
+
+def test_small_values_go_to_segments(tmp_path):
+    with open_db(tmp_path, 'n') as db:
+        db['small'] = b'x'*10
+        db['large'] = b'y'*1000
+        assert db['small'].read() == b'x'*10
+        assert db['large'].read() == b'y'*1000
+        assert sorted(db.keys()) == ['large', 'small']
+
+    assert len(list(utils.iter_data_paths(tmp_path))) == 1
+
+
+def test_move_between_stores(tmp_path):
+    with open_db(tmp_path, 'n') as db:
+        db['a'] = b'y'*1000
+        db['a'] = b'x'
+        assert db['a'].read() == b'x'
+        assert not list(utils.iter_data_paths(tmp_path))
+        db['a'] = b'z'*1000
+        assert db['a'].read() == b'z'*1000
+        assert len(db) == 1
+
+
+def test_snapshot_reopen(tmp_path):
+    with open_db(tmp_path, 'n') as db:
+        for i in range(100):
+            db[str(i)] = str(i).encode()
+        for i in range(0, 100, 2):
+            del db[str(i)]
+
+    with open_db(tmp_path, 'r') as db:
+        assert len(db) == 50
+        assert db['51'].read() == b'51'
+        assert '50' not in db
+
+
+def test_other_instance_sees_writes(tmp_path):
+    with open_db(tmp_path, 'n') as writer, open_db(tmp_path, 'r') as reader:
+        writer['file'] = b'y'*1000
+        assert reader['file'].read() == b'y'*1000
+        writer['new'] = b'x'
+        ## A key that isn't found makes the reader check the segments
+        assert reader['new'].read() == b'x'
+        del writer['new']
+        writer['other'] = b'z'
+        assert writer.get('new') is None
+        assert 'other' in reader
+
+
+def test_negative_cache(tmp_path, monkeypatch):
+    with open_db(tmp_path, 'n') as writer, open_db(tmp_path, 'r') as reader:
+        writer['big'] = b'y'*1000
+        calls = []
+        refresh = reader._segments.refresh
+        monkeypatch.setattr(reader._segments, 'refresh', lambda force=False: (calls.append(force), refresh(force)))
+        for _ in range(10):
+            assert reader['big'].read() == b'y'*1000
+        assert calls.count(True) == 1
+
+
+def test_rotated_segments_are_sealed(tmp_path):
+    with open_db(tmp_path, 'n', segment_size=1000) as db:
+        for i in range(100):
+            db[str(i)] = b'x'*50
+        store = db._segments
+        assert len(store._sealed) >= len(segment_names(tmp_path)) - 2
+
+    with open_db(tmp_path, 'r') as db:
+        assert len(db._segments._open_names) == 0
+        assert db['99'].read() == b'x'*50
+
+
+def test_compaction_drops_tombstones(tmp_path):
+    with open_db(tmp_path, 'n', segment_size=4096) as db:
+        for round_n in range(20):
+            for i in range(50):
+                db['{}-{}'.format(round_n, i)] = b'x'*20
+            for i in range(50):
+                del db['{}-{}'.format(round_n, i)]
+            db.compact_segments(0.5)
+        db.compact_segments(0.0)
+        db.compact_segments(0.0)
+        store = db._segments
+        assert len(db) == 0
+        assert len(store._index) < 200
+
+    sizes = [os.path.getsize(tmp_path.joinpath(utils.sys_dir_name, segments.segments_dir_name, name)) for name in segment_names(tmp_path)]
+    assert sum(sizes) < 20*50*(segments.record_struct.size + 20)
+
+    with open_db(tmp_path, 'r') as db:
+        assert len(db) == 0
+        assert db.get('0-0') is None
+
+
+def test_compaction_keeps_needed_tombstones(tmp_path):
+    with open_db(tmp_path, 'n', segment_size=2048) as db:
+        db['keep'] = b'old'
+        ## Fill the first segment with live values so it isn't compacted
+        for i in range(40):
+            db['live-{}'.format(i)] = b'x'*20
+        del db['keep']
+        for i in range(200):
+            db['tmp-{}'.format(i)] = b'x'*20
+            del db['tmp-{}'.format(i)]
+        db.compact_segments(0.5)
+
+    with open_db(tmp_path, 'r') as db:
+        assert 'keep' not in db
+        assert len(db) == 40
+
+
+def _write_segment_keys(db_path, tag):
+    with open_db(db_path, 'w', locking=True, segment_size=8192) as db:
+        for i in range(300):
+            db['{}-{}'.format(tag, i)] = b'x'*10
+            if i % 3 == 0:
+                del db['{}-{}'.format(tag, i)]
+        db.compact_segments(0.3)
+
+
+@pytest.mark.skipif(utils.fcntl is None, reason='needs fcntl')
+def test_concurrent_writers(tmp_path):
+    open_db(tmp_path, 'n').close()
+    ctx = multiprocessing.get_context('fork')
+    procs = [ctx.Process(target=_write_segment_keys, args=(tmp_path, tag)) for tag in 'abc']
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+        assert proc.exitcode == 0
+
+    with open_db(tmp_path, 'r') as db:
+        assert len(list(db.keys())) == 3*200
+        assert db['a-1'].read() == b'x'*10
+        assert 'b-3' not in db
+
+
+def test_compaction_by_another_instance(tmp_path, monkeypatch):
+    monkeypatch.setattr(segments, 'refresh_interval', 0)
+    with open_db(tmp_path, 'n', segment_size=2048) as writer, open_db(tmp_path, 'w', segment_size=2048) as compactor:
+        for i in range(200):
+            compactor['tmp-{}'.format(i)] = b'x'*20
+        writer['seen'] = b'x'
+        for i in range(200):
+            del compactor['tmp-{}'.format(i)]
+
+        ## The writer keeps its own records while segments it has scanned are compacted away
+        for round_n in range(20):
+            for i in range(10):
+                writer['{}-{}'.format(round_n, i)] = b'y'*20
+            compactor.compact_segments(0.0)
+            for i in range(10):
+                assert writer['{}-{}'.format(round_n, i)].read() == b'y'*20
+        assert len(writer) == 201
+        del writer['0-0']
+        assert writer.get('0-0') is None
+
+
+def _write_and_read_back(db_path, tag):
+    with open_db(db_path, 'w', locking=True, manifest=True, segment_size=4096) as db:
+        for i in range(200):
+            db['{}-{}'.format(tag, i)] = b'x'*10
+            assert db['{}-{}'.format(tag, i)].read() == b'x'*10
+            if i % 20 == 0:
+                db.compact_segments(0.3)
+
+
+@pytest.mark.skipif(utils.fcntl is None, reason='needs fcntl')
+def test_compaction_while_other_processes_write(tmp_path):
+    open_db(tmp_path, 'n', manifest=True).close()
+    ctx = multiprocessing.get_context('fork')
+    procs = [ctx.Process(target=_write_and_read_back, args=(tmp_path, tag)) for tag in 'abcd']
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+        assert proc.exitcode == 0
+
+    with open_db(tmp_path, 'r') as db:
+        assert len(db) == 4*200
+        assert all(db[key].read() == b'x'*10 for key in db.keys())
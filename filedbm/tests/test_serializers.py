@@ -0,0 +1,76 @@
+import pytest
+
+import filedbm
+from filedbm import serializers
+
+
+def test_serializers(tmp_path):
+    with filedbm.open(tmp_path, 'n', serializer='pickle') as db:
+        db['a'] = {'x': [1, 2]}
+        assert db['a'] == {'x': [1, 2]}
+        assert db.get('missing') is None
+
+        db.set('j', {'k': 1}, serializer='json')
+        assert db.get('j', serializer='json') == {'k': 1}
+        assert db.get('j', serializer='bytes') == b'{"k": 1}'
+
+        assert dict(db.items(['a'])) == {'a': {'x': [1, 2]}}
+        assert db.get_many(['a', 'zz'], default=0) == [{'x': [1, 2]}, 0]
+
+    ## Without a serializer the stored bytes come back as a file object
+    with filedbm.open(tmp_path, 'r') as db:
+        assert db['j'].read() == b'{"k": 1}'
+
+
+def test_msgpack(tmp_path):
+    pytest.importorskip('msgpack')
+    with filedbm.open(tmp_path, 'n', serializer='msgpack') as db:
+        db['m'] = [1, 'a']
+        assert db['m'] == [1, 'a']
+
+
+def test_numpy(tmp_path):
+    np = pytest.importorskip('numpy')
+    arr = np.arange(1000000, dtype='f8').reshape(1000, 1000)
+    with filedbm.open(tmp_path, 'n', serializer='numpy') as db:
+        db['arr'] = arr
+        result = db['arr']
+        assert result.shape == arr.shape
+        assert np.array_equal(result, arr)
+        ## Large arrays are read only views over the mapped file
+        assert not result.flags.writeable
+        del result
+
+        fortran = np.asfortranarray(np.arange(12).reshape(3, 4))
+        db['f'] = fortran
+        result = db['f']
+        assert np.array_equal(result, fortran)
+        assert result.flags.f_contiguous
+
+        strided = arr[::7, ::3]
+        db['strided'] = strided
+        assert np.array_equal(db['strided'], strided)
+
+        db['scalar'] = np.float32(3)
+        assert db['scalar'] == 3
+
+        structured = np.array([(1, 2.)], dtype=[('a', 'i4'), ('b', 'f8')])
+        db['structured'] = structured
+        assert db['structured'] == structured
+
+    with filedbm.open(tmp_path, 'w', serializer='numpy', compression='zlib') as db:
+        db['c'] = arr[:100]
+        assert np.array_equal(db['c'], arr[:100])
+
+
+def test_unknown_serializer(tmp_path):
+    with pytest.raises(ValueError):
+        filedbm.open(tmp_path, 'n', serializer='yaml')
+    assert 'pickle' in serializers.serializers
+
+
+def test_missing_package(tmp_path, monkeypatch):
+    monkeypatch.setitem(serializers.registry.packages, 'msgpack', ('msgpack', None))
+    assert not serializers.serializer_available('msgpack')
+    with pytest.raises(ImportError):
+        filedbm.open(tmp_path, 'n', serializer='msgpack')
@@ -0,0 +1,82 @@
+import os
+import asyncio
+import subprocess
+
+import pytest
+
+import filedbm
+from filedbm import utils
+
+
+def generated(n):
+    return (bytes([i % 256])*1000 for i in range(n))
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'compression': 'zlib'}, {'segment_max_value_size': 1000}, {'dedup': True, 'metrics': True}, {'manifest': True, 'shard_depth': 1}])
+def test_stream_values(tmp_path, kwargs):
+    with filedbm.open(tmp_path, 'n', **kwargs) as db:
+        db['gen'] = generated(300)
+        assert db['gen'].read() == b''.join(generated(300))
+        db['small'] = iter([b'ab', b'cd'])
+        assert db['small'].read() == b'abcd'
+        db['list'] = [b'x', b'y']
+        assert db['list'].read() == b'xy'
+        db['empty'] = iter([])
+        assert db['empty'].read() == b''
+        db['bytes'] = b'plain'
+        assert db['bytes'].read() == b'plain'
+
+        if kwargs.get('manifest'):
+            assert db._manifest.entries()[utils.hash_key(b'gen')][1] == 300000
+        if kwargs.get('metrics'):
+            assert db.stats()['ops']['set']['count'] == 5
+
+
+@pytest.mark.skipif(not os.path.exists('/dev/zero'), reason='needs /dev/zero')
+def test_pipe(tmp_path):
+    with filedbm.open(tmp_path, 'n') as db:
+        proc = subprocess.Popen(['head', '-c', '3000000', '/dev/zero'], stdout=subprocess.PIPE)
+        db['pipe'] = proc.stdout
+        proc.wait()
+        proc.stdout.close()
+        assert db['pipe'].read() == bytes(3000000)
+
+
+def test_open_writer(tmp_path):
+    with filedbm.open(tmp_path, 'n') as db:
+        with db.open_writer('w', ttl=100) as w:
+            for i in range(100):
+                w.write(b'%05d' % i)
+            assert 'w' not in db
+        assert db['w'].read() == b''.join(b'%05d' % i for i in range(100))
+        assert utils.field_expiry in db['w'].fields
+
+        ## A writer that fails leaves the old value
+        with pytest.raises(RuntimeError):
+            with db.open_writer('w') as w:
+                w.write(b'zzz')
+                raise RuntimeError
+        assert db['w'].read()[:5] == b'00000'
+        assert not os.listdir(tmp_path.joinpath(utils.sys_dir_name, utils.tmp_dir_name))
+
+
+def test_serializer(tmp_path):
+    with filedbm.open(tmp_path, 'n', serializer='pickle') as db:
+        ## With a serializer lists are values, not streams
+        db['l'] = [1, 2]
+        assert db['l'] == [1, 2]
+        with db.open_writer('raw') as w:
+            w.write(b'raw')
+        assert db.get('raw', serializer='bytes') == b'raw'
+
+
+def test_async_writer(tmp_path):
+    async def main():
+        async with await filedbm.open_async(tmp_path, 'n') as db:
+            async with db.open_writer('a') as w:
+                await w.write(b'hello ')
+                await w.write(b'world')
+            value = await db.get('a')
+            assert await value.read() == b'hello world'
+
+    asyncio.run(main())
@@ -8,28 +8,176 @@ Created on Thu Jan  5 11:04:13 2023
 import pathlib
 import os
 import io
+import errno
+import stat as stat_mod
 from hashlib import blake2b, blake2s
 # from time import time
-from typing import Any, Generic, Iterator, Union
+from itertools import islice
+from threading import Lock, Timer
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from . import compression
+from . import checksums
+from typing import Any, Generic, Iterable, Iterator, Union
 import mmap
+import json
+import struct
 from time import time
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 ############################################
 ### Parameters
 
 key_hash_len = 13
 
+sys_dir_name = '.filedbm'
+meta_file_name = 'meta.json'
+manifest_file_name = 'manifest'
+
+tmp_dir_name = 'tmp'
+
+shard_width = 2
+
+durability_levels = ('none', 'per-write', 'group')
+
+## A group commit is made once this many writes are pending or after this many seconds
+group_commit_size = 1000
+group_commit_delay = 1.0
+
+## Temporary files older than this (in seconds) are considered left behind by a crashed writer
+stale_tmp_age = 3600
+
+## Values up to this size are read with a single pread instead of being memory mapped
+pread_max_size = 65536
+
+## Number of keys handed to the thread pool at a time when iterating over given keys
+bulk_chunk_size = 256
+
+## Number of data files read by each thread pool task when iterating with prefetch
+prefetch_chunk_size = 32
+
+## Data blocks can end with a trailer of extra fields: tag/length/data fields, the total fields length and the magic
+trailer_magic = b'\xfd\x7e'
+trailer_end_struct = struct.Struct('<H2s')
+
+## Trailer field tags
+field_expiry = 1
+field_codec = 2
+field_blob = 3
+field_checksum = 4
+
+expiry_struct = struct.Struct('<d')
+
+## Deduplicated values are stored once in .filedbm/blobs under the hash of their content; the data file of a key only holds the content hash and length
+blobs_dir_name = 'blobs'
+content_hash_len = 32
+blob_struct = struct.Struct('<{}sQ'.format(content_hash_len))
+
+## Smaller values aren't deduplicated, as a blob and its links would cost more than the value itself
+dedup_min_size = 4096
+
+## FileDBM.verify checks the data files in chunks of this many files per task
+verify_chunk_size = 64
+quarantine_dir_name = 'quarantine'
+
+## The results of verify_data_file that mean the value couldn't be checked against a checksum
+unverified_statuses = ('no checksum', 'checksum unavailable')
+
+## The max number of index entries checked by a single expire call and how often writes run it when there's no sweeper
+expire_batch_size = 10000
+expire_check_interval = 60
+
+## Extra bytes read together with the fixed size header so that the key is usually fetched in the same pread
+header_read_size = 256
+
+## The ioctl that reflinks a whole file (Linux; btrfs, XFS and others)
+ficlone = 0x40049409
+
+## Errors that mean a kernel-side copy isn't supported for the given file descriptors (rather than an I/O error)
+kernel_copy_errnos = {errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF, errno.EPERM}
+
+## Chunk size of the pread/write fallback of kernel-side copies
+copy_chunk_size = 1048576
+
 
 ############################################
 ### Classes
 
 
 class FileObjectReadSlice(io.IOBase):
-    def __init__(self, file_path: Union[pathlib.Path, str], offset: int, length: int):
+    """
+    A read-only file-like object over the value part of a data block. The file is opened once (or an already open file descriptor is handed over) and kept open for the life of the object. Small values are read in a single pread, larger values are memory mapped once. The file descriptor and mapping are released on close() or when used as a context manager.
+    """
+    def __init__(self, file_path: Union[pathlib.Path, str], offset: int, length: int, fd: int=None, stat: os.stat_result=None, fields: dict=None):
         self.f = file_path
         self.f_offset = offset
         self.offset = 0
         self.length = length
+        self.stat = stat
+        self.fields = {} if fields is None else fields
+        self._fd = fd
+        self._mm = None
+        self._buf = None
+        self._verify = None
+
+    @classmethod
+    def from_buffer(cls, buffer: bytes, file_path: Union[pathlib.Path, str]=None, stat: os.stat_result=None, fields: dict=None):
+        """
+        Create a slice over a value that is already in memory (e.g. a small value read in one go or from the value cache).
+        """
+        value = cls(file_path, 0, len(buffer), stat=stat, fields=fields)
+        value._buf = memoryview(buffer)
+
+        return value
+
+    def _get_buffer(self):
+        """
+        Load the value buffer on first access.
+        """
+        if self._buf is None:
+            if self.closed:
+                raise ValueError('I/O operation on closed file.')
+            if self._fd is None:
+                self._fd = os.open(self.f, os.O_RDONLY)
+            if self.length <= pread_max_size:
+                self._buf = memoryview(os.pread(self._fd, self.length, self.f_offset))
+                self._close_fd()
+            else:
+                self._mm = mmap.mmap(self._fd, 0, access=mmap.ACCESS_READ)
+                self._close_fd()
+                self._buf = memoryview(self._mm)[self.f_offset:self.f_offset + self.length]
+
+        return self._buf
+
+    def _close_fd(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def prefetch(self):
+        """
+        Read a small value into memory now (releasing the file handle). Large values are left to be mapped on first read.
+        """
+        if self.length <= pread_max_size:
+            self._get_buffer()
+
+    @property
+    def holds_file(self):
+        """
+        Whether the value holds a file descriptor or a memory map (a large value).
+        """
+        return self._fd is not None or self._mm is not None
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
 
     def seek(self, offset, whence=0):
         if whence == os.SEEK_SET:
@@ -47,18 +195,484 @@ class FileObjectReadSlice(io.IOBase):
     def tell(self):
         return self.offset
 
+    def view(self, size=-1):
+        """
+        Like read, but returns a memoryview that points straight into the loaded value (no copy). The view is only valid while it is referenced; the underlying mapping stays alive until all views are released.
+        """
+        buf = self._get_buffer()
+        if size < 0:
+            size = self.length - self.offset
+        size = max(0, min(size, self.length - self.offset))
+        start = self.offset
+        self.offset += size
+
+        if self._verify is not None:
+            self._check(buf[start:start + size], start)
+
+        return buf[start:start + size]
+
+    def verify_checksum(self, checksum, digest):
+        """
+        Check the value against the digest of its checksum once it has been read to the end. Only a value read from start to end in order (in any number of reads) is checked; reading elsewhere turns the check off. A ChecksumError is raised by the read that completes a value that doesn't match.
+        """
+        self._verify = (checksum.new(), digest)
+        self._verified_len = 0
+
+    def _check(self, data, start):
+        if start != self._verified_len:
+            self._verify = None
+            return
+
+        hasher, digest = self._verify
+        hasher.update(data)
+        self._verified_len += len(data)
+        if self._verified_len == self.length:
+            self._verify = None
+            if hasher.digest() != digest:
+                raise checksums.ChecksumError('The value in ' + str(self.f) + ' doesn\'t match its checksum.')
+
     def read(self, size=-1):
+        return bytes(self.view(size))
+
+    def copy_to(self, out, size=-1):
+        """
+        Copy the value (from the current position) to a file object, file descriptor or socket. A value that hasn't been loaded into memory is copied by the kernel (copy_file_range or sendfile) without passing through Python. Returns the number of bytes copied.
+        """
+        if self._buf is not None or self.closed or self._verify is not None:
+            return write_all(out, self.view(size))
+
         if size < 0:
             size = self.length - self.offset
         size = max(0, min(size, self.length - self.offset))
-        with io.open(self.f, 'rb', buffering=0) as file:
-            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
-                mm.seek(self.offset + self.f_offset)
-                b1 = mm.read(size)
-                mm.close()
-                file.close()
-                self.offset += size
-                return b1
+        if self._fd is None:
+            self._fd = os.open(self.f, os.O_RDONLY)
+
+        if hasattr(out, 'sendfile'):
+            ## A socket; socket.sendfile deals with timeouts and falls back to send
+            with io.open(self._fd, 'rb', closefd=False) as f:
+                n = out.sendfile(f, self.f_offset + self.offset, size)
+        elif isinstance(out, int):
+            n = copy_fd_range(out, self._fd, self.f_offset + self.offset, size)
+        else:
+            try:
+                out_fd = out.fileno()
+            except (AttributeError, OSError):
+                return write_all(out, self.view(size))
+            out.flush()
+            n = copy_fd_range(out_fd, self._fd, self.f_offset + self.offset, size)
+            if out.seekable():
+                ## Resync the position of a buffered file object with its file descriptor
+                out.seek(0, io.SEEK_CUR)
+        self.offset += n
+
+        return n
+
+    def readinto(self, b):
+        with memoryview(b) as dest:
+            dest = dest.cast('B')
+            view = self.view(len(dest))
+            n = len(view)
+            dest[:n] = view
+
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._close_fd()
+            if self._buf is not None:
+                self._buf.release()
+                self._buf = None
+            if self._mm is not None:
+                try:
+                    self._mm.close()
+                except BufferError:
+                    ## Views handed out are still in use; the mapping is unmapped once they are garbage collected
+                    pass
+                self._mm = None
+        super().close()
+
+
+class FileObjectDecompressSlice(FileObjectReadSlice):
+    """
+    A FileObjectReadSlice over a compressed value. The length and offsets are those of the uncompressed value. Reads decompress the value in buffer_size chunks so a large value is never held fully in memory. Seeking forward decompresses and discards up to the new position and seeking backward restarts the decompression. view() can't point into the file, so it returns a view of the decompressed bytes.
+    """
+    def __init__(self, raw: FileObjectReadSlice, codec, length: int, buffer_size: int=512000):
+        super().__init__(raw.f, raw.f_offset, length, None, raw.stat, raw.fields)
+        self._raw = raw
+        self._codec = codec
+        self._buffer_size = buffer_size
+        self._chunks = None
+        self._pending = b''
+        self._pending_pos = 0
+
+    def _restart(self):
+        self._raw.seek(0)
+        self._chunks = self._codec.decompress_chunks(self._raw, self._buffer_size)
+        self._pending = b''
+        self._pending_pos = 0
+
+    def prefetch(self):
+        self._raw.prefetch()
+
+    @property
+    def holds_file(self):
+        return self._raw.holds_file
+
+    def read(self, size=-1):
+        if self.closed:
+            raise ValueError('I/O operation on closed file.')
+        if size < 0:
+            size = self.length - self.offset
+        size = max(0, min(size, self.length - self.offset))
+
+        if self._chunks is None or self.offset < self._pending_pos:
+            self._restart()
+
+        pos = self.offset
+        out = []
+        n = 0
+        while n < size:
+            start = pos - self._pending_pos
+            if start < len(self._pending):
+                piece = self._pending[start:start + size - n]
+                out.append(piece)
+                n += len(piece)
+                pos += len(piece)
+            else:
+                self._pending_pos += len(self._pending)
+                self._pending = next(self._chunks, b'')
+                if not self._pending:
+                    break
+
+        self.offset = pos
+
+        return b''.join(out)
+
+    def view(self, size=-1):
+        return memoryview(self.read(size))
+
+    def copy_to(self, out, size=-1):
+        """
+        Copy the decompressed value to a file object, file descriptor or socket in buffer_size chunks. Returns the number of bytes copied.
+        """
+        if size < 0:
+            size = self.length - self.offset
+        n = 0
+        while n < size:
+            chunk = self.read(min(self._buffer_size, size - n))
+            if not chunk:
+                break
+            n += write_all(out, chunk)
+
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._raw.close()
+            self._chunks = None
+            self._pending = b''
+        super().close()
+
+
+class DataBlock:
+    """
+    The parsed header, key and trailer fields of a data file (see open_data_block).
+    """
+    __slots__ = ('file_path', 'fd', 'stat', 'key', 'value_pos', 'value_len', 'fields', 'data')
+
+    def __init__(self, file_path, fd, stat, key, value_pos, value_len, fields, data):
+        self.file_path = file_path
+        self.fd = fd
+        self.stat = stat
+        self.key = key
+        self.value_pos = value_pos
+        self.value_len = value_len
+        self.fields = fields
+        self.data = data
+
+
+class DataBlockWriter:
+    """
+    Write a data block from a value streamed in chunks, so its length doesn't need to be known in advance (pipes, sockets, generators). The chunks go straight to a temporary file (in the tmp folder unless tmp_path is given); the value length in the header is written by finish once the value is complete and commit renames the file into place, so readers only ever see the complete value. With a compressor the first compressor.min_size bytes are held back to decide whether to compress; a streamed value is compressed even if it doesn't shrink, as it can't be read again.
+    """
+    def __init__(self, db_path, key, n_bytes_key, n_bytes_value, compressor=None, tmp_path=None, checksum=None):
+        self.key = key
+        self.length = 0
+        self.stat = None
+        self._n_bytes_key = n_bytes_key
+        self._n_bytes_value = n_bytes_value
+        self._compressor = compressor
+        self._compressobj = None
+        self._head = [] if compressor is not None else None
+        self._checksum = checksum
+        self._hasher = None if checksum is None else checksum.new()
+        self.value_len = 0
+        if tmp_path is None:
+            self.tmp_path, fd = open_tmp_file(db_path, hash_key(key))
+        else:
+            self.tmp_path = tmp_path
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        self._file = io.open(fd, 'wb')
+        self._file.write(int_to_bytes(len(key), n_bytes_key) + int_to_bytes(0, n_bytes_value) + key)
+
+    @classmethod
+    def from_file(cls, tmp_path, n_bytes_key, n_bytes_value):
+        """
+        A writer over a data block that was finished earlier (e.g. staged by a batch), ready to be committed. Raises FileNotFoundError if the file doesn't exist.
+        """
+        writer = cls.__new__(cls)
+        writer.tmp_path = tmp_path
+        writer.length = None
+        writer._file = None
+        with io.open(tmp_path, 'rb') as f:
+            writer.stat = os.fstat(f.fileno())
+            head = f.read(n_bytes_key + n_bytes_value)
+        writer.key = None
+        writer.value_len = bytes_to_int(head[n_bytes_key:])
+
+        return writer
+
+    def write(self, data):
+        """
+        Write the next chunk of the value. Returns the number of bytes taken.
+        """
+        n = len(data)
+        self.length += n
+        if self._head is not None:
+            self._head.append(bytes(data))
+            if self.length < self._compressor.min_size:
+                return n
+            data = b''.join(self._head)
+            self._head = None
+            self._compressobj = self._compressor.compressobj()
+        if self._compressobj is not None:
+            data = self._compressobj.compress(data)
+        self._write_value_data(data)
+
+        return n
+
+    def _write_value_data(self, data):
+        self._file.write(data)
+        self.value_len += len(data)
+        if self._hasher is not None:
+            self._hasher.update(data)
+
+    def write_from(self, value, buffer_size):
+        """
+        Write all the chunks of an iterable of bytes or everything read from a file object (in buffer_size chunks).
+        """
+        if hasattr(value, 'read'):
+            chunk = value.read(buffer_size)
+            while chunk:
+                self.write(chunk)
+                chunk = value.read(buffer_size)
+        else:
+            for chunk in value:
+                self.write(chunk)
+
+    def finish(self, fields=None, durability='none'):
+        """
+        Complete the data block: flush the compressor, write the trailer with fields and the value length in the header. The file is fsynced with durability 'per-write'. The temporary file is removed if anything fails. Returns the os.stat_result of the file.
+        """
+        try:
+            if self._head is not None:
+                self._write_value_data(b''.join(self._head))
+            elif self._compressobj is not None:
+                self._write_value_data(self._compressobj.flush())
+                if fields is None:
+                    fields = {}
+                fields[field_codec] = compression.codec_struct.pack(self._compressor.codec.codec_id, self.length)
+            if self._hasher is not None:
+                if fields is None:
+                    fields = {}
+                fields[field_checksum] = checksums.encode_field(self._checksum, self._hasher.digest())
+            if self.value_len >= 256**self._n_bytes_value:
+                raise ValueError('The value is too long for n_bytes_value.')
+
+            if fields:
+                self._file.write(encode_trailer(fields))
+            self._file.seek(self._n_bytes_key)
+            self._file.write(int_to_bytes(self.value_len, self._n_bytes_value))
+
+            self._file.flush()
+            if durability == 'per-write':
+                os.fsync(self._file.fileno())
+            self.stat = os.fstat(self._file.fileno())
+            self._file.close()
+        except BaseException:
+            self.abort()
+            raise
+
+        return self.stat
+
+    def commit(self, file_path, fields=None, durability='none', committer=None):
+        """
+        Finish the data block (unless that has been done already, in which case fields is ignored) and atomically rename it into place. Returns the os.stat_result of the written file.
+        """
+        if self.stat is None:
+            self.finish(fields, durability)
+        try:
+            replace_file(self.tmp_path, file_path)
+        except BaseException:
+            self.abort()
+            raise
+
+        commit_file(file_path, durability, committer)
+
+        return self.stat
+
+    def abort(self):
+        """
+        Discard the value and remove the temporary file.
+        """
+        if self._file is not None:
+            self._file.close()
+        try:
+            os.unlink(self.tmp_path)
+        except FileNotFoundError:
+            pass
+
+
+class GroupCommitter:
+    """
+    Batches the fsyncs of many writes into one commit. Files and directories are collected by add() and fsynced together once max_pending files are pending, once max_delay seconds have passed since the first pending write (via a timer thread), or when commit() is called explicitly (e.g. by FileDBM.sync or close).
+    """
+    def __init__(self, max_pending: int=group_commit_size, max_delay: float=group_commit_delay):
+        self.max_pending = max_pending
+        self.max_delay = max_delay
+        self._lock = Lock()
+        self._commit_lock = Lock()
+        self._files = set()
+        self._dirs = set()
+        self._timer = None
+
+    def add(self, file_path, is_file=True):
+        with self._lock:
+            if is_file:
+                self._files.add(file_path)
+            self._dirs.add(file_path.parent)
+            commit_now = len(self._files) >= self.max_pending
+            if not commit_now and self._timer is None:
+                self._timer = Timer(self.max_delay, self.commit)
+                self._timer.daemon = True
+                self._timer.start()
+
+        if commit_now:
+            self.commit()
+
+    def commit(self):
+        with self._commit_lock:
+            with self._lock:
+                files = self._files
+                dirs = self._dirs
+                self._files = set()
+                self._dirs = set()
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+
+            for file_path in files:
+                try:
+                    fsync_path(file_path)
+                except FileNotFoundError:
+                    ## Deleted since; its directory is synced below
+                    pass
+
+            for dir_path in dirs:
+                try:
+                    fsync_dir(dir_path)
+                except FileNotFoundError:
+                    pass
+
+
+class ValueCache:
+    """
+    Thread-safe in-memory LRU cache of small values limited by the total bytes held. Each entry keeps the inode, mtime and size of the data file it was read from, so a cheap stat is enough to detect that the value was changed (e.g. by another process; atomic writes always create a new inode).
+    """
+    def __init__(self, max_size: int, max_value_size: int):
+        self.max_size = max_size
+        self.max_value_size = max_value_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, ttl=None):
+        """
+        Get a cached value as a FileObjectReadSlice if it's still valid, otherwise None.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+
+        if entry is not None:
+            file_path, signature, data, fields = entry
+            try:
+                stat = os.stat(file_path)
+            except FileNotFoundError:
+                stat = None
+
+            if stat is not None and signature == (stat.st_ino, stat.st_mtime_ns, stat.st_size) and not is_expired(stat.st_mtime, fields, ttl):
+                with self._lock:
+                    if key in self._entries:
+                        self._entries.move_to_end(key)
+                    self.hits += 1
+
+                return FileObjectReadSlice.from_buffer(data, file_path, stat, fields)
+            else:
+                self.pop(key)
+
+        with self._lock:
+            self.misses += 1
+
+        return None
+
+    def put(self, key, file_path, stat, data, fields=None):
+        """
+
+        """
+        size = len(data)
+        if size > self.max_value_size:
+            return
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[2])
+            self._entries[key] = (file_path, (stat.st_ino, stat.st_mtime_ns, stat.st_size), data, {} if fields is None else fields)
+            self.size += size
+            while self.size > self.max_size:
+                _, (_, _, old_data, _) = self._entries.popitem(last=False)
+                self.size -= len(old_data)
+                self.evictions += 1
+
+    def pop(self, key):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[2])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def reset_counters(self):
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def after_fork(self):
+        self._lock = Lock()
+
+    def info(self):
+        """
+
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'entries': len(self._entries), 'size': self.size, 'max_size': self.max_size, 'max_value_size': self.max_value_size}
 
 
 ############################################
@@ -97,175 +711,1274 @@ def determine_obj_size(file_obj):
     return size
 
 
-def get_data_block(file_path, key, value, n_bytes_key, n_bytes_value):
+def is_stream(value):
     """
-    Function to get either the key or the value or both from a data block.
+    True for values whose length can't be known before they have been read: file objects that can't seek (pipes, sockets, HTTP bodies) and iterables of bytes chunks (e.g. generators).
     """
-    with io.open(file_path, 'rb', buffering=0) as file:
-        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
-            if key and value:
-                key_len_value_len = mm.read(n_bytes_key + n_bytes_value)
-                key_len = bytes_to_int(key_len_value_len[:n_bytes_key])
-                value_len = bytes_to_int(key_len_value_len[n_bytes_key:])
-                key_value = mm.read(key_len + value_len)
-                key = key_value[:key_len]
-                value = FileObjectReadSlice(file_path, n_bytes_key + n_bytes_value + key_len, value_len)
+    if isinstance(value, (bytes, bytearray, memoryview, str)):
+        return False
+    if hasattr(value, 'read'):
+        seekable = getattr(value, 'seekable', None)
+        return seekable is None or not seekable()
 
-                return key.decode(), value
+    return isinstance(value, Iterable)
 
-            elif key:
-                key_len = bytes_to_int(mm.read(n_bytes_key))
-                mm.seek(n_bytes_value, 1)
-                key = mm.read(key_len)
 
-                return key.decode()
+def chunks(iterable, size):
+    """
+    Split an iterable into lists of at most size items.
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
 
-            elif value:
-                key_len_value_len = mm.read(n_bytes_key + n_bytes_value)
-                key_len = bytes_to_int(key_len_value_len[:n_bytes_key])
-                value_len = bytes_to_int(key_len_value_len[n_bytes_key:])
-                value = FileObjectReadSlice(file_path, n_bytes_key + n_bytes_value + key_len, value_len)
 
-                return value
-            else:
-                raise ValueError('One or both key and value must be True.')
+def next_chunk(iterator, size):
+    """
+    Get the next (up to) size items from an iterator as a list.
+    """
+    return list(islice(iterator, size))
 
 
-def get_value(db_path, key, n_bytes_key, n_bytes_value, ttl=None):
+def next_values_chunk(iterator, size, max_open):
     """
+    Get the next (up to) size (key, value) items from an iterator as a list. Small values (that haven't been deserialized) are read into memory, which releases their file descriptors; the chunk ends early once max_open values that still hold one (large values) have been taken.
+    """
+    chunk = []
+    n_open = 0
+    for item in iterator:
+        value = item[1]
+        chunk.append(item)
+        if isinstance(value, FileObjectReadSlice):
+            value.prefetch()
+            if value.holds_file:
+                n_open += 1
+        if len(chunk) >= size or n_open >= max_open:
+            break
+
+    return chunk
+
+
+def key_file_path(db_path, key_hash, shard_depth=0):
+    """
+    Get the path of the data file for a hashed key. With a shard_depth > 0 the file is nested in subdirectories named by the leading hex characters of the hash (e.g. ab/cd/<hash> for a shard_depth of 2).
+    """
+    if shard_depth:
+        parts = [key_hash[i*shard_width:(i+1)*shard_width] for i in range(shard_depth)]
+        return db_path.joinpath(*parts, key_hash)
+    else:
+        return db_path.joinpath(key_hash)
+
 
+def check_shard_depth(shard_depth):
     """
-    key_bytes_len = len(key)
-    key_hash = hash_key(key)
-    file_path = db_path.joinpath(key_hash)
-    if file_path.exists():
-        if ttl is not None:
-            if (time() - os.path.getmtime(file_path)) > ttl:
-                file_path.unlink()
-                return None
 
-        file_len = file_path.stat().st_size
+    """
+    if not isinstance(shard_depth, int) or not (0 <= shard_depth < key_hash_len):
+        raise ValueError('shard_depth must be an int between 0 and ' + str(key_hash_len - 1) + '.')
 
-        value_pos = n_bytes_key + n_bytes_value + key_bytes_len
 
-        out = FileObjectReadSlice(file_path, value_pos, file_len - value_pos)
+def is_data_file_name(name):
+    """
 
-        return out
-    else:
+    """
+    return len(name) == key_hash_len*2 and not name.startswith('.')
+
+
+def is_shard_dir_name(name):
+    """
+
+    """
+    return len(name) == shard_width and not name.startswith('.')
+
+
+def iter_data_entries(db_path, max_depth=0):
+    """
+    Iterate over the os.DirEntry objects of all data files in the database. Shard directories are descended into up to max_depth levels, which also covers databases that are partially migrated between layouts. The file types come from the directory listing, so no stat calls are made (entry.stat() makes one on first use and caches it).
+    """
+    with os.scandir(db_path) as it:
+        dirs = []
+        for entry in it:
+            name = entry.name
+            if is_data_file_name(name):
+                if entry.is_file():
+                    yield entry
+            elif max_depth and is_shard_dir_name(name):
+                if entry.is_dir():
+                    dirs.append(entry.path)
+
+    for dir_path in dirs:
+        yield from iter_data_entries(dir_path, max_depth - 1)
+
+
+def iter_data_paths(db_path, max_depth=0):
+    """
+    Iterate over all data file paths in the database (see iter_data_entries).
+    """
+    for entry in iter_data_entries(db_path, max_depth):
+        yield pathlib.Path(entry.path)
+
+
+def read_meta(db_path):
+    """
+    Read the database metadata. Returns an empty dict if the database has no metadata (e.g. it was created by an older version).
+    """
+    meta_path = db_path.joinpath(sys_dir_name, meta_file_name)
+    try:
+        with io.open(meta_path, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def meta_mtime(db_path):
+    """
+
+    """
+    try:
+        stat = os.stat(db_path.joinpath(sys_dir_name, meta_file_name))
+        return stat.st_ino, stat.st_mtime_ns
+    except FileNotFoundError:
         return None
 
 
-def iter_keys_values(db_path, key=False, value=False, n_bytes_key=2, n_bytes_value=4, ttl=None):
+def write_meta(db_path, meta):
+    """
+    Write the database metadata atomically via a temporary file and rename.
     """
+    sys_path = db_path.joinpath(sys_dir_name)
+    sys_path.mkdir(exist_ok=True)
+    meta_path = sys_path.joinpath(meta_file_name)
+    tmp_path = sys_path.joinpath(meta_file_name + '.' + str(os.getpid()) + '.tmp')
+    with io.open(tmp_path, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, meta_path)
+
 
+def move_data_file(old_path, new_path):
+    """
+    Move a data file without overwriting an existing file at the new path. If the new path already exists (e.g. the key was written during a migration), the old file is stale and is simply removed.
+    """
+    try:
+        os.link(old_path, new_path)
+    except FileExistsError:
+        pass
+    except FileNotFoundError:
+        if not old_path.exists():
+            return
+        new_path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.link(old_path, new_path)
+        except FileExistsError:
+            pass
+
+    try:
+        old_path.unlink()
+    except FileNotFoundError:
+        pass
+
+
+def migrate_layout(db_path, shard_depth):
     """
-    for file_path in db_path.iterdir():
-        if ttl is not None:
-            if (time() - os.path.getmtime(file_path)) > ttl:
-                file_path.unlink()
-                continue
+    Convert a database to a different shard_depth layout. The migration is online: the target layout is recorded in the metadata first (together with the previous layout) so that lookups fall back to the old location until every file has been moved. Files are moved with link/unlink so that values written during the migration are never overwritten by stale copies.
+    """
+    check_shard_depth(shard_depth)
+    db_path = pathlib.Path(db_path)
+    meta = read_meta(db_path)
+    old_depth = meta.get('shard_depth', 0)
+    prev_depth = meta.get('prev_shard_depth')
+
+    if prev_depth is None:
+        if old_depth == shard_depth:
+            return
+        max_depth = max(old_depth, shard_depth)
+        meta['shard_depth'] = shard_depth
+        meta['prev_shard_depth'] = old_depth
+        write_meta(db_path, meta)
+    elif old_depth == shard_depth:
+        ## Resume an interrupted migration
+        max_depth = max(old_depth, prev_depth)
+    else:
+        raise ValueError('A migration to shard_depth ' + str(old_depth) + ' is in progress. It must be completed before migrating to another layout.')
+
+    for file_path in list(iter_data_paths(db_path, max_depth)):
+        new_path = key_file_path(db_path, file_path.name, shard_depth)
+        if file_path != new_path:
+            move_data_file(file_path, new_path)
 
-        yield get_data_block(file_path, key, value, n_bytes_key, n_bytes_value)
+    remove_empty_shard_dirs(db_path)
 
+    del meta['prev_shard_depth']
+    write_meta(db_path, meta)
 
-def write_data_block(db_path, key, value, n_bytes_key, n_bytes_value, buffer_size):
+
+def remove_empty_shard_dirs(db_path):
     """
 
     """
-    key_bytes_len = len(key)
-    key_hash = hash_key(key)
+    for path in db_path.iterdir():
+        if is_shard_dir_name(path.name) and path.is_dir():
+            remove_empty_shard_dirs(path)
+            try:
+                path.rmdir()
+            except OSError:
+                pass
 
-    if isinstance(value, bytes):
-        value = io.BytesIO(value)
 
-    value_bytes_len = determine_obj_size(value)
+def encode_trailer(fields):
+    """
+    Encode the extra fields of a data block. Each field is stored as tag (1 byte), length (1 byte) and data, followed by the total length of the fields and the trailer magic.
+    """
+    b = b''.join(bytes((tag, len(data))) + data for tag, data in fields.items())
+
+    return b + trailer_end_struct.pack(len(b), trailer_magic)
+
+
+def decode_trailer(trailer):
+    """
+    Decode the trailer of a data block into a dict of tag -> bytes. A trailer that isn't valid (e.g. from a damaged file) gives an empty dict.
+    """
+    fields = {}
+    if len(trailer) < trailer_end_struct.size:
+        return fields
+    fields_len, magic = trailer_end_struct.unpack_from(trailer, len(trailer) - trailer_end_struct.size)
+    if magic != trailer_magic or fields_len != len(trailer) - trailer_end_struct.size:
+        return fields
+
+    pos = 0
+    while pos < fields_len:
+        tag = trailer[pos]
+        data_len = trailer[pos + 1]
+        fields[tag] = bytes(trailer[pos + 2:pos + 2 + data_len])
+        pos += 2 + data_len
+
+    return fields
+
+
+def parse_data_block(data, n_bytes_key, n_bytes_value):
+    """
+    Parse a complete data block held in memory (e.g. a record of a segment file). Returns the key, value position, value length and trailer fields.
+    """
+    n_bytes_header = n_bytes_key + n_bytes_value
+    key_len = bytes_to_int(data[:n_bytes_key])
+    value_len = bytes_to_int(data[n_bytes_key:n_bytes_header])
+    value_pos = n_bytes_header + key_len
+    trailer_pos = value_pos + value_len
+    if len(data) > trailer_pos:
+        fields = decode_trailer(data[trailer_pos:])
+    else:
+        fields = {}
+
+    return bytes(data[n_bytes_header:value_pos]), value_pos, value_len, fields
 
-    write_init_bytes = int_to_bytes(key_bytes_len, n_bytes_key) + int_to_bytes(value_bytes_len, n_bytes_value) + key
 
-    file_path = db_path.joinpath(key_hash)
+def make_data_block(key, value, n_bytes_key, n_bytes_value, fields=None, compressor=None, checksum=None):
+    """
+    Create a complete data block in memory from a value in bytes. Used for values small enough to be stored in segment files. The value is compressed and checksummed the same way as by write_data_block.
+    """
+    if compressor is not None and len(value) >= compressor.min_size:
+        compressobj = compressor.compressobj()
+        compressed = compressobj.compress(value) + compressobj.flush()
+        if len(compressed) < len(value):
+            if fields is None:
+                fields = {}
+            fields[field_codec] = compression.codec_struct.pack(compressor.codec.codec_id, len(value))
+            value = compressed
+
+    if checksum is not None:
+        if fields is None:
+            fields = {}
+        hasher = checksum.new()
+        hasher.update(value)
+        fields[field_checksum] = checksums.encode_field(checksum, hasher.digest())
+
+    block = int_to_bytes(len(key), n_bytes_key) + int_to_bytes(len(value), n_bytes_value) + key + value
+    if fields:
+        block += encode_trailer(fields)
+
+    return block
+
+
+def open_data_block(file_path, n_bytes_key, n_bytes_value, load_max_size=pread_max_size):
+    """
+    Open a data file and read its header, key and trailer. Files up to load_max_size bytes are read completely in a single pread and closed again (the contents are in the data attribute); otherwise the fd is left open in the fd attribute for reading the value. Raises FileNotFoundError if the file doesn't exist.
+    """
+    fd = os.open(file_path, os.O_RDONLY)
+    try:
+        stat = os.fstat(fd)
+        file_len = stat.st_size
+        n_bytes_header = n_bytes_key + n_bytes_value
+
+        if file_len <= load_max_size:
+            data = os.pread(fd, file_len, 0)
+            head = data
+        else:
+            data = None
+            head = os.pread(fd, n_bytes_header + header_read_size, 0)
+
+        key_len = bytes_to_int(head[:n_bytes_key])
+        value_len = bytes_to_int(head[n_bytes_key:n_bytes_header])
+        value_pos = n_bytes_header + key_len
+        if len(head) < value_pos:
+            head = os.pread(fd, value_pos, 0)
+        key = head[n_bytes_header:value_pos]
+
+        trailer_pos = value_pos + value_len
+        if file_len > trailer_pos:
+            if data is not None:
+                trailer = data[trailer_pos:]
+            else:
+                trailer = os.pread(fd, file_len - trailer_pos, trailer_pos)
+            fields = decode_trailer(trailer)
+        else:
+            ## A truncated file can't give more than it holds
+            value_len = max(0, min(value_len, file_len - value_pos))
+            fields = {}
+
+        if data is not None:
+            os.close(fd)
+            fd = None
+    except BaseException:
+        os.close(fd)
+        raise
+
+    return DataBlock(file_path, fd, stat, key, value_pos, value_len, fields, data)
+
 
-    with io.open(file_path, 'w+b') as file:
-        _ = file.write(write_init_bytes)
+def close_data_block(block):
+    """
+
+    """
+    if block.fd is not None:
+        os.close(block.fd)
+        block.fd = None
+
+
+def data_block_value(block, buffer_size=512000):
+    """
+    Create the FileObjectReadSlice of the value of an opened data block. The fd (if still open) is handed over to it. Compressed values get a FileObjectDecompressSlice that decompresses in buffer_size chunks.
+    """
+    if block.data is not None:
+        value = FileObjectReadSlice.from_buffer(memoryview(block.data)[block.value_pos:block.value_pos + block.value_len], block.file_path, block.stat, block.fields)
+    else:
+        value = FileObjectReadSlice(block.file_path, block.value_pos, block.value_len, block.fd, block.stat, block.fields)
+        block.fd = None
 
-        if hasattr(value, '_buffer_size'):
-            buffer_size = value._buffer_size
+    return decompress_value(value, buffer_size)
 
+
+def decompress_value(value, buffer_size=512000):
+    """
+    Wrap the value in a FileObjectDecompressSlice if its fields say it's compressed.
+    """
+    codec_field = value.fields.get(field_codec)
+    if codec_field is not None:
+        codec_id, raw_len = compression.codec_struct.unpack(codec_field)
+        try:
+            codec = compression.get_codec_by_id(codec_id)
+        except BaseException:
+            value.close()
+            raise
+        value = FileObjectDecompressSlice(value, codec, raw_len, buffer_size)
+
+    return value
+
+
+def verify_on_read(value):
+    """
+    Have a value (from data_block_value or decompress_value) checked against the checksum in its fields as it's read (see FileObjectReadSlice.verify_checksum). The checksum covers the stored bytes, so a compressed value is checked as it's decompressed. Returns the value.
+    """
+    checksum_field = value.fields.get(field_checksum)
+    if checksum_field is not None:
+        raw = value._raw if isinstance(value, FileObjectDecompressSlice) else value
+        try:
+            raw.verify_checksum(*checksums.decode_field(checksum_field))
+        except BaseException:
+            value.close()
+            raise
+
+    return value
+
+
+def blob_path(db_path, content_hash, key_hash=None):
+    """
+    The path of a blob, or of the link to it held by a key. The links are hard links, so the number of keys referring to a blob is its link count minus one.
+    """
+    name = content_hash if key_hash is None else content_hash + '.' + key_hash
+
+    return db_path.joinpath(sys_dir_name, blobs_dir_name, content_hash[:shard_width], name)
+
+
+def open_blob_block(db_path, block, n_bytes_key, n_bytes_value):
+    """
+    Open the blob that a deduplicated data block refers to (through the key's own link to it). The fields of the data block (e.g. the expiry) are merged into those of the blob. The data block is closed.
+    """
+    close_data_block(block)
+    content_hash, raw_len = blob_struct.unpack(block.fields[field_blob])
+    blob_block = open_data_block(blob_path(db_path, content_hash.hex(), block.file_path.name), n_bytes_key, n_bytes_value)
+    fields = dict(block.fields)
+    fields.update(blob_block.fields)
+    blob_block.fields = fields
+
+    return blob_block
+
+
+def hash_content(value, buffer_size):
+    """
+    The content hash of a value (a file object), read in buffer_size chunks from its current position, which is restored afterwards.
+    """
+    start_pos = value.tell()
+    h = blake2b(digest_size=content_hash_len)
+    chunk = value.read(buffer_size)
+    while chunk:
+        h.update(chunk)
         chunk = value.read(buffer_size)
-        while chunk:
-            file.write(chunk)
-            chunk = value.read(buffer_size)
+    value.seek(start_pos)
 
+    return h.digest()
 
 
+def link_blob(canonical_path, link_path):
+    """
+    Add a key's link to a blob. Returns False if the blob doesn't exist.
+    """
+    try:
+        os.link(canonical_path, link_path)
+    except FileExistsError:
+        ## The key already refers to the same content
+        pass
+    except FileNotFoundError:
+        return False
 
+    return True
 
 
+def release_blob(db_path, content_hash, key_hash, durability='none', committer=None):
+    """
+    Remove a key's link to a blob and remove the blob once no key refers to it. A key that links to the blob at the same time keeps the content alive through its own link.
+    """
+    link_path = blob_path(db_path, content_hash, key_hash)
+    try:
+        os.unlink(link_path)
+    except FileNotFoundError:
+        return
 
+    canonical_path = blob_path(db_path, content_hash)
+    try:
+        if os.stat(canonical_path).st_nlink <= 1:
+            os.unlink(canonical_path)
+    except FileNotFoundError:
+        pass
 
+    commit_file(link_path, durability, committer, False)
 
 
+def read_blob_field(file_path, n_bytes_key, n_bytes_value):
+    """
+    The content hash (in hex) that a data file refers to, or None if it isn't deduplicated (or doesn't exist).
+    """
+    try:
+        block = open_data_block(file_path, n_bytes_key, n_bytes_value, 0)
+    except FileNotFoundError:
+        return None
+    close_data_block(block)
 
+    blob_field = block.fields.get(field_blob)
+    if blob_field is not None:
+        return blob_field[:content_hash_len].hex()
 
 
+def unlink_data_file(db_path, file_path, n_bytes_key, n_bytes_value, durability='none', committer=None):
+    """
+    Remove a data file and release the blob it refers to (if it's deduplicated). Raises FileNotFoundError if it doesn't exist.
+    """
+    content_hash = read_blob_field(file_path, n_bytes_key, n_bytes_value)
+    file_path.unlink()
+    if content_hash is not None:
+        release_blob(db_path, content_hash, file_path.name, durability, committer)
 
 
+def iter_blob_paths(db_path):
+    """
+    Iterate over the paths of all blobs (without the links of the keys to them).
+    """
+    blobs_path = db_path.joinpath(sys_dir_name, blobs_dir_name)
+    try:
+        dirs = [entry.path for entry in os.scandir(blobs_path) if entry.is_dir()]
+    except FileNotFoundError:
+        return
+
+    for dir_path in dirs:
+        try:
+            entries = list(os.scandir(dir_path))
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            if '.' not in entry.name and entry.is_file():
+                yield pathlib.Path(entry.path)
+
+
+def check_checksum(fields, chunks):
+    """
+    Check the chunks of a stored value against the checksum in its fields. Returns 'ok', 'checksum mismatch', 'no checksum', 'checksum unavailable' (its package isn't installed) or 'bad trailer' (an unknown checksum).
+    """
+    checksum_field = fields.get(field_checksum)
+    if checksum_field is None:
+        return 'no checksum'
+    try:
+        checksum, digest = checksums.decode_field(checksum_field)
+    except ImportError:
+        return 'checksum unavailable'
+    except ValueError:
+        return 'bad trailer'
+
+    hasher = checksum.new()
+    for chunk in chunks:
+        hasher.update(chunk)
+    if hasher.digest() != digest:
+        return 'checksum mismatch'
+
+    return 'ok'
+
+
+def verify_data_file(file_path, n_bytes_key, n_bytes_value, buffer_size, check_key=True):
+    """
+    Check a data file (or a blob) for damage: a file shorter than its header says ('truncated'), a trailer that can't be decoded ('bad trailer'), a key that doesn't hash to the file name ('key mismatch', only with check_key) and a value that doesn't match its checksum (see check_checksum). The value is read in buffer_size chunks. The data file of a deduplicated value only refers to its blob, which is checked on its own, so it's 'ok' if it's intact. Returns the key (or None if it can't be read) and the status, or (None, None) if the file has been removed in the meantime.
+    """
+    try:
+        fd = os.open(file_path, os.O_RDONLY)
+    except FileNotFoundError:
+        return None, None
+
+    try:
+        file_len = os.fstat(fd).st_size
+        n_bytes_header = n_bytes_key + n_bytes_value
+        head = os.pread(fd, n_bytes_header + header_read_size, 0)
+        if len(head) < n_bytes_header:
+            return None, 'truncated'
+
+        value_len = bytes_to_int(head[n_bytes_key:n_bytes_header])
+        value_pos = n_bytes_header + bytes_to_int(head[:n_bytes_key])
+        if len(head) < value_pos:
+            head = os.pread(fd, value_pos, 0)
+        if len(head) < value_pos:
+            return None, 'truncated'
+        key = head[n_bytes_header:value_pos].decode(errors='replace') if check_key else None
+
+        trailer_pos = value_pos + value_len
+        if file_len < trailer_pos:
+            return key, 'truncated'
+        fields = {}
+        if file_len > trailer_pos:
+            fields = decode_trailer(os.pread(fd, file_len - trailer_pos, trailer_pos))
+            if not fields:
+                return key, 'bad trailer'
+
+        if check_key and hash_key(head[n_bytes_header:value_pos]) != file_path.name:
+            return key, 'key mismatch'
+        if field_blob in fields:
+            return key, 'ok'
+
+        chunks = (os.pread(fd, min(buffer_size, trailer_pos - pos), pos) for pos in range(value_pos, trailer_pos, buffer_size))
+
+        return key, check_checksum(fields, chunks)
+    finally:
+        os.close(fd)
+
+
+def verify_data_files(paths, n_bytes_key, n_bytes_value, buffer_size):
+    """
+    Run verify_data_file over (path, check_key) pairs. Returns a list of (path, key, status) of the files that still exist. This is the task that FileDBM.verify hands to its thread or process pool.
+    """
+    results = []
+    for file_path, check_key in paths:
+        key, status = verify_data_file(file_path, n_bytes_key, n_bytes_value, buffer_size, check_key)
+        if status is not None:
+            results.append((file_path, key, status))
 
+    return results
 
 
+def verify_segment_block(key_hash, block, n_bytes_key, n_bytes_value):
+    """
+    Check a data block of a segment record (see verify_data_file). Returns the key (or None) and the status.
+    """
+    n_bytes_header = n_bytes_key + n_bytes_value
+    if len(block) < n_bytes_header:
+        return None, 'truncated'
+    key, value_pos, value_len, fields = parse_data_block(block, n_bytes_key, n_bytes_value)
+    trailer_pos = value_pos + value_len
+    if len(block) < trailer_pos:
+        return None, 'truncated'
+    key_bytes = key
+    key = key_bytes.decode(errors='replace')
+    if len(block) > trailer_pos and not fields:
+        return key, 'bad trailer'
+    if hash_key(key_bytes) != key_hash:
+        return key, 'key mismatch'
+
+    return key, check_checksum(fields, (block[value_pos:trailer_pos],))
+
+
+def get_expiry(mtime, fields, ttl=None):
+    """
+    The time (in seconds since the epoch) that a value expires. That's the earlier of its own expiry (set with a per-key ttl) and its mtime (in seconds) plus the database ttl. None if it never expires.
+    """
+    expiry = fields.get(field_expiry)
+    if expiry is not None:
+        expiry = expiry_struct.unpack(expiry)[0]
+    if ttl is not None:
+        db_expiry = mtime + ttl
+        if expiry is None or db_expiry < expiry:
+            expiry = db_expiry
 
+    return expiry
 
 
+def is_expired(mtime, fields, ttl=None, now=None):
+    """
 
+    """
+    expiry = get_expiry(mtime, fields, ttl)
+    if expiry is None:
+        return False
+    if now is None:
+        now = time()
 
+    return now > expiry
 
 
+def is_entry_expired(entry, now, min_mtime=None):
+    """
+    Check a manifest entry (key, value size, mtime in ns, expiry) against its expiry and the min mtime (in ns) allowed by the database ttl.
+    """
+    return (entry[3] is not None and now > entry[3]) or (min_mtime is not None and entry[2] < min_mtime)
 
 
+def prefix_stop(prefix):
+    """
+    The smallest string that is greater than every string starting with prefix, so that the keys with the prefix are the range [prefix, prefix_stop). None if there is no such string (the prefix is empty or only holds the max code point).
+    """
+    prefix = prefix.rstrip(chr(0x10ffff))
+    if not prefix:
+        return None
 
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
 
 
+def get_data_block(file_path, key, value, n_bytes_key, n_bytes_value, ttl=None, buffer_size=512000, db_path=None):
+    """
+    Function to get either the key or the value or both from a data block. Returns None if the value has expired. The db_path is needed to read deduplicated values.
+    """
+    if not key and not value:
+        raise ValueError('One or both key and value must be True.')
 
+    block = open_data_block(file_path, n_bytes_key, n_bytes_value, pread_max_size if value else 0)
+    if is_expired(block.stat.st_mtime, block.fields, ttl):
+        close_data_block(block)
+        return None
 
+    if key and not value:
+        close_data_block(block)
+        return block.key.decode()
 
+    key_bytes = block.key
+    if field_blob in block.fields:
+        block = open_blob_block(db_path, block, n_bytes_key, n_bytes_value)
+    value = data_block_value(block, buffer_size)
 
+    if key:
+        return key_bytes.decode(), value
+    else:
+        return value
 
 
+def get_value(db_path, key, n_bytes_key, n_bytes_value, ttl=None, shard_depth=0, buffer_size=512000):
+    """
+    Get the value of a key as a FileObjectReadSlice. A small value costs a single open, fstat and pread; for a large value the fd is handed over to the FileObjectReadSlice. Expired values are treated as missing (they are removed by FileDBM.expire).
+    """
+    key_hash = hash_key(key)
+    file_path = key_file_path(db_path, key_hash, shard_depth)
+    try:
+        block = open_data_block(file_path, n_bytes_key, n_bytes_value)
+    except FileNotFoundError:
+        return None
 
+    if is_expired(block.stat.st_mtime, block.fields, ttl):
+        close_data_block(block)
+        return None
 
+    if field_blob in block.fields:
+        try:
+            block = open_blob_block(db_path, block, n_bytes_key, n_bytes_value)
+        except FileNotFoundError:
+            ## Deleted while it was being read
+            return None
 
+    return data_block_value(block, buffer_size)
 
 
+def iter_keys_values(db_path, key=False, value=False, n_bytes_key=2, n_bytes_value=4, ttl=None, max_depth=0, buffer_size=512000, skip=None):
+    """
+    Iterate over the keys and/or values of the data files. Files named in skip (a set or dict of key hashes) are left out.
+    """
+    for file_path in iter_data_paths(db_path, max_depth):
+        if skip is not None and file_path.name in skip:
+            continue
+        try:
+            block = get_data_block(file_path, key, value, n_bytes_key, n_bytes_value, ttl, buffer_size, db_path)
+        except FileNotFoundError:
+            ## Removed by someone else since the directory was listed
+            continue
 
+        if block is not None:
+            yield block
 
 
+def fsync_dir(dir_path):
+    """
+    fsync a directory so that renames and unlinks in it are durable.
+    """
+    fd = os.open(dir_path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
 
 
+def fsync_path(file_path):
+    """
 
+    """
+    fd = os.open(file_path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
 
 
+def check_durability(durability):
+    """
 
+    """
+    if durability not in durability_levels:
+        raise ValueError('durability must be one of ' + str(durability_levels) + '.')
 
 
+def remove_stale_tmp_files(db_path, max_age=stale_tmp_age):
+    """
+    Remove temporary files left behind by writers that crashed. Only files older than max_age seconds are removed so that writes in progress in other processes are left alone.
+    """
+    tmp_path = db_path.joinpath(sys_dir_name, tmp_dir_name)
+    now = time()
+    try:
+        entries = list(os.scandir(tmp_path))
+    except FileNotFoundError:
+        return
+
+    for entry in entries:
+        try:
+            if (now - entry.stat().st_mtime) > max_age:
+                os.unlink(entry.path)
+        except FileNotFoundError:
+            pass
+
+
+def open_tmp_file(db_path, key_hash):
+    """
+    Create a new temporary file in the database's tmp directory. It's on the same filesystem as the data files so it can be renamed into place atomically.
+    """
+    tmp_dir = db_path.joinpath(sys_dir_name, tmp_dir_name)
+    tmp_path = tmp_dir.joinpath(key_hash + '.' + os.urandom(6).hex())
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL
+    try:
+        fd = os.open(tmp_path, flags, 0o666)
+    except FileNotFoundError:
+        tmp_dir.mkdir(parents=True, exist_ok=True)
+        fd = os.open(tmp_path, flags, 0o666)
 
+    return tmp_path, fd
 
 
+def replace_file(tmp_path, file_path):
+    """
+    Atomically rename the temporary file into place, creating the shard directories if needed.
+    """
+    try:
+        os.replace(tmp_path, file_path)
+    except FileNotFoundError:
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(tmp_path, file_path)
 
 
+def commit_file(file_path, durability, committer=None, is_file=True):
+    """
+    Make a renamed (or unlinked) file durable according to the durability level. The file data itself must already have been fsynced for per-write.
+    """
+    if durability == 'per-write':
+        fsync_dir(file_path.parent)
+    elif durability == 'group':
+        committer.add(file_path, is_file)
 
 
+def append_log(path, data, fd=None):
+    """
+    Append data to an append-only log (the manifest or the access log) with a single write on an O_APPEND fd, so records from several processes don't interleave. The write holds a shared flock on the log and is only done once the fd is known to still be the log's file, so a record is never lost to a log that is being rewritten (see locked_log). Returns the fd to use for the next append (reopened if the log was replaced).
+    """
+    while True:
+        if fd is None:
+            fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_SH)
+        try:
+            try:
+                current = os.stat(path).st_ino == os.fstat(fd).st_ino
+            except FileNotFoundError:
+                current = False
+            if current:
+                os.write(fd, data)
+                return fd
+        finally:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+        fd = None
+
+
+@contextmanager
+def locked_log(path):
+    """
+    Hold an exclusive flock on the current file of an append-only log while it's rewritten, so no process can append to it until it has been replaced (appenders then move on to the new file). Yields the fd of the locked file. Without fcntl nothing is locked.
+    """
+    while True:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                current = os.stat(path).st_ino == os.fstat(fd).st_ino
+            except FileNotFoundError:
+                current = False
+            if current:
+                yield fd
+                return
+        finally:
+            ## Closing the fd releases the flock
+            os.close(fd)
+
+
+def write_all(out, data):
+    """
+    Write all of data to a file object, file descriptor or socket. Returns the number of bytes written.
+    """
+    if isinstance(out, int):
+        view = memoryview(data)
+        while view:
+            view = view[os.write(out, view):]
+    elif hasattr(out, 'sendall'):
+        out.sendall(data)
+    else:
+        out.write(data)
+
+    return len(data)
+
+
+def regular_file_fd(file_obj):
+    """
+    The file descriptor of a file object that is backed by a regular file, otherwise None.
+    """
+    try:
+        fd = file_obj.fileno()
+    except (AttributeError, OSError, ValueError):
+        return None
+    try:
+        if stat_mod.S_ISREG(os.fstat(fd).st_mode):
+            return fd
+    except OSError:
+        pass
+
+    return None
+
+
+def _copy_file_range(out_fd, in_fd, offset, count):
+    return os.copy_file_range(in_fd, out_fd, count, offset)
+
+
+def _sendfile(out_fd, in_fd, offset, count):
+    return os.sendfile(out_fd, in_fd, offset, count)
+
+
+kernel_copy_funcs = tuple(func for func, name in ((_copy_file_range, 'copy_file_range'), (_sendfile, 'sendfile')) if hasattr(os, name))
+
+
+def copy_fd_range(out_fd, in_fd, offset, count):
+    """
+    Copy count bytes of in_fd starting at offset to the current position of out_fd without passing them through Python. copy_file_range is tried first (which can share the extents on btrfs, XFS and NFS), then sendfile; if neither works for these file descriptors the data is copied with pread and write. Returns the number of bytes copied, which is less than count if in_fd ends first.
+    """
+    n = 0
+    for func in kernel_copy_funcs:
+        try:
+            while n < count:
+                copied = func(out_fd, in_fd, offset + n, count - n)
+                if not copied:
+                    return n
+                n += copied
+            return n
+        except OSError as err:
+            if n or err.errno not in kernel_copy_errnos:
+                raise
+
+    while n < count:
+        data = os.pread(in_fd, min(count - n, copy_chunk_size), offset + n)
+        if not data:
+            break
+        n += write_all(out_fd, data)
+
+    return n
+
+
+def clone_file(out_fd, in_fd):
+    """
+    Make out_fd a reflink copy of the whole of in_fd (FICLONE), which shares the extents instead of copying the data. Returns False if the platform or filesystem doesn't support it.
+    """
+    if fcntl is None:
+        return False
+    try:
+        fcntl.ioctl(out_fd, ficlone, in_fd)
+    except OSError:
+        return False
+
+    return True
+
+
+def copy_file_data(out_fd, in_fd, size):
+    """
+    Copy a whole file: a reflink if the filesystem supports it, otherwise a kernel-side copy.
+    """
+    if not clone_file(out_fd, in_fd):
+        os.lseek(out_fd, 0, os.SEEK_SET)
+        copy_fd_range(out_fd, in_fd, 0, size)
+
+
+def copy_value(file, value, buffer_size, hasher=None):
+    """
+    Copy a value into a file. Values on disk (regular files and FileObjectReadSlices) are copied by the kernel, other file objects in buffer_size chunks. With a hasher (of a checksum) the value is always copied in chunks, which are added to the hasher.
+    """
+    if hasher is not None:
+        chunk = value.read(buffer_size)
+        while chunk:
+            file.write(chunk)
+            hasher.update(chunk)
+            chunk = value.read(buffer_size)
+        return
+
+    if isinstance(value, FileObjectReadSlice):
+        value.copy_to(file)
+        return
+
+    in_fd = regular_file_fd(value)
+    if in_fd is not None:
+        pos = value.tell()
+        file.flush()
+        n = copy_fd_range(file.fileno(), in_fd, pos, os.fstat(in_fd).st_size - pos)
+        file.seek(0, io.SEEK_CUR)
+        value.seek(pos + n)
+        return
+
+    chunk = value.read(buffer_size)
+    while chunk:
+        file.write(chunk)
+        chunk = value.read(buffer_size)
+
+
+def copy_compressed_value(file, value, buffer_size, compressobj, max_len, hasher=None):
+    """
+    Compress a value into a file in buffer_size chunks. The compressed chunks are added to the hasher if given. Returns the compressed length, or None as soon as it's clear that the compressed value won't be smaller than max_len.
+    """
+    n = 0
+    chunk = value.read(buffer_size)
+    while chunk:
+        out = compressobj.compress(chunk)
+        if out:
+            n += len(out)
+            if n >= max_len:
+                return None
+            file.write(out)
+            if hasher is not None:
+                hasher.update(out)
+        chunk = value.read(buffer_size)
+
+    out = compressobj.flush()
+    n += len(out)
+    if n >= max_len:
+        return None
+    file.write(out)
+    if hasher is not None:
+        hasher.update(out)
+
+    return n
+
+
+def write_data_block(db_path, key, value, n_bytes_key, n_bytes_value, buffer_size, shard_depth=0, durability='none', committer=None, fields=None, compressor=None, file_path=None, checksum=None):
+    """
+    Write a data block. The block is written to a temporary file which is then atomically renamed into place, so readers never see a partially written value. With durability 'per-write' the file and its directory are fsynced before returning; with 'group' the fsyncs are handed to the GroupCommitter. Any extra fields (a dict of tag -> bytes) are written to the trailer after the value. With a compressor, values of at least compressor.min_size are compressed while streaming (unless they don't shrink) and the codec field is added to fields. With a checksum, the checksum of the stored value is computed while streaming and added to fields. Values of unknown length (see is_stream) are written with a DataBlockWriter, and a DataBlockWriter that has already been written is just committed. The file_path defaults to the key's data file. Returns the os.stat_result of the written file.
+    """
+    key_bytes_len = len(key)
+    key_hash = hash_key(key)
+
+    if file_path is None:
+        file_path = key_file_path(db_path, key_hash, shard_depth)
+
+    if isinstance(value, bytes):
+        value = io.BytesIO(value)
+    elif is_stream(value):
+        writer = DataBlockWriter(db_path, key, n_bytes_key, n_bytes_value, compressor, None, checksum)
+        try:
+            writer.write_from(value, buffer_size)
+        except BaseException:
+            writer.abort()
+            raise
+        value = writer
+
+    if isinstance(value, DataBlockWriter):
+        return value.commit(file_path, fields, durability, committer)
+
+    value_bytes_len = determine_obj_size(value)
+
+    write_init_bytes = int_to_bytes(key_bytes_len, n_bytes_key) + int_to_bytes(value_bytes_len, n_bytes_value) + key
+
+    tmp_path, fd = open_tmp_file(db_path, key_hash)
+    try:
+        with io.open(fd, 'wb') as file:
+            _ = file.write(write_init_bytes)
+
+            if hasattr(value, '_buffer_size'):
+                buffer_size = value._buffer_size
+
+            hasher = None if checksum is None else checksum.new()
+            if compressor is not None and value_bytes_len >= compressor.min_size:
+                start_pos = value.tell()
+                compressed_len = copy_compressed_value(file, value, buffer_size, compressor.compressobj(), value_bytes_len, hasher)
+                if compressed_len is None:
+                    ## It doesn't shrink, so store it as is
+                    file.seek(len(write_init_bytes))
+                    file.truncate()
+                    value.seek(start_pos)
+                    hasher = None if checksum is None else checksum.new()
+                    copy_value(file, value, buffer_size, hasher)
+                else:
+                    if fields is None:
+                        fields = {}
+                    fields[field_codec] = compression.codec_struct.pack(compressor.codec.codec_id, value_bytes_len)
+                    file.seek(n_bytes_key)
+                    file.write(int_to_bytes(compressed_len, n_bytes_value))
+                    file.seek(0, io.SEEK_END)
+            else:
+                copy_value(file, value, buffer_size, hasher)
+
+            if hasher is not None:
+                if fields is None:
+                    fields = {}
+                fields[field_checksum] = checksums.encode_field(checksum, hasher.digest())
+            if fields:
+                file.write(encode_trailer(fields))
+
+            file.flush()
+            if durability == 'per-write':
+                os.fsync(fd)
 
+            stat = os.fstat(fd)
 
+        replace_file(tmp_path, file_path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
 
+    commit_file(file_path, durability, committer)
 
+    return stat
 
 
+def write_dedup_block(db_path, key, value, n_bytes_key, n_bytes_value, buffer_size, shard_depth=0, durability='none', committer=None, fields=None, compressor=None, checksum=None):
+    """
+    Write a value deduplicated by its content. The value is hashed first; if a blob with the same content already exists the key just gets a hard link to it and the value isn't written again. Otherwise the blob is written (and compressed and checksummed) like a data block. The key's data file then only holds the content hash and length in its trailer (which is added to fields). The blob of the key's previous value is released. Returns the os.stat_result of the key's data file.
+    """
+    key_hash = hash_key(key)
+
+    if isinstance(value, bytes):
+        value = io.BytesIO(value)
 
+    if hasattr(value, '_buffer_size'):
+        buffer_size = value._buffer_size
 
+    value_bytes_len = determine_obj_size(value)
+    content_hash = hash_content(value, buffer_size).hex()
+    canonical_path = blob_path(db_path, content_hash)
+    link_path = blob_path(db_path, content_hash, key_hash)
+
+    ## The blob can be removed by a concurrent release between the write and the link, so try again
+    for _ in range(3):
+        if link_blob(canonical_path, link_path):
+            break
+        start_pos = value.tell()
+        write_data_block(db_path, b'', value, n_bytes_key, n_bytes_value, buffer_size, 0, durability, committer, None, compressor, canonical_path, checksum)
+        value.seek(start_pos)
+    else:
+        raise FileNotFoundError('The blob ' + content_hash + ' kept being removed while it was written.')
+    commit_file(link_path, durability, committer, False)
 
+    file_path = key_file_path(db_path, key_hash, shard_depth)
+    old_content_hash = read_blob_field(file_path, n_bytes_key, n_bytes_value)
 
+    if fields is None:
+        fields = {}
+    fields[field_blob] = blob_struct.pack(bytes.fromhex(content_hash), value_bytes_len)
+    stat = write_data_block(db_path, key, b'', n_bytes_key, n_bytes_value, buffer_size, shard_depth, durability, committer, fields)
 
+    if old_content_hash is not None and old_content_hash != content_hash:
+        release_blob(db_path, old_content_hash, key_hash, durability, committer)
 
+    return stat
 
 
+def iter_file_range(fd, pos, length, chunk_size=copy_chunk_size):
+    """
+    Read length bytes of a file from pos in chunks of at most chunk_size.
+    """
+    end = pos + length
+    while pos < end:
+        chunk = os.pread(fd, min(chunk_size, end - pos), pos)
+        if not chunk:
+            break
+        pos += len(chunk)
+        yield chunk
 
 
+def patched_chunks(value, offset, data, chunk_size=copy_chunk_size):
+    """
+    The chunks of a value (a file object of known length) with data written at offset (None appends it), without holding the whole value in memory.
+    """
+    if offset is None:
+        offset = value.length
+    value.seek(0)
+    pos = 0
+    while pos < offset:
+        chunk = value.read(min(chunk_size, offset - pos))
+        if not chunk:
+            break
+        pos += len(chunk)
+        yield chunk
+    yield data
+    if offset + len(data) < value.length:
+        value.seek(offset + len(data))
+        while True:
+            chunk = value.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+def patch_data_block(db_path, file_path, offset, data, n_bytes_key, n_bytes_value, durability='none', committer=None, atomic=False, ttl=None):
+    """
+    Write data into the value of a data file at offset (None appends it) without rewriting the rest of the value. When the value grows, the trailer is moved to the new end and the value-length field in the header is updated last. In place only the changed bytes, the trailer and the header are written, but a reader may see a partly written patch. With atomic=True the file is copied (as a reflink where the filesystem supports it) to a temporary file which is patched and renamed into place. The checksum of the value is updated: a crc32 or crc32c checksum is continued with data when appending, otherwise the patched value is hashed in chunks from the file. Compressed and deduplicated values (and values whose checksum algorithm isn't available) can't be patched, so None is returned for them, as it is for an expired value (against its own expiry and the database ttl) which must not be brought back by the patch. Otherwise returns the os.stat_result of the patched file, the new value length and the trailer fields. Raises FileNotFoundError if the file doesn't exist.
+    """
+    n_bytes_header = n_bytes_key + n_bytes_value
+    fd = os.open(file_path, os.O_RDONLY if atomic else os.O_RDWR)
+    try:
+        file_stat = os.fstat(fd)
+        file_len = file_stat.st_size
+        head = os.pread(fd, n_bytes_header + header_read_size, 0)
+        key_len = bytes_to_int(head[:n_bytes_key])
+        value_len = bytes_to_int(head[n_bytes_key:n_bytes_header])
+        value_pos = n_bytes_header + key_len
+        trailer_pos = value_pos + value_len
+        if file_len > trailer_pos:
+            trailer = os.pread(fd, file_len - trailer_pos, trailer_pos)
+        else:
+            value_len = max(0, min(value_len, file_len - value_pos))
+            trailer = b''
+        fields = decode_trailer(trailer)
+        if not fields:
+            trailer = b''
+
+        if field_codec in fields or field_blob in fields or is_expired(file_stat.st_mtime, fields, ttl):
+            return None
+
+        if offset is None:
+            offset = value_len
+        elif offset < 0 or offset > value_len:
+            raise ValueError('offset must be between 0 and the length of the value ({}).'.format(value_len))
+        new_value_len = max(value_len, offset + len(data))
+        if new_value_len >= 256**n_bytes_value:
+            raise ValueError('The value would be too long for n_bytes_value.')
+
+        if field_checksum in fields:
+            try:
+                checksum, digest = checksums.decode_field(fields[field_checksum])
+            except (ImportError, ValueError):
+                return None
+            if offset == value_len and checksum.resume is not None:
+                hasher = checksum.resume(digest)
+                hasher.update(data)
+            else:
+                ## The patched value is hashed in chunks from the file
+                hasher = checksum.new()
+                for chunk in iter_file_range(fd, value_pos, offset):
+                    hasher.update(chunk)
+                hasher.update(data)
+                for chunk in iter_file_range(fd, value_pos + offset + len(data), value_len - offset - len(data)):
+                    hasher.update(chunk)
+            fields[field_checksum] = checksums.encode_field(checksum, hasher.digest())
+            trailer = encode_trailer(fields)
+
+        if atomic:
+            tmp_path, tmp_fd = open_tmp_file(db_path, file_path.name)
+            try:
+                copy_file_data(tmp_fd, fd, file_len)
+            except BaseException:
+                os.close(tmp_fd)
+                os.unlink(tmp_path)
+                raise
+            os.close(fd)
+            fd = tmp_fd
+
+        try:
+            os.pwrite(fd, data, value_pos + offset)
+            if new_value_len > value_len or field_checksum in fields:
+                if trailer:
+                    os.pwrite(fd, trailer, value_pos + new_value_len)
+            if new_value_len > value_len:
+                os.pwrite(fd, int_to_bytes(new_value_len, n_bytes_value), n_bytes_key)
+            if durability == 'per-write':
+                os.fsync(fd)
+            stat = os.fstat(fd)
+
+            if atomic:
+                os.close(fd)
+                fd = None
+                replace_file(tmp_path, file_path)
+        except BaseException:
+            if atomic:
+                try:
+                    os.unlink(tmp_path)
+                except FileNotFoundError:
+                    pass
+            raise
+    finally:
+        if fd is not None:
+            os.close(fd)
+
+    if atomic:
+        commit_file(file_path, durability, committer)
+    elif durability == 'group':
+        committer.add(file_path)
+
+    return stat, new_value_len, fields
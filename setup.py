@@ -144,10 +144,14 @@ setup(
     #
     # Similar to `install_requires` above, these must be valid existing
     # projects.
-    #extras_require={  # Optional
-    #    'dev': ['check-manifest'],
-    #    'test': ['coverage'],
-    #},
+    extras_require={  # Optional
+        'zstd': ['zstandard'],
+        'lz4': ['lz4'],
+        'crc32c': ['crc32c'],
+        'xxhash': ['xxhash'],
+        'msgpack': ['msgpack'],
+        'numpy': ['numpy'],
+    },
 
     # If there are data files included in your packages that need to be
     # installed, specify them here.